@@ -1,8 +1,15 @@
 import streamlit as st
-import redis
 import bson
+import pandas as pd
+from datetime import datetime, timedelta
 from utils.utils import verify_admin_access
 from utils.database.database_manager import get_database
+from utils.database.connections import get_redis_connection, get_connection_stats
+from utils.flowise_client import get_ttft_stats, get_transport_stats
+from utils.translation import translation_memory
+from utils.redis_explorer import scan_page, sample_memory_by_prefix, read_value
+from utils.usage import get_usage_rollups, flush_usage_rollups
+from utils.perf import get_perf_stats
 
 # Проверка прав администратора
 if not verify_admin_access():
@@ -17,17 +24,9 @@ if not db:
 # Получаем прямой доступ к базе данных MongoDB
 mongo_db = db.db  # Получаем объект базы данных MongoDB
 
-# Инициализация Redis с использованием secrets
+# Клиент Redis из общего пула подключений процесса
 try:
-    redis_client = redis.Redis(
-        host=st.secrets["redis"]["host"],
-        port=st.secrets["redis"]["port"],
-        password=st.secrets["redis"]["password"],
-        db=st.secrets["redis"]["db"],
-        decode_responses=True,
-        socket_timeout=10,
-        socket_connect_timeout=10
-    )
+    redis_client = get_redis_connection()
     # Проверяем подключение
     redis_client.ping()
 except Exception as e:
@@ -36,13 +35,68 @@ except Exception as e:
 
 st.title('Продвинутая аналитика баз данных')
 
-# Создаем три вкладки: для Пользователей, MongoDB и Redis
-tabs = st.tabs(['Пользователи', 'MongoDB', 'Redis'])
+# Счетчики подключений процесса: при повторных запусках страницы они не должны расти
+with st.expander('Подключения процесса', expanded=False):
+    st.json(get_connection_stats())
+
+# Время до первого токена по чат-потокам (замеры текущего процесса)
+with st.expander('Flowise: время до первого токена', expanded=False):
+    ttft_stats = get_ttft_stats()
+    if ttft_stats:
+        st.json(ttft_stats)
+    else:
+        st.info('Замеров пока нет')
+    st.write('Транспорт Flowise (запросы, повторы, переиспользование подключений):')
+    st.json(get_transport_stats())
+
+# Попадания по уровням кэша DatabaseManager (L1 процесса и Redis)
+with st.expander('Кэш данных', expanded=False):
+    st.json(db.get_cache_stats())
+
+# Серверное время обработки взаимодействий
+with st.expander('Время обработки взаимодействий', expanded=False):
+    # Полный перезапуск страницы (*:script) и перезапуск только области чата (*:chat_fragment)
+    perf_stats = get_perf_stats()
+    if perf_stats:
+        st.table(pd.DataFrame.from_dict(perf_stats, orient='index'))
+    else:
+        st.info("Замеров пока нет")
+
+# Попадания в память переводов (локальный кэш процесса и Redis)
+with st.expander('Память переводов', expanded=False):
+    st.json(translation_memory.get_stats())
+
+# Вкладки: пользователи, MongoDB, Redis и использование генераций
+tabs = st.tabs(['Пользователи', 'MongoDB', 'Redis', 'Использование'])
 
 with tabs[0]:
     st.subheader('Пользователи')
+    
+    # Сводка считается одной агрегацией на стороне MongoDB
+    try:
+        summary = db.get_users_summary()
+        metric_col1, metric_col2, metric_col3 = st.columns(3)
+        metric_col1.metric("Пользователей", summary["users"])
+        metric_col2.metric("Активных токенов", summary["active_tokens"])
+        metric_col3.metric("Остаток генераций", summary["remaining_generations"])
+        if summary["registrations"]:
+            st.write("Регистрации по дням:")
+            st.bar_chart(
+                {row["date"]: row["count"] for row in summary["registrations"]}
+            )
+    except Exception as e:
+        st.error(f"Ошибка при получении сводки пользователей: {str(e)}")
+    
+    user_search = st.text_input("Поиск по началу имени или email")
+    
+    # Курсоры просмотренных страниц; при смене поиска просмотр начинается сначала
+    if st.session_state.get('user_browser_search') != user_search:
+        st.session_state.user_browser_search = user_search
+        st.session_state.user_page_cursors = [None]
+    
     try:
-        users = list(db.users.find())
+        cursors = st.session_state.user_page_cursors
+        users, next_username = db.find_users_page(user_search, after_username=cursors[-1])
         if users:
             user_options = {}
             for u in users:
@@ -55,7 +109,8 @@ with tabs[0]:
                 
                 # Отображение информации о пользователе
                 st.write("Информация о пользователе:")
-                registration_date = selected_user.get("registered_at", "Не указано")
+                st.write("Email:", selected_user.get("email", "Не указано"))
+                registration_date = selected_user.get("created_at", selected_user.get("registered_at", "Не указано"))
                 st.write("Дата регистрации:", registration_date)
                 
                 # Информация о токене
@@ -76,6 +131,18 @@ with tabs[0]:
                     st.write("Чат-потоки отсутствуют")
         else:
             st.info("Пользователи не найдены")
+        
+        nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+        with nav_col1:
+            if st.button("⬅️ Назад", key="users_prev", disabled=len(cursors) == 1, use_container_width=True):
+                cursors.pop()
+                st.rerun()
+        with nav_col2:
+            st.caption(f"Страница {len(cursors)}")
+        with nav_col3:
+            if st.button("Вперед ➡️", key="users_next", disabled=next_username is None, use_container_width=True):
+                cursors.append(next_username)
+                st.rerun()
     except Exception as e:
         st.error(f"Ошибка при получении данных пользователей: {str(e)}")
 
@@ -126,20 +193,64 @@ with tabs[1]:
 with tabs[2]:
     st.subheader('Аналитика Redis')
     if redis_client:
+        # Обход ключей через SCAN: курсор хранится в состоянии сессии
+        scan_col1, scan_col2 = st.columns([3, 1])
+        with scan_col1:
+            scan_match = st.text_input('Шаблон ключей (MATCH)', value='*')
+        with scan_col2:
+            scan_count = st.selectbox('Ключей за шаг', [50, 100, 500], index=1)
+        
+        if st.session_state.get('redis_scan_match') != (scan_match, scan_count):
+            st.session_state.redis_scan_match = (scan_match, scan_count)
+            st.session_state.redis_scan_cursor = 0
+            st.session_state.redis_scan_done = False
+        
         try:
-            keys = redis_client.keys('*')
-            if keys:
-                st.write('Первые 10 ключей Redis:')
-                for key in keys[:10]:
-                    try:
-                        value = redis_client.get(key)
-                        st.write(f'Ключ: {key}  Значение: {value}')
-                    except Exception as e:
-                        st.write(f'Ключ: {key}  Ошибка чтения значения: {e}')
+            if st.session_state.redis_scan_done:
+                st.info('Обход завершен')
             else:
-                st.info('Ключи не найдены')
+                next_cursor, rows = scan_page(scan_match, st.session_state.redis_scan_cursor, scan_count)
+                if rows:
+                    st.dataframe(rows, use_container_width=True)
+                elif next_cursor:
+                    st.info('На этом шаге совпадений нет, обход можно продолжить')
+                else:
+                    st.info('Ключи не найдены')
+            
+            nav_col1, nav_col2 = st.columns(2)
+            with nav_col1:
+                if st.button('Следующие ключи', disabled=st.session_state.redis_scan_done):
+                    st.session_state.redis_scan_cursor = next_cursor
+                    st.session_state.redis_scan_done = next_cursor == 0
+                    st.rerun()
+            with nav_col2:
+                if st.button('С начала'):
+                    st.session_state.redis_scan_cursor = 0
+                    st.session_state.redis_scan_done = False
+                    st.rerun()
         except Exception as e:
             st.error(f'Ошибка получения ключей: {e}')
+        
+        # Память по группам ключей считается по выборке только по запросу
+        st.write('---')
+        st.subheader('Память по префиксам ключей')
+        sample_size = st.select_slider('Размер выборки', options=[200, 500, 1000, 5000], value=1000)
+        if st.button('Оценить память'):
+            try:
+                breakdown = sample_memory_by_prefix(sample_size)
+                st.write(f"Ключей в базе: {breakdown['total_keys']}, в выборке: {breakdown['sampled']}")
+                if breakdown['groups']:
+                    st.dataframe(breakdown['groups'], use_container_width=True)
+            except Exception as e:
+                st.error(f'Ошибка оценки памяти: {e}')
+        
+        key_to_view = st.text_input('Просмотр значения ключа')
+        if key_to_view:
+            try:
+                st.write('Значение:')
+                st.write(read_value(key_to_view))
+            except Exception as e:
+                st.write(f'Ошибка чтения значения: {e}')
     else:
         st.error('Подключение к Redis не установлено')
 
@@ -157,4 +268,42 @@ with tabs[2]:
                 except Exception as e:
                     st.error(f'Ошибка обновления значения: {e}')
             else:
-                st.error('Пожалуйста, заполните все поля для редактирования') 
\ No newline at end of file
+                st.error('Пожалуйста, заполните все поля для редактирования') 
+with tabs[3]:
+    st.subheader('Генерации по чат-потокам и пользователям')
+    usage_col1, usage_col2 = st.columns([3, 1])
+    with usage_col1:
+        usage_days = st.selectbox('Период, дней', [1, 7, 30, 90], index=1)
+    with usage_col2:
+        if st.button('Перенести свежие счетчики'):
+            try:
+                st.success(f'Обновлено записей: {flush_usage_rollups()}')
+            except Exception as e:
+                st.error(f'Ошибка переноса счетчиков: {e}')
+    
+    try:
+        # Читаются только часовые записи за период, объем не зависит от числа сообщений
+        rollups = get_usage_rollups(datetime.now() - timedelta(days=usage_days))
+        if rollups:
+            usage_df = pd.DataFrame(rollups)
+            usage_df['day'] = usage_df['hour'].dt.floor('D')
+            
+            st.metric('Генераций за период', int(usage_df['generations'].sum()))
+            
+            st.write('По чат-потокам и дням:')
+            st.bar_chart(usage_df.pivot_table(
+                index='day', columns='flow_id', values='generations', aggfunc='sum', fill_value=0
+            ))
+            
+            st.write('По часам суток:')
+            st.bar_chart(usage_df.groupby(usage_df['hour'].dt.hour)['generations'].sum())
+            
+            st.write('Самые активные пользователи:')
+            st.dataframe(
+                usage_df.groupby('username')['generations'].sum().nlargest(20).rename('generations'),
+                use_container_width=True
+            )
+        else:
+            st.info('Данных об использовании за период нет')
+    except Exception as e:
+        st.error(f'Ошибка получения данных об использовании: {e}')
@@ -4,8 +4,8 @@ from utils.page_config import setup_pages
 from utils.database.database_manager import get_database
 from datetime import datetime, timedelta
 import redis.exceptions
-import socket
-from pymongo import MongoClient, errors as mongo_errors
+from utils.database.connections import get_redis_connection
+from utils.token_registry import mint_tokens, tokens_to_csv, serialize_token_data, find_tokens_page
 import hashlib
 import secrets
 import json
@@ -15,18 +15,8 @@ from utils.security import verify_password, check_login_attempts, increment_logi
 # Настраиваем страницы
 setup_pages()
 
-# Инициализация Redis
-redis_pool = redis.ConnectionPool(
-    host=st.secrets["redis"]["host"],
-    port=st.secrets["redis"]["port"],
-    password=st.secrets["redis"]["password"],
-    db=0,
-    socket_timeout=10,
-    socket_connect_timeout=10,
-    socket_keepalive=True,
-    retry_on_timeout=True
-)
-redis_client = redis.Redis(connection_pool=redis_pool, decode_responses=True)
+# Клиент Redis поверх общего пула подключений процесса
+redis_client = get_redis_connection()
 
 def safe_redis_operation(operation, *args, max_retries=3, **kwargs):
     """Безопасное выполнение Redis операций"""
@@ -48,18 +38,8 @@ class DateTimeEncoder(json.JSONEncoder):
             return obj.isoformat()
         return super().default(obj)
 
-def serialize_token_data(token_data: dict) -> str:
-    """Безопасная сериализация данных токена в JSON"""
-    serializable_data = token_data.copy()
-    for key, value in serializable_data.items():
-        if isinstance(value, datetime):
-            serializable_data[key] = value.isoformat()
-    return json.dumps(serializable_data)
-
-# После импортов и инициализации Redis
-def generate_secure_token() -> str:
-    """Генерация криптографически безопасного токена"""
-    return secrets.token_hex(32)  # 256-bit token
+MAX_MINT_COUNT = 100000      # токенов за одну партию
+INLINE_DISPLAY_LIMIT = 10    # партии больше этого размера отдаются только файлом CSV
 
 # Функция проверки сессии администратора
 def verify_admin_session():
@@ -118,53 +98,10 @@ if not verify_admin_access():
 
 st.title("Генерация токенов (Админ панель)")
 
-# После инициализации баз данных, но до основного кода
-def cleanup_expired_tokens():
-    """Агрессивная очистка неактивных токенов"""
-    try:
-        # Создаем индексы для оптимизации запросов если их нет
-        db.access_tokens.create_index([("remaining_generations", 1)])
-        db.access_tokens.create_index([("expires_at", 1)])
-        db.access_tokens.create_index([("created_at", -1)])
-        
-        # Удаляем все токены с нулевыми генерациями
-        result1 = db.access_tokens.delete_many({
-            "remaining_generations": {"$lte": 0}
-        })
-        
-        # Удаляем просроченные токены
-        result2 = db.access_tokens.delete_many({
-            "has_time_limit": True,
-            "expires_at": {"$lt": datetime.now()}
-        })
-        
-        # Очищаем соответствующие записи в Redis
-        if result1.deleted_count > 0 or result2.deleted_count > 0:
-            # Получаем все активные токены из MongoDB
-            active_tokens = set(token["token"] for token in db.access_tokens.find({}, {"token": 1}))
-            
-            # Получаем все ключи токенов из Redis
-            redis_keys = safe_redis_operation(redis_client.keys, "token_*")
-            
-            # Удаляем из Redis токены, которых нет в MongoDB
-            for redis_key in redis_keys:
-                token = redis_key.replace("token_", "")
-                if token not in active_tokens:
-                    safe_redis_operation(redis_client.delete, redis_key)
-        
-        total_deleted = result1.deleted_count + result2.deleted_count
-        if total_deleted > 0:
-            print(f"Удалено токенов: {total_deleted} (без генераций: {result1.deleted_count}, просрочено: {result2.deleted_count})")
-            
-    except Exception as e:
-        print(f"Ошибка при очистке токенов: {str(e)}")
-        st.error("Ошибка при очистке токенов")
-
-# Запускаем очистку при старте страницы
-cleanup_expired_tokens()
+# Очистка токенов и синхронизация кэша выполняются фоновым процессом (python -m utils.maintenance)
 
 with st.form("token_generation"):
-    num_tokens = st.number_input("Количество токенов", min_value=1, max_value=10, value=1)
+    num_tokens = st.number_input("Количество токенов", min_value=1, max_value=MAX_MINT_COUNT, value=1)
     generations = st.number_input("Количество генераций на токен", 
                                 min_value=10, max_value=1000, value=500)
     
@@ -186,61 +123,89 @@ if submit:
         st.session_state.admin_verified = False
         st.rerun()
         
-    generated_tokens = []
-    for _ in range(num_tokens):
-        try:
-            # Генерируем новый токен
-            new_token = generate_secure_token()
-            
-            # Устанавливаем срок действия только если включено ограничение по времени
-            expires_at = datetime.now() + timedelta(days=expiry_days) if enable_time_limit else None
-            
-            # Сохраняем токен в MongoDB
-            token_data = {
-                "token": new_token,
-                "total_generations": generations,
-                "remaining_generations": generations,
-                "used": False,
-                "created_at": datetime.now(),
-                "has_time_limit": enable_time_limit,
-                "expires_at": expires_at,
-                "created_by": st.session_state.username
-            }
-            
-            db.access_tokens.insert_one(token_data)
-            
-            # Кэшируем токен в Redis с правильной сериализацией
-            safe_redis_operation(
-                redis_client.setex,
-                f"token_{new_token}",
-                86400,  # 24 часа
-                serialize_token_data(token_data)
-            )
-            
-            generated_tokens.append((new_token, enable_time_limit))
-            
-        except Exception as e:
-            st.error(f"Ошибка при генерации токена: {str(e)}")
-            print(f"Подробная ошибка: {str(e)}")  # Для отладки
-            continue
+    # Устанавливаем срок действия только если включено ограничение по времени
+    # Срок хранится в UTC: по нему токены удаляет TTL-индекс MongoDB
+    expires_at = datetime.utcnow() + timedelta(days=expiry_days) if enable_time_limit else None
+    
+    progress_bar = st.progress(0.0, text="Генерация токенов...")
+    started = time.monotonic()
+    
+    def report_progress(done: int, total: int):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        progress_bar.progress(done / total, text=f"Сгенерировано {done} из {total} ({done / elapsed:,.0f} токенов/с)")
+    
+    try:
+        minted = mint_tokens(
+            int(num_tokens),
+            int(generations),
+            expires_at=expires_at,
+            created_by=st.session_state.username,
+            progress_callback=report_progress
+        )
+    except Exception as e:
+        minted = []
+        st.error(f"Ошибка при генерации токенов: {str(e)}")
+        print(f"Подробная ошибка: {str(e)}")  # Для отладки
+    
+    elapsed = time.monotonic() - started
+    progress_bar.empty()
     
     # Отображаем сгенерированные токены
-    if generated_tokens:
-        st.success(f"Успешно сгенерировано токенов: {len(generated_tokens)}")
-        for token, has_time_limit in generated_tokens:
-            with st.expander(f"Токен {token[:8]}...", expanded=True):
-                st.code(token)
-                if has_time_limit:
-                    st.write(f"✅ {generations} генераций | ⏱️ {expiry_days} дней")
-                else:
-                    st.write(f"✅ {generations} генераций | ♾️ Без ограничения по времени")
+    if minted:
+        st.success(
+            f"Успешно сгенерировано токенов: {len(minted)} за {elapsed:.1f}с "
+            f"({len(minted) / max(elapsed, 1e-6):,.0f} токенов/с)"
+        )
+        st.download_button(
+            "Скачать CSV",
+            data=tokens_to_csv(minted),
+            file_name=f"tokens_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+            mime="text/csv"
+        )
+        # Небольшие партии показываем на странице, крупные доступны только в CSV
+        if len(minted) <= INLINE_DISPLAY_LIMIT:
+            for token_data in minted:
+                with st.expander(f"Токен {token_data['token'][:8]}...", expanded=True):
+                    st.code(token_data["token"])
+                    if token_data["has_time_limit"]:
+                        st.write(f"✅ {generations} генераций | ⏱️ {expiry_days} дней")
+                    else:
+                        st.write(f"✅ {generations} генераций | ♾️ Без ограничения по времени")
 
 # Модифицируем отображение существующих токенов
 st.markdown("---")
 st.subheader("Существующие токены")
 
+TOKEN_STATUS_FILTERS = {
+    "Все": "all",
+    "Неиспользованные": "unused",
+    "Использованные": "used",
+    "Просроченные": "expired",
+    "С ограничением по времени": "time_limited"
+}
+
+filter_col1, filter_col2, filter_col3 = st.columns([2, 2, 1])
+with filter_col1:
+    status_label = st.selectbox("Состояние", list(TOKEN_STATUS_FILTERS.keys()))
+with filter_col2:
+    token_prefix = st.text_input("Начало токена", max_chars=64)
+with filter_col3:
+    page_size = st.selectbox("На странице", [25, 50, 100], index=1)
+
+# Курсоры просмотренных страниц; при смене фильтров просмотр начинается сначала
+filters_state = (status_label, token_prefix.strip().lower(), page_size)
+if st.session_state.get("token_list_filters") != filters_state:
+    st.session_state.token_list_filters = filters_state
+    st.session_state.token_page_cursors = [None]
+
 try:
-    tokens = list(db.access_tokens.find().sort("created_at", -1))
+    cursors = st.session_state.token_page_cursors
+    tokens, next_cursor = find_tokens_page(
+        TOKEN_STATUS_FILTERS[status_label],
+        token_prefix,
+        after=cursors[-1],
+        page_size=page_size
+    )
     if tokens:
         for token in tokens:
             with st.expander(f"Токен {token['token'][:8]}..."):
@@ -255,7 +220,7 @@ try:
                     if token.get("has_time_limit", False):
                         expires_at = token.get("expires_at")
                         if expires_at:
-                            days_left = (expires_at - datetime.now()).days
+                            days_left = (expires_at - datetime.utcnow()).days
                             if days_left > 0:
                                 st.write(f"🕒 {days_left} дней")
                             else:
@@ -274,7 +239,19 @@ try:
                         except Exception as e:
                             st.error(f"Ошибка при удалении токена: {str(e)}")
     else:
-        st.info("Нет активных токенов")
+        st.info("Нет токенов")
+    
+    nav_col1, nav_col2, nav_col3 = st.columns([1, 2, 1])
+    with nav_col1:
+        if st.button("⬅️ Назад", disabled=len(cursors) == 1, use_container_width=True):
+            cursors.pop()
+            st.rerun()
+    with nav_col2:
+        st.caption(f"Страница {len(cursors)}")
+    with nav_col3:
+        if st.button("Вперед ➡️", disabled=next_cursor is None, use_container_width=True):
+            cursors.append(next_cursor)
+            st.rerun()
 except Exception as e:
     st.error(f"Ошибка при загрузке токенов: {str(e)}")
 
@@ -299,7 +276,7 @@ def validate_token(token: str) -> bool:
             
         # Проверяем срок действия
         if token_data.get("has_time_limit") and token_data.get("expires_at"):
-            if datetime.now() > token_data["expires_at"]:
+            if datetime.utcnow() > token_data["expires_at"]:
                 # Немедленно удаляем просроченный токен
                 db.access_tokens.delete_one({"token": token})
                 safe_redis_operation(redis_client.delete, f"token_{token}")
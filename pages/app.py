@@ -1,63 +1,38 @@
 import streamlit as st
-import requests
 import json
 import os
 from PIL import Image
-import hashlib
 import base64
 import mimetypes
 from datetime import datetime
 from googletrans import Translator
 from utils.page_config import setup_pages, PAGE_CONFIG, check_token_access
-from utils.utils import verify_user_access
+from utils.utils import verify_user_access, reserve_generation, complete_generation
+from utils.quota import get_remaining, refund_generation
+from utils.usage import record_generation
 import time
-from utils.translation import translate_text, display_message_with_translation
-from flowise import Flowise, PredictionData
+from utils.perf import record_timing, timed
+from utils.translation import translate_text, display_message_with_translation, detect_message_language
+from utils.transcript import render_transcript, render_message_body
+from utils.flowise_client import create_prediction, stream_prediction
 import uuid
 from utils.database.database_manager import get_database
 import redis.exceptions
-import socket
-from pymongo import MongoClient, errors as mongo_errors
+from pymongo import errors as mongo_errors
+from utils.database.connections import get_mongo_client, get_redis_connection
 
-# Инициализация MongoDB с аутентификацией
+# Начало выполнения скрипта страницы (для замера полного перезапуска)
+_script_started = time.perf_counter()
+
+# Подключение к MongoDB берем из общего реестра процесса
 try:
-    mongo_uri = (
-        f"mongodb://{st.secrets['mongodb']['username']}:{st.secrets['mongodb']['password']}"
-        f"@fra1.clusters.zeabur.com:31735/{st.secrets['mongodb']['database']}"
-        "?authSource=admin&authMechanism=SCRAM-SHA-1"
-    )
-    mongo_client = MongoClient(mongo_uri, 
-                             serverSelectionTimeoutMS=5000,
-                             connectTimeoutMS=5000,
-                             socketTimeoutMS=5000)
-    # Проверка подключения
-    mongo_client.admin.command('ping')
-    print("MongoDB подключение успешно установлено")
+    mongo_client = get_mongo_client()
 except mongo_errors.ConnectionFailure as e:
     st.error(f"Ошибка подключения к MongoDB: {str(e)}")
     st.stop()
 
-# Создаем пул подключений Redis с надежными настройками
-redis_pool = redis.ConnectionPool(
-    host=st.secrets["redis"]["host"],
-    port=st.secrets["redis"]["port"],
-    password=st.secrets["redis"]["password"],
-    db=0,
-    socket_timeout=10,
-    socket_connect_timeout=10,
-    socket_keepalive=True,
-    socket_keepalive_options={
-        socket.TCP_KEEPIDLE: 30,
-        socket.TCP_KEEPINTVL: 10,
-        socket.TCP_KEEPCNT: 3
-    },
-    retry_on_timeout=True,
-    max_connections=20,
-    health_check_interval=15
-)
-
-# Инициализируем клиент Redis с пулом подключений
-redis_client = redis.Redis(connection_pool=redis_pool, decode_responses=True)
+# Клиент Redis поверх общего пула подключений
+redis_client = get_redis_connection()
 
 # Функция для безопасного выполнения Redis операций
 def safe_redis_operation(operation, *args, max_retries=5, **kwargs):
@@ -87,99 +62,34 @@ db = get_database()
 # Получаем ID основного чата из секретов
 MAIN_CHAT_ID = st.secrets["flowise"]["main_chat_id"]
 
-def save_session_history(username: str, flow_id: str, session_id: str, messages: list, display_name: str = None):
-    """Сохраняет историю сессии в MongoDB и Redis"""
-    try:
-        if not display_name:
-            display_name = f"Сессия {len(get_available_sessions(username, flow_id)) + 1}"
-        
-        # Сохранение в MongoDB
-        db.chat_history.update_one(
-            {
-                "username": username,
-                "flow_id": flow_id,
-                "session_id": session_id
-            },
-            {
-                "$set": {
-                    "messages": messages,
-                    "updated_at": datetime.now()
-                }
-            },
-            upsert=True
-        )
-        
-        db.chat_sessions.update_one(
-            {
-                "username": username,
-                "flow_id": flow_id,
-                "session_id": session_id
-            },
-            {
-                "$set": {
-                    "name": display_name,
-                    "updated_at": datetime.now()
-                },
-                "$setOnInsert": {
-                    "created_at": datetime.now()
-                }
-            },
-            upsert=True
-        )
-
-        # Сохранение в Redis для быстрого доступа
-        redis_key = f"{username}_{flow_id}_{session_id}"
-        safe_redis_operation(
-            redis_client.set,
-            redis_key,
-            json.dumps({
-                "messages": messages,
-                "display_name": display_name,
-                "updated_at": datetime.now().isoformat()
-            }),
-            ex=86400  # Кэш на 24 часа
-        )
-        
-    except Exception as e:
-        print(f"Ошибка при сохранении истории сессии: {str(e)}")
-        st.error("Произошла ошибка при сохранении данных")
+# Потоковый вывод ответов (можно отключить в secrets.toml: flowise.streaming = false)
+STREAMING_ENABLED = st.secrets["flowise"].get("streaming", True)
+
+@db.cache_handler("sessions", ttl=60)
+def load_available_sessions(username: str, flow_id: str = MAIN_CHAT_ID) -> list:
+    """
+    Сессии чата из MongoDB (кэшируется через DatabaseManager.cache_handler).
+    Ошибки пробрасываются, чтобы не попасть в кэш как пустой список.
+    """
+    sessions = list(db.chat_sessions.find(
+        {"username": username, "flow_id": flow_id},
+        {"session_id": 1, "name": 1}
+    ).sort("created_at", 1))
+    
+    result = []
+    for i, session in enumerate(sessions):
+        result.append({
+            'id': session['session_id'],
+            'display_name': "Основная сессия" if i == 0 else session.get('name', f"Сессия {session['session_id'][:8]}"),
+            'is_primary': i == 0
+        })
+    
+    return result
 
-def get_available_sessions(username: str, flow_id: str = None) -> list:
-    """Получение доступных сессий чата с поддержкой кэширования"""
+def get_available_sessions(username: str, flow_id: str = MAIN_CHAT_ID) -> list:
+    """Получение доступных сессий чата"""
     try:
-        flow_id = flow_id or MAIN_CHAT_ID
-        
-        # Пробуем получить из Redis с коротким TTL
-        cache_key = f"sessions_{username}_{flow_id}"
-        cached_data = safe_redis_operation(redis_client.get, cache_key, max_retries=2)
-        
-        if cached_data:
-            return json.loads(cached_data)
-        
-        # Если кэша нет, получаем из MongoDB
-        sessions = list(db.chat_sessions.find({
-            "username": username,
-            "flow_id": flow_id
-        }).sort("created_at", 1))
-        
-        result = []
-        for i, session in enumerate(sessions):
-            result.append({
-                'id': session['session_id'],
-                'display_name': "Основная сессия" if i == 0 else session.get('name', f"Сессия {session['session_id'][:8]}"),
-                'is_primary': i == 0
-            })
-        
-        # Кэшируем результат на короткое время
-        safe_redis_operation(
-            redis_client.set,
-            cache_key,
-            json.dumps(result),
-            ex=60   # Кэш на 1 минуту
-        )
-        
-        return result
-        
+        return load_available_sessions(username, flow_id)
     except Exception as e:
         print(f"Ошибка при получении сессий: {str(e)}")
         return []
@@ -203,8 +113,7 @@ def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
         )
         
         # Инвалидируем кэш сессий
-        cache_key = f"sessions_{username}_{flow_id}"
-        safe_redis_operation(redis_client.delete, cache_key)
+        load_available_sessions.invalidate(username, flow_id)
         
         # Обновляем кэш конкретной сессии
         session_key = f"{username}_{flow_id}_{session_id}"
@@ -240,9 +149,8 @@ def delete_session(username: str, flow_id: str, session_id: str):
         })
         
         # Очищаем кэш
-        cache_key = f"sessions_{username}_{flow_id}"
         session_key = f"{username}_{flow_id}_{session_id}"
-        safe_redis_operation(redis_client.delete, cache_key)
+        load_available_sessions.invalidate(username, flow_id)
         safe_redis_operation(redis_client.delete, session_key)
         
         # Если удалена текущая сессия, переключаемся на другую
@@ -273,6 +181,7 @@ def delete_session(username: str, flow_id: str, session_id: str):
                     "created_at": datetime.now(),
                     "updated_at": datetime.now()
                 })
+                load_available_sessions.invalidate(username, flow_id)
         
         st.success("Сессия успешно удалена")
         time.sleep(1)
@@ -285,35 +194,13 @@ def delete_session(username: str, flow_id: str, session_id: str):
 def clear_session_history(username: str, flow_id: str, session_id: str):
     """Очистка истории сессии с обновлением кэша"""
     try:
-        # Очищаем в MongoDB
-        db.chat_history.update_one(
-            {
-                "username": username,
-                "flow_id": flow_id,
-                "session_id": session_id
-            },
-            {
-                "$set": {
-                    "messages": [],
-                    "updated_at": datetime.now()
-                }
-            },
-            upsert=True
-        )
+        # Сообщения скрываются указателем visible_from_seq, массив сжимается фоновым обслуживанием
+        if not db.clear_chat_history(username, flow_id, session_id):
+            return False
         
-        # Очищаем кэш сессии
+        # Копия сессии в Redis больше не актуальна
         session_key = f"{username}_{flow_id}_{session_id}"
-        session_data = safe_redis_operation(redis_client.get, session_key)
-        if session_data:
-            data = json.loads(session_data)
-            data['messages'] = []
-            data['updated_at'] = datetime.now().isoformat()
-            safe_redis_operation(
-                redis_client.set,
-                session_key,
-                json.dumps(data),
-                ex=86400
-            )
+        safe_redis_operation(redis_client.delete, session_key)
         
         # Принудительно очищаем кэш пользователя
         db.clear_user_cache(username)
@@ -323,10 +210,6 @@ def clear_session_history(username: str, flow_id: str, session_id: str):
         print(f"Ошибка при очистке истории: {str(e)}")
         return False
 
-def get_message_hash(role, content):
-    """Создание хэша сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
-
 def get_user_profile_image(username):
     """Получение изображения профиля пользователя"""
     user_data = db.get_user(username)
@@ -338,7 +221,7 @@ def display_message(message, role):
     """Отображение сообщения в чате"""
     avatar = "🤖" if role == "assistant" else get_user_profile_image(st.session_state.username)
     with st.chat_message(role, avatar=avatar):
-        st.write(message["content"])
+        render_message_body(message, role)
 
 def save_chat_flow(username, flow_id, flow_name=None):
     """Сохранение потока чата"""
@@ -354,6 +237,7 @@ def save_chat_flow(username, flow_id, flow_name=None):
         "created_at": datetime.now(),
         "updated_at": datetime.now()
     })
+    load_available_sessions.invalidate(username, flow_id)
     return session_id
 
 def get_user_chat_flows(username):
@@ -366,8 +250,8 @@ def generate_response(prompt: str, chat_id: str, session_id: str, uploaded_files
         print(f"[DEBUG] Generating response for prompt: {prompt[:100]}...")
         print(f"[DEBUG] Chat ID: {chat_id}, Session ID: {session_id}")
         
-        # Используем base_url из secrets и убираем лишние слеши
-        base_url = st.secrets["flowise"]["api_base_url"].rstrip('/')
+        # Используем base_url из secrets
+        base_url = st.secrets["flowise"]["api_base_url"]
         
         print(f"[DEBUG] Using base URL: {base_url}")
         print(f"[DEBUG] Flow ID: {chat_id}")
@@ -380,27 +264,17 @@ def generate_response(prompt: str, chat_id: str, session_id: str, uploaded_files
             "chat_type": "main_chat"
         }
         
-        # Формируем правильный URL для запроса
-        prediction_url = f"{base_url}/{chat_id}"
-        print(f"[DEBUG] Full URL: {prediction_url}")
-        
-        # Отправляем запрос напрямую через requests
-        response = requests.post(
-            prediction_url,
-            json={
-                "question": prompt,
-                "overrideConfig": {
-                    "sessionId": session_id,
-                    "userMetadata": user_metadata
-                }
-            }
+        # Отправляем запрос через общий транспорт Flowise (пул подключений, таймауты)
+        response_data = create_prediction(
+            base_url,
+            chat_id,
+            prompt,
+            {
+                "sessionId": session_id,
+                "userMetadata": user_metadata
+            },
+            append_path=False
         )
-        
-        # Проверяем статус ответа
-        response.raise_for_status()
-        
-        # Получаем JSON ответ
-        response_data = response.json()
         print(f"[DEBUG] Received response: {str(response_data)[:100]}...")
         
         # Проверяем наличие текста в ответе
@@ -418,8 +292,33 @@ def generate_response(prompt: str, chat_id: str, session_id: str, uploaded_files
     except Exception as e:
         error_msg = f"Ошибка при получении ответа: {str(e)}"
         print(f"[ERROR] {error_msg}")
+        st.session_state._generation_failed = True
         return error_msg
 
+def stream_response(prompt: str, chat_id: str, session_id: str):
+    """Потоковая генерация ответа: фрагменты текста по мере поступления от Flowise"""
+    user_metadata = {
+        "username": st.session_state.username,
+        "session_start": st.session_state.get("session_start", datetime.now().isoformat()),
+        "chat_type": "main_chat"
+    }
+    try:
+        yield from stream_prediction(
+            st.secrets["flowise"]["api_base_url"],
+            chat_id,
+            prompt,
+            {
+                "sessionId": session_id,
+                "userMetadata": user_metadata
+            },
+            append_path=False
+        )
+    except Exception as e:
+        error_msg = f"Ошибка при получении ответа: {str(e)}"
+        print(f"[ERROR] {error_msg}")
+        st.session_state._generation_failed = True
+        yield error_msg
+
 def submit_question():
     if not verify_user_access():
         return
@@ -429,28 +328,27 @@ def submit_question():
         st.warning("Пожалуйста, введите ваш вопрос.")
         return
 
+    # Генерация списывается до запроса к модели одной атомарной операцией
+    reserved, remaining = reserve_generation(st.session_state.username, 1)
+    if not reserved:
+        st.error("Отправка сообщений недоступна, так как у вас нет активного токена с генерациями.")
+        return
+    st.session_state._generation_failed = False
+    completed = False
+
     try:
-        # Получаем текущую историю
-        messages = db.get_chat_history(
-            st.session_state.username,
-            MAIN_CHAT_ID,
-            st.session_state.current_session
-        )
-        
-        # Добавляем сообщение пользователя
+        # Добавляем сообщение пользователя в конец истории
         user_message = {
             "role": "user",
             "content": user_input,
+            "lang": detect_message_language(user_input),
             "timestamp": datetime.now().isoformat()
         }
-        messages.append(user_message)
-        
-        # Сохраняем обновленную историю
-        db.save_chat_history(
+        db.append_chat_messages(
             st.session_state.username,
             MAIN_CHAT_ID,
             st.session_state.current_session,
-            messages
+            [user_message]
         )
         
         # Отображаем сообщение пользователя
@@ -458,37 +356,48 @@ def submit_question():
 
         # Получаем и отображаем ответ
         with st.chat_message("assistant"):
-            response = generate_response(
-                user_input,
-                MAIN_CHAT_ID,
-                st.session_state.current_session
-            )
-            st.write(response)
+            if STREAMING_ENABLED:
+                # Текст выводится по мере генерации, в историю сохраняется один раз в конце
+                response = st.write_stream(stream_response(
+                    user_input,
+                    MAIN_CHAT_ID,
+                    st.session_state.current_session
+                )) or "Получен пустой ответ от API"
+            else:
+                response = generate_response(
+                    user_input,
+                    MAIN_CHAT_ID,
+                    st.session_state.current_session
+                )
+                st.write(response)
             
-            # Добавляем ответ ассистента в историю
+            # Дописываем ответ ассистента в историю
             assistant_message = {
                 "role": "assistant",
                 "content": response,
+                "lang": detect_message_language(response),
                 "timestamp": datetime.now().isoformat()
             }
-            messages.append(assistant_message)
-            
-            # Сохраняем обновленную историю
-            db.save_chat_history(
+            db.append_chat_messages(
                 st.session_state.username,
                 MAIN_CHAT_ID,
                 st.session_state.current_session,
-                messages
+                [assistant_message]
             )
             
-            # Обновляем количество оставшихся генераций
-            db.users.update_one(
-                {"username": st.session_state.username},
-                {"$inc": {"remaining_generations": -1}}
-            )
-            st.rerun()
+            if st.session_state._generation_failed:
+                # Ответ не получен: возвращаем списанную генерацию
+                refund_generation(st.session_state.username, 1)
+            else:
+                complete_generation(st.session_state.username, remaining)
+                record_generation(st.session_state.username, MAIN_CHAT_ID)
+            completed = True
+            # Перезапускаем только область чата, а не всю страницу
+            st.rerun(scope="fragment")
 
     except Exception as e:
+        if not completed:
+            refund_generation(st.session_state.username, 1)
         st.error(f"Ошибка: {str(e)}")
 
 def encode_file_to_base64(file_content: bytes) -> str:
@@ -520,11 +429,7 @@ user = db.get_user(st.session_state.username)
 st.title(f"{PAGE_CONFIG['app']['icon']} {PAGE_CONFIG['app']['name']}")
 
 # Отображение оставшихся генераций
-user_data = db.get_user(st.session_state.username)
-if user_data and user_data.get('active_token'):
-    remaining_generations = user_data.get('remaining_generations', 0)
-else:
-    remaining_generations = 0
+remaining_generations = get_remaining(st.session_state.username)
 
 st.sidebar.metric("Осталось генераций:", remaining_generations)
 
@@ -625,11 +530,7 @@ with st.expander("🎯 Управление сессиями", expanded=False):
                 st.session_state.current_flow = MAIN_CHAT_ID
                 
                 # Инвалидируем кэш сессий
-                cache_key = f"sessions_{st.session_state.username}_{MAIN_CHAT_ID}"
-                try:
-                    redis_client.delete(cache_key)
-                except Exception as e:
-                    print(f"Ошибка при очистке кэша: {e}")
+                load_available_sessions.invalidate(st.session_state.username, MAIN_CHAT_ID)
                 
                 st.success("Новая сессия создана")
                 time.sleep(1)
@@ -666,73 +567,45 @@ with st.expander("🎯 Управление сессиями", expanded=False):
 
 st.markdown("---")
 
-# Отображение истории чата
-if "current_session" in st.session_state:
-    # Добавляем пагинацию для истории сообщений
-    if 'messages_page' not in st.session_state:
-        st.session_state.messages_page = 0
-    
-    MESSAGES_PER_PAGE = 50
-    
-    # Получаем общее количество сообщений
-    total_messages = db.chat_history.count_documents({
-        "username": st.session_state.username,
-        "flow_id": MAIN_CHAT_ID,
-        "session_id": st.session_state.current_session
-    })
-    
-    total_pages = (total_messages + MESSAGES_PER_PAGE - 1) // MESSAGES_PER_PAGE
-    
-    if total_pages > 1:
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            page = st.select_slider(
-                "История сообщений",
-                options=range(total_pages),
-                value=st.session_state.messages_page,
-                format_func=lambda x: f"Страница {x + 1} из {total_pages}"
+@st.fragment
+def chat_area():
+    """
+    История и поле ввода чата. Отправка сообщения и подгрузка ранних сообщений перезапускают
+    только этот фрагмент, остальная страница (сессии, боковая панель) не выполняется заново.
+    """
+    with timed("app:chat_fragment"):
+        # Отображение истории чата: окно последних сообщений, ранние подгружаются по кнопке
+        if "current_session" in st.session_state:
+            session_id = st.session_state.current_session
+            render_transcript(
+                f"{MAIN_CHAT_ID}_{session_id}",
+                lambda count: db.get_chat_history_page(
+                    st.session_state.username, MAIN_CHAT_ID, session_id, page=0, page_size=count
+                ),
+                lambda message: display_message(message, message["role"])
             )
-            if page != st.session_state.messages_page:
-                st.session_state.messages_page = page
-                st.rerun()
-    
-    # Получаем сообщения для текущей страницы
-    messages = list(db.chat_history.find(
-        {
-            "username": st.session_state.username,
-            "flow_id": MAIN_CHAT_ID,
-            "session_id": st.session_state.current_session
-        }
-    ).sort("timestamp", -1)
-     .skip(st.session_state.messages_page * MESSAGES_PER_PAGE)
-     .limit(MESSAGES_PER_PAGE))
-    
-    # Отображаем сообщения в обратном порядке (от новых к старым)
-    for message in reversed(messages):
-        if isinstance(message, dict) and "role" in message and "content" in message:
-            display_message(message, message["role"])
-        else:
-            print(f"Пропущено некорректное сообщение: {message}")
-
-# Поле ввода сообщения
-user_input = st.text_area(
-    "Введите ваше сообщение",
-    height=100,
-    key="message_input",
-    placeholder="Введите текст сообщения здесь..."
-)
 
-col1, col2, col3 = st.columns(3)
-with col1:
-    send_button = st.button("Отправить", use_container_width=True, key="send_message_button")
-with col2:
-    clear_button = st.button("Очистить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="clear_message_button")
-with col3:
-    cancel_button = st.button("Отменить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="cancel_message_button")
-
-# Если нет токена, отправка сообщения блокируется
-if send_button and user_input and user_input.strip():
-    if remaining_generations <= 0:
-        st.error("Отправка сообщений недоступна, так как у вас нет активного токена с генерациями.")
-    else:
-        submit_question()
+        # Поле ввода сообщения
+        user_input = st.text_area(
+            "Введите ваше сообщение",
+            height=100,
+            key="message_input",
+            placeholder="Введите текст сообщения здесь..."
+        )
+
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            send_button = st.button("Отправить", use_container_width=True, key="send_message_button")
+        with col2:
+            clear_button = st.button("Очистить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="clear_message_button")
+        with col3:
+            cancel_button = st.button("Отменить", on_click=lambda: setattr(st.session_state, 'message_input', ''), use_container_width=True, key="cancel_message_button")
+
+        # Если нет токена, отправка сообщения блокируется
+        if send_button and user_input and user_input.strip():
+            # Наличие генераций проверяется при списании в submit_question
+            submit_question()
+
+chat_area()
+
+record_timing("app:script", time.perf_counter() - _script_started)
@@ -2,6 +2,8 @@ import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
 from utils.page_config import PAGE_CONFIG, setup_pages
 from utils.database.database_manager import get_database
+from utils.quota import set_balance
+from utils.token_registry import is_token_deactivated, token_generations
 import os
 import json
 from datetime import datetime
@@ -39,6 +41,14 @@ st.title("Ввод токена")
 # Поле для ввода токена
 access_token = st.text_input("Вставьте токен доступа (например: b99176c5-8bca-4be9-b066-894e4103f32c)")
 
+@db.cache_handler("token", ttl=60)
+def find_token(token: str):
+    """Поиск токена (кэшируется, неизвестные токены тоже запоминаются на короткое время)"""
+    return db.access_tokens.find_one(
+        {"token": token},
+        {"_id": 0, "token": 1, "used": 1, "total_generations": 1, "generations": 1}
+    )
+
 def verify_token(token: str, username: str) -> tuple[bool, str]:
     """Проверка и активация токена"""
     # Получаем данные пользователя
@@ -47,13 +57,16 @@ def verify_token(token: str, username: str) -> tuple[bool, str]:
         return False, "Пользователь не найден"
     
     # Проверка существования и использования токена
-    token_data = db.access_tokens.find_one({"token": token})
+    token_data = find_token(token)
     if not token_data:
         return False, "Недействительный токен"
     
     if token_data.get("used", False):
         return False, "Токен уже использован"
     
+    if is_token_deactivated(token):
+        return False, "Токен был деактивирован"
+    
     # Проверка использования токена другим пользователем
     existing_user = db.users.find_one({"active_token": token})
     if existing_user and existing_user['username'] != username:
@@ -61,17 +74,21 @@ def verify_token(token: str, username: str) -> tuple[bool, str]:
     
     # Активируем токен
     try:
-        # Обновляем статус токена
-        db.access_tokens.update_one(
-            {"token": token},
+        # Обновляем статус токена; условие на used защищает от устаревшей записи в кэше
+        activated = db.access_tokens.find_one_and_update(
+            {"token": token, "used": {"$ne": True}},
             {
                 "$set": {
                     "used": True,
                     "activated_at": datetime.now(),
                     "activated_by": username
                 }
-            }
+            },
+            projection={"_id": 1}
         )
+        find_token.invalidate(token)
+        if not activated:
+            return False, "Токен уже использован"
         
         # Обновляем данные пользователя
         db.users.update_one(
@@ -79,12 +96,16 @@ def verify_token(token: str, username: str) -> tuple[bool, str]:
             {
                 "$set": {
                     "active_token": token,
-                    "remaining_generations": token_data["generations"],
+                    "remaining_generations": token_generations(token_data),
                     "token_activated_at": datetime.now()
                 }
             }
         )
         
+        # Новый остаток сразу попадает в счетчик квоты, кэш пользователя сбрасываем (сменился токен)
+        set_balance(username, token_generations(token_data))
+        db.invalidate_user(username)
+        
         return True, "Токен успешно активирован"
     except Exception as e:
         print(f"Ошибка при активации токена: {e}")
@@ -1,22 +1,22 @@
 import streamlit as st
-import requests
 import json
 import os
 from PIL import Image
-import hashlib
-from utils.utils import verify_user_access, update_remaining_generations, get_data_file_path
-from googletrans import Translator
+from utils.utils import verify_user_access, reserve_generation, complete_generation, get_data_file_path
 from datetime import datetime
 from utils.page_config import setup_pages
 import time
-from utils.translation import translate_text, display_message_with_translation
-from flowise import Flowise, PredictionData
+from utils.perf import record_timing, timed
+from utils.translation import translate_text, display_message_with_translation, detect_message_language
+from utils.transcript import render_transcript, render_message_body
+from utils.flowise_client import create_prediction, stream_prediction
 import uuid
 from langdetect import detect
-from pymongo import MongoClient
-from redis import Redis, ConnectionPool
 import redis.exceptions
-import socket
+from utils.database.connections import get_mongo_client, get_redis_connection
+from utils import session_store
+from utils.quota import get_remaining, refund_generation
+from utils.usage import record_generation
 
 # Настройка страницы
 st.set_page_config(
@@ -26,6 +26,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Начало выполнения скрипта страницы (для замера полного перезапуска)
+_script_started = time.perf_counter()
+
 # Настройка страниц
 setup_pages()
 
@@ -42,8 +45,8 @@ if "flowise" not in st.secrets or "base_url" not in st.secrets["flowise"]:
 # Получаем базовый URL и очищаем его от /api/v1/prediction
 base_url = st.secrets["flowise"]["base_url"].replace('/api/v1/prediction', '')
 
-# Создаем клиент Flowise
-flowise_client = Flowise(base_url=base_url)
+# Потоковый вывод ответов (можно отключить в secrets.toml: flowise.streaming = false)
+STREAMING_ENABLED = st.secrets["flowise"].get("streaming", True)
 
 # Инициализируем уникальный идентификатор сессии для пользователя
 if "session_id" not in st.session_state:
@@ -59,36 +62,11 @@ HISTORY_DIR = os.path.join(os.path.dirname(__file__), '..', 'chat_history')
 if not os.path.exists(HISTORY_DIR):
     os.makedirs(HISTORY_DIR)
 
-# Инициализация MongoDB с аутентификацией
-mongo_uri = (
-    f"mongodb://{st.secrets['mongodb']['username']}:{st.secrets['mongodb']['password']}"
-    f"@fra1.clusters.zeabur.com:31735/{st.secrets['mongodb']['database']}"
-    "?authSource=admin&authMechanism=SCRAM-SHA-1"
-)
-mongo_client = MongoClient(mongo_uri)
+# Подключения к MongoDB и Redis берем из общего реестра процесса
+mongo_client = get_mongo_client()
 user_db = mongo_client[st.secrets["mongodb"]["database"]]["users"]
 
-# Создаем пул подключений с более надежными настройками
-redis_pool = ConnectionPool(
-    host=st.secrets["redis"]["host"],
-    port=st.secrets["redis"]["port"],
-    password=st.secrets["redis"]["password"],
-    db=0,
-    socket_timeout=10,
-    socket_connect_timeout=10,
-    socket_keepalive=True,
-    socket_keepalive_options={
-        socket.TCP_KEEPIDLE: 30,
-        socket.TCP_KEEPINTVL: 10,
-        socket.TCP_KEEPCNT: 3
-    },
-    retry_on_timeout=True,
-    max_connections=20,
-    health_check_interval=15
-)
-
-# Инициализируем клиент Redis с пулом подключений
-redis_client = Redis(connection_pool=redis_pool, decode_responses=True)
+redis_client = get_redis_connection()
 
 # Функция для безопасного выполнения Redis операций с улучшенной обработкой ошибок
 def safe_redis_operation(operation, *args, **kwargs):
@@ -117,7 +95,7 @@ def safe_redis_operation(operation, *args, **kwargs):
                 # Пробуем создать новое подключение
                 try:
                     redis_client.connection_pool.reset()
-                    new_client = Redis(connection_pool=redis_pool, decode_responses=True)
+                    new_client = get_redis_connection()
                     if new_client.ping():
                         redis_client = new_client  # Теперь можно использовать без global
                         return operation(*args, **kwargs)
@@ -132,122 +110,45 @@ def safe_redis_operation(operation, *args, **kwargs):
 
 def get_session_display_name(username: str, flow_id: str, session_id: str) -> str:
     """Получает отображаемое имя сессии"""
-    history_file = os.path.join(HISTORY_DIR, f"{username}_{flow_id}_{session_id}.json")
     try:
-        with open(history_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            if isinstance(data, dict) and 'display_name' in data:
-                return data['display_name']
-    except:
-        pass
-    return f"Сессия {session_id}"
+        return session_store.get_display_name(username, flow_id, session_id)
+    except Exception as e:
+        print(f"Ошибка получения имени сессии: {e}")
+        return f"Сессия {session_id}"
 
 def save_session_history(username, flow_id, session_id, messages, display_name=None):
-    """Сохраняет историю сессии в файл"""
-    key = f"{username}_{flow_id}_{session_id}"
-    data = {
-        'messages': messages,
-        'display_name': display_name or f"Сессия {len(get_available_sessions(username, flow_id)) + 1}"
-    }
-    safe_redis_operation(redis_client.set, key, json.dumps(data))
+    """Полностью перезаписывает историю сессии и регистрирует сессию в индексе"""
+    safe_redis_operation(session_store.replace_messages, username, flow_id, session_id, messages, display_name)
+
+def append_session_messages(username, flow_id, session_id, messages):
+    """Добавляет сообщения в конец истории сессии (возвращает сообщения с id и seq)"""
+    return safe_redis_operation(session_store.append_messages, username, flow_id, session_id, messages)
 
 def load_session_history(username, flow_id, session_id):
-    """Загружает историю сессии из файла"""
-    key = f"{username}_{flow_id}_{session_id}"
-    data = safe_redis_operation(redis_client.get, key)
-    if data:
-        return json.loads(data).get('messages', [])
-    return []
+    """Загружает историю сессии"""
+    return safe_redis_operation(session_store.load_messages, username, flow_id, session_id) or []
+
+def load_recent_session_messages(username, flow_id, session_id, count):
+    """Загружает последние count сообщений сессии и общее количество сообщений"""
+    return safe_redis_operation(session_store.load_recent_messages, username, flow_id, session_id, count)
 
 def get_available_sessions(username, flow_id):
-    """Получает список доступных сессий для чата"""
-    prefix = f"{username}_{flow_id}_"
-    cache_key = f"available_sessions_{prefix}"
-    
-    # Пробуем получить из кэша
+    """Получает список доступных сессий для чата по индексу сессий"""
     try:
-        cached_data = redis_client.get(cache_key)
-    except Exception as e:
-        print(f"Ошибка получения кэша: {e}")
-        cached_data = None
-        
-    if cached_data:
-        return json.loads(cached_data)
-    
-    sessions = []
-    try:
-        for key in safe_redis_operation(redis_client.scan_iter, f"{prefix}*"):
-            session_id = key.decode().split('_')[-1]
-            try:
-                data = redis_client.get(key)
-                if data:
-                    data = json.loads(data)
-            except Exception as e:
-                print(f"Ошибка получения данных сессии: {e}")
-                continue
-            sessions.append({
-                'id': session_id,
-                'display_name': data.get('display_name', f"Сессия {len(sessions) + 1}"),
-                'created_at': data.get('created_at', datetime.now().isoformat())
-            })
-        
-        # Сортируем сессии по дате создания
-        sessions = sorted(sessions, key=lambda x: x.get('created_at', ''))
-        
-        # Помечаем первую сессию как основную
-        if sessions:
-            sessions[0]['display_name'] = "Основная сессия"
-            sessions[0]['is_primary'] = True
-            for session in sessions[1:]:
-                session['is_primary'] = False
-        
-        # Кэшируем результат на короткое время
-        try:
-            redis_client.set(
-                cache_key,
-                json.dumps(sessions),
-                ex=60  # Кэш на 1 минуту
-            )
-        except Exception as e:
-            print(f"Ошибка кэширования сессий: {e}")
+        return safe_redis_operation(session_store.list_sessions, username, flow_id)
     except Exception as e:
         print(f"Ошибка при получении списка сессий: {e}")
         return []
-    return sessions
 
 def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
     """Переименовывает сессию"""
     try:
-        key = f"{username}_{flow_id}_{session_id}"
-        cache_key = f"available_sessions_{username}_{flow_id}_"
+        safe_redis_operation(session_store.rename_session, username, flow_id, session_id, new_name)
         
-        data = safe_redis_operation(redis_client.get, key)
-        if data:
-            data = json.loads(data)
-            messages = data.get('messages', [])
-            
-            # Обновляем данные сессии с новым именем
-            session_data = {
-                'messages': messages,
-                'display_name': new_name,
-                'updated_at': datetime.now().isoformat()
-            }
-            
-            # Сохраняем обновленные данные
-            safe_redis_operation(
-                redis_client.set,
-                key,
-                json.dumps(session_data),
-                ex=86400  # TTL 24 часа
-            )
-            
-            # Инвалидируем кэш списка сессий
-            safe_redis_operation(redis_client.delete, cache_key)
-            
-            st.success(f"Сессия успешно переименована в '{new_name}'")
-            time.sleep(1)
-            st.rerun()
-            return True
+        st.success(f"Сессия успешно переименована в '{new_name}'")
+        time.sleep(1)
+        st.rerun()
+        return True
     except Exception as e:
         print(f"Ошибка при переименовании сессии: {e}")
         st.error(f"Ошибка при переименовании сессии: {e}")
@@ -256,15 +157,8 @@ def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
 def delete_session(username: str, flow_id: str, session_id: str):
     """Удаляет сессию полностью"""
     try:
-        key = f"{username}_{flow_id}_{session_id}"
-        cache_key = f"available_sessions_{username}_{flow_id}_"
-        
-        if safe_redis_operation(redis_client.exists, key):
-            # Удаляем сессию из Redis
-            safe_redis_operation(redis_client.delete, key)
-            # Инвалидируем кэш списка сессий
-            safe_redis_operation(redis_client.delete, cache_key)
-            print(f"Удалена сессия: {key}")
+        if safe_redis_operation(session_store.delete_session, username, flow_id, session_id):
+            print(f"Удалена сессия: {username}_{flow_id}_{session_id}")
             
             # Если удалена текущая сессия, переключаемся на первую доступную
             if ('current_chat_flow' in st.session_state and 
@@ -293,8 +187,8 @@ def delete_session(username: str, flow_id: str, session_id: str):
 def clear_session_history(username: str, flow_id: str, session_id: str):
     """Очищает историю конкретной сессии"""
     try:
-        # Очищаем файл истории
-        save_session_history(username, flow_id, session_id, [], get_session_display_name(username, flow_id, session_id))
+        # Сообщения скрываются указателем, список сжимается фоновым обслуживанием
+        safe_redis_operation(session_store.clear_messages, username, flow_id, session_id)
         
         # Очищаем состояние сообщений в текущей сессии
         st.session_state.messages = []
@@ -304,25 +198,11 @@ def clear_session_history(username: str, flow_id: str, session_id: str):
     except Exception as e:
         print(f"Ошибка при очистке истории: {e}")
 
-def delete_message_from_session(username: str, flow_id: str, session_id: str, message_hash: str):
-    """Удаляет конкретное сообщение из истории сессии"""
+def delete_message_from_session(username: str, flow_id: str, session_id: str, message: dict):
+    """Удаляет конкретное сообщение из истории сессии по его id"""
     try:
-        # Загружаем текущие сообщения
-        messages = load_session_history(username, flow_id, session_id)
-        
-        # Фильтруем сообщения, исключая сообщение с указанным хэшем
-        updated_messages = [
-            msg for msg in messages 
-            if get_message_hash(msg["role"], msg["content"]) != message_hash
-        ]
-        
-        # Сохраняем обновленную историю
-        save_session_history(username, flow_id, session_id, updated_messages, get_session_display_name(username, flow_id, session_id))
-        
-        # Обновляем состояние сообщений в текущей сессии
-        st.session_state.messages = updated_messages
-        
-        print(f"Удалено сообщение из сессии: {username}_{flow_id}_{session_id}")
+        if safe_redis_operation(session_store.delete_message, username, flow_id, session_id, message):
+            print(f"Удалено сообщение {message.get('id')} из сессии: {username}_{flow_id}_{session_id}")
         st.rerun()
     except Exception as e:
         print(f"Ошибка при удалении сообщения: {e}")
@@ -340,10 +220,6 @@ if os.path.exists(ASSISTANT_ICON_PATH):
 else:
     assistant_avatar = "🤖"
 
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
-
 def get_user_profile_image(username):
     for ext in ['png', 'jpg', 'jpeg']:
         image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
@@ -359,7 +235,7 @@ def display_message(message, role):
     avatar = assistant_avatar if role == "assistant" else get_user_profile_image(st.session_state.username)
     
     with st.chat_message(role, avatar=avatar):
-        st.markdown(message["content"])
+        render_message_body(message, role)
 
 # Функция для сохранения нового чат-потока
 def save_chat_flow(username, flow_id, flow_name=None):
@@ -421,16 +297,14 @@ def delete_chat_flow(username, flow_id):
 st.title("Личный помощник")
 
 # Отображение оставшихся генераций
-user = user_db.find_one({"username": st.session_state.username})
-if user:
-    remaining_generations = user.get('remaining_generations', 0)
-    st.sidebar.metric("Осталось генераций:", remaining_generations)
-    
-    # Определяем возможность отправки сообщений
-    can_send_messages = remaining_generations > 0
-    
-    if remaining_generations <= 0:
-        st.sidebar.error("У вас закончились генераций. Вы не можете отправлять и получать сообщения. Пожалуйста, активируйте новый токен, купить новый можно в https://startintellect.ru/products")
+remaining_generations = get_remaining(st.session_state.username)
+st.sidebar.metric("Осталось генераций:", remaining_generations)
+
+# Определяем возможность отправки сообщений
+can_send_messages = remaining_generations > 0
+
+if remaining_generations <= 0:
+    st.sidebar.error("У вас закончились генераций. Вы не можете отправлять и получать сообщения. Пожалуйста, активируйте новый токен, купить новый можно в https://startintellect.ru/products")
 
 # Управление чат-потоками в боковой панели
 st.sidebar.title("Управление чат-потоками")
@@ -558,8 +432,7 @@ if 'current_chat_flow' in st.session_state:
                 st.session_state.username,
                 st.session_state.current_chat_flow['id'],
                 st.session_state.current_chat_flow['current_session'],
-                [],
-                get_session_display_name(st.session_state.username, st.session_state.current_chat_flow['id'], st.session_state.current_chat_flow['current_session'])
+                []
             )
         
         # Отображаем доступные сессии и кнопки управления
@@ -626,36 +499,17 @@ if 'current_chat_flow' in st.session_state:
                     new_session_id = str(uuid.uuid4())
                     current_flow_id = st.session_state.current_chat_flow['id']
                     
-                    # Получаем список существующих сессий
-                    existing_sessions = get_available_sessions(
-                        st.session_state.username,
-                        current_flow_id
-                    )
-                    new_session_number = len(existing_sessions) + 1
                     session_name = f"Сессия {datetime.now().strftime('%Y-%m-%d %H:%M')}"
                     
-                    # Сохраняем данные сессии в Redis
-                    session_data = {
-                        'messages': [],
-                        'display_name': session_name,
-                        'created_at': datetime.now().isoformat(),
-                        'updated_at': datetime.now().isoformat()
-                    }
-                    
-                    session_key = f"{st.session_state.username}_{current_flow_id}_{new_session_id}"
-                    redis_client.set(
-                        session_key,
-                        json.dumps(session_data),
-                        ex=86400  # TTL 24 часа
+                    # Сохраняем пустую сессию и добавляем ее в индекс
+                    save_session_history(
+                        st.session_state.username,
+                        current_flow_id,
+                        new_session_id,
+                        [],
+                        session_name
                     )
                     
-                    # Инвалидируем кэш списка сессий
-                    cache_key = f"available_sessions_{st.session_state.username}_{current_flow_id}_"
-                    try:
-                        redis_client.delete(cache_key)
-                    except Exception as e:
-                        print(f"Ошибка очистки кэша: {e}")
-                    
                     # Обновляем состояние
                     st.session_state.current_chat_flow['current_session'] = new_session_id
                     
@@ -691,42 +545,6 @@ if 'current_chat_flow' in st.session_state:
         
     st.markdown("---")
 
-    # Загружаем историю текущей сессии
-    session_messages = load_session_history(
-        st.session_state.username,
-        st.session_state.current_chat_flow['id'],
-        st.session_state.current_chat_flow['current_session']
-    )
-    
-    # Добавляем пагинацию для сообщений
-    if 'messages_page' not in st.session_state:
-        st.session_state.messages_page = 0
-    
-    MESSAGES_PER_PAGE = 50
-    total_messages = len(session_messages)
-    total_pages = (total_messages + MESSAGES_PER_PAGE - 1) // MESSAGES_PER_PAGE
-    
-    if total_pages > 1:
-        col1, col2, col3 = st.columns([1, 2, 1])
-        with col2:
-            page = st.select_slider(
-                "История сообщений",
-                options=range(total_pages),
-                value=st.session_state.messages_page,
-                format_func=lambda x: f"Страница {x + 1} из {total_pages}"
-            )
-            if page != st.session_state.messages_page:
-                st.session_state.messages_page = page
-                st.rerun()
-    
-    # Получаем сообщения для текущей страницы
-    start_idx = st.session_state.messages_page * MESSAGES_PER_PAGE
-    end_idx = min(start_idx + MESSAGES_PER_PAGE, total_messages)
-    page_messages = session_messages[start_idx:end_idx]
-    
-    # Отображаем сообщения текущей страницы
-    for message in page_messages:
-        display_message(message, message["role"])
 
 # Функция отправки сообщения
 def display_timer():
@@ -759,27 +577,59 @@ def display_timer():
             break
     placeholder.empty()
 
-def generate_response(prompt: str, chat_id: str, session_id: str):
-    """Генерирует ответ от Flowise"""
+def translate_if_english(text_response: str) -> str:
+    """Переводит ответ на русский, если он на английском"""
+    print(f"Исходный текст для перевода: {text_response[:100]}...")  # Показываем первые 100 символов
     try:
-        print('Начало генерации ответа')
+        # Определяем язык текста
+        detected_lang = detect(text_response)
+        print(f"Определен язык ответа: {detected_lang}")
         
-        # Формируем данные для запроса
-        prediction_data = PredictionData(
-            chatflowId=chat_id,
-            question=prompt,
-            streaming=False,
-            overrideConfig={
+        # Если текст на английском, переводим на русский через память переводов
+        if detected_lang == 'en':
+            print("Начинаем перевод на русский...")
+            return translate_text(text_response, 'ru', source_lang=detected_lang)
+        else:
+            print(f"Перевод не требуется, текст уже на языке: {detected_lang}")
+            return text_response
+    except Exception as e:
+        print(f"Ошибка при переводе: {str(e)}")
+        return text_response
+
+def stream_response(prompt: str, chat_id: str, session_id: str):
+    """Потоковая генерация ответа: фрагменты текста по мере поступления от Flowise"""
+    try:
+        yield from stream_prediction(
+            base_url,
+            chat_id,
+            prompt,
+            {
                 "sessionId": f"{st.session_state.username}_{chat_id}_{session_id}",
                 "modelName": "gpt-3.5-turbo"
             }
         )
+    except Exception as e:
+        print(f"Ошибка при потоковом получении ответа: {str(e)}")
+        st.session_state._generation_failed = True
+        yield f"Ошибка при получении ответа: {str(e)}"
+
+def generate_response(prompt: str, chat_id: str, session_id: str):
+    """Генерирует ответ от Flowise"""
+    try:
+        print('Начало генерации ответа')
         
         try:
             print("Отправка запроса к API...")
-            prediction = flowise_client.create_prediction(prediction_data)
+            response = create_prediction(
+                base_url,
+                chat_id,
+                prompt,
+                {
+                    "sessionId": f"{st.session_state.username}_{chat_id}_{session_id}",
+                    "modelName": "gpt-3.5-turbo"
+                }
+            )
             print("Получение ответа от API...")
-            response = next(prediction)
             print(f"Тип полученного ответа: {type(response)}")
             print(f"Содержимое ответа: {response}")
             
@@ -809,41 +659,22 @@ def generate_response(prompt: str, chat_id: str, session_id: str):
                 text_response = str(response) if response else "Получен пустой ответ от API"
 
             if text_response:
-                print(f"Исходный текст для перевода: {text_response[:100]}...")  # Показываем первые 100 символов
-                try:
-                    # Определяем язык текста
-                    detected_lang = detect(text_response)
-                    print(f"Определен язык ответа: {detected_lang}")
-                    
-                    # Если текст на английском, переводим на русский
-                    if detected_lang == 'en':
-                        print("Начинаем перевод на русский...")
-                        translator = Translator()
-                        translated = translator.translate(text_response, dest='ru')
-                        if translated and translated.text:
-                            print("Перевод успешно выполнен")
-                            return translated.text
-                        else:
-                            print("Ошибка: перевод вернул пустой результат")
-                            return text_response
-                    else:
-                        print(f"Перевод не требуется, текст уже на языке: {detected_lang}")
-                        return text_response
-                except Exception as e:
-                    print(f"Ошибка при переводе: {str(e)}")
-                    return text_response
+                return translate_if_english(text_response)
             
             print("Не удалось получить текст для ответа")
+            st.session_state._generation_failed = True
             return "Не удалось получить ответ в ожидаемом формате. Пожалуйста, попробуйте еще раз."
                     
         except Exception as e:
             print(f"Ошибка при получении ответа от API: {str(e)}")
+            st.session_state._generation_failed = True
             if "Unknown model" in str(e):
                 return "Ошибка конфигурации модели. Пожалуйста, проверьте настройки чата."
             return f"Ошибка при получении ответа: {str(e)}"
             
     except Exception as e:
         print(f"Общая ошибка в generate_response: {str(e)}")
+        st.session_state._generation_failed = True
         return f"Произошла ошибка: {str(e)}"
 
 def submit_message(user_input):
@@ -851,31 +682,30 @@ def submit_message(user_input):
         st.warning("Пожалуйста, введите сообщение")
         return
 
+    # Генерация списывается до запроса к модели одной атомарной операцией
+    reserved, remaining = reserve_generation(st.session_state.username, 1)
+    if not reserved:
+        st.error("Отправка сообщений недоступна. Пожалуйста, активируйте новый токен.")
+        return
+    st.session_state._generation_failed = False
+    completed = False
+
     try:
         print("Начало обработки сообщения")
         
-        # Получаем текущую сессию и историю
+        # Получаем текущую сессию
         current_session_id = st.session_state.current_chat_flow['current_session']
         print(f"Текущая сессия: {current_session_id}")
         
-        session_messages = load_session_history(
-            st.session_state.username,
-            st.session_state.current_chat_flow['id'],
-            current_session_id
-        )
-        print("История сессии загружена")
-
-        # Добавляем сообщение пользователя
-        user_message = {"role": "user", "content": user_input}
-        session_messages.append(user_message)
+        # Добавляем сообщение пользователя в конец истории
+        user_message = {"role": "user", "content": user_input, "lang": detect_message_language(user_input)}
         
         try:
-            save_session_history(
+            append_session_messages(
                 st.session_state.username,
                 st.session_state.current_chat_flow['id'],
                 current_session_id,
-                session_messages,
-                get_session_display_name(st.session_state.username, st.session_state.current_chat_flow['id'], current_session_id)
+                [user_message]
             )
             print("Сообщение пользователя сохранено")
         except Exception as save_error:
@@ -886,41 +716,60 @@ def submit_message(user_input):
         # Получаем и отображаем ответ
         with st.chat_message("assistant", avatar=assistant_avatar):
             print("Запрос ответа от API...")
-            response = generate_response(
-                user_input,
-                st.session_state.current_chat_flow['id'],
-                current_session_id
-            )
+            if STREAMING_ENABLED:
+                # Выводим текст по мере генерации, затем при необходимости заменяем переводом
+                response_placeholder = st.empty()
+                with response_placeholder:
+                    streamed = st.write_stream(stream_response(
+                        user_input,
+                        st.session_state.current_chat_flow['id'],
+                        current_session_id
+                    ))
+                response = translate_if_english(streamed) if streamed else "Получен пустой ответ от API"
+                if response != streamed:
+                    response_placeholder.markdown(response)
+            else:
+                response = generate_response(
+                    user_input,
+                    st.session_state.current_chat_flow['id'],
+                    current_session_id
+                )
+                # Отображаем ответ
+                st.write(response)
             print(f"Получен ответ от API: {response}")
             
-            # Отображаем ответ
-            st.write(response)
-            
-            # Сохраняем ответ в историю сессии
-            assistant_message = {"role": "assistant", "content": response}
-            session_messages.append(assistant_message)
+            # Дописываем ответ в историю сессии
+            assistant_message = {"role": "assistant", "content": response, "lang": detect_message_language(response)}
             
             try:
-                save_session_history(
+                append_session_messages(
                     st.session_state.username,
                     st.session_state.current_chat_flow['id'],
                     current_session_id,
-                    session_messages,
-                    get_session_display_name(st.session_state.username, st.session_state.current_chat_flow['id'], current_session_id)
+                    [assistant_message]
                 )
                 print("Ответ сохранен в истории")
             except Exception as save_error:
                 print(f"Ошибка при сохранении ответа: {str(save_error)}")
             
             try:
-                update_remaining_generations(st.session_state.username, -1)
+                if st.session_state._generation_failed:
+                    # Ответ не получен: возвращаем списанную генерацию
+                    refund_generation(st.session_state.username, 1)
+                else:
+                    complete_generation(st.session_state.username, remaining)
+                    record_generation(st.session_state.username, st.session_state.current_chat_flow['id'])
                 print("Счетчик генераций обновлен")
             except Exception as update_error:
                 print(f"Ошибка при обновлении счетчика: {str(update_error)}")
+            completed = True
             
-            st.rerun()
+            # Перезапускаем только область чата, а не всю страницу
+            st.rerun(scope="fragment")
 
     except Exception as e:
+        if not completed:
+            refund_generation(st.session_state.username, 1)
         error_msg = f"Общая ошибка при обработке сообщения: {str(e)}"
         print(error_msg)
         st.error(error_msg)
@@ -932,30 +781,52 @@ def clear_input():
     # Используем callback для очистки
     st.session_state.message_input = ""
 
-# Поле ввода с возможностью растягивания
-user_input = st.text_area(
-    "Введите ваше сообщение",
-    height=100,
-    key="message_input",
-    placeholder="Введите текст сообщения здесь..."  
-)
+@st.fragment
+def chat_area():
+    """
+    История и поле ввода чата. Отправка сообщения и подгрузка ранних сообщений перезапускают
+    только этот фрагмент, выбор чата и сессии в остальной части страницы не выполняется заново.
+    """
+    with timed("new_chat:chat_fragment"):
+        if 'current_chat_flow' in st.session_state:
+            # Окно последних сообщений текущей сессии, ранние подгружаются по кнопке
+            flow_id = st.session_state.current_chat_flow['id']
+            session_id = st.session_state.current_chat_flow['current_session']
+            render_transcript(
+                f"{flow_id}_{session_id}",
+                lambda count: load_recent_session_messages(
+                    st.session_state.username, flow_id, session_id, count
+                ),
+                lambda message: display_message(message, message["role"])
+            )
 
-# Создаем три колонки для кнопок
-col1, col2, col3 = st.columns(3)
-    
-with col1:
-    send_button = st.button("Отправить", key="send_message", use_container_width=True)
-with col2:
-    # Используем on_click для очистки
-    clear_button = st.button("Очистить", key="clear_input", on_click=clear_input, use_container_width=True)
-with col3:
-    # Для кнопки отмены используем тот же callback
-    cancel_button = st.button("Отменить", key="cancel_request", on_click=clear_input, use_container_width=True)
-
-# Изменяем логику отправки сообщения
-if send_button:  # Отправляем только при явном нажатии кнопки
-    if not can_send_messages:
-        st.error("Отправка сообщений недоступна. Пожалуйста, активируйте новый токен.")
-    elif user_input and user_input.strip():
-        st.session_state['_last_input'] = user_input
-        submit_message(user_input)
\ No newline at end of file
+        # Поле ввода с возможностью растягивания
+        user_input = st.text_area(
+            "Введите ваше сообщение",
+            height=100,
+            key="message_input",
+            placeholder="Введите текст сообщения здесь..."  
+        )
+
+        # Создаем три колонки для кнопок
+        col1, col2, col3 = st.columns(3)
+
+        with col1:
+            send_button = st.button("Отправить", key="send_message", use_container_width=True)
+        with col2:
+            # Используем on_click для очистки
+            clear_button = st.button("Очистить", key="clear_input", on_click=clear_input, use_container_width=True)
+        with col3:
+            # Для кнопки отмены используем тот же callback
+            cancel_button = st.button("Отменить", key="cancel_request", on_click=clear_input, use_container_width=True)
+
+        # Изменяем логику отправки сообщения
+        if send_button:  # Отправляем только при явном нажатии кнопки
+            # Наличие генераций проверяется при списании в submit_message
+            if user_input and user_input.strip():
+                st.session_state['_last_input'] = user_input
+                submit_message(user_input)
+
+chat_area()
+
+record_timing("new_chat:script", time.perf_counter() - _script_started)
@@ -12,6 +12,7 @@ from googletrans import Translator
 import streamlit.components.v1 as components
 from datetime import datetime
 from utils.database.database_manager import get_database
+from utils.quota import get_remaining
 
 # Получаем экземпляр базы данных
 db = get_database()
@@ -23,19 +24,7 @@ if not os.path.exists(PROFILE_IMAGES_DIR):
 
 def clear_chat_history(username: str, flow_id: str, session_id: str):
     """Очистка истории чата"""
-    db.chat_history.update_one(
-        {
-            "username": username,
-            "flow_id": flow_id,
-            "session_id": session_id
-        },
-        {
-            "$set": {
-                "messages": [],
-                "updated_at": datetime.now()
-            }
-        }
-    )
+    db.clear_chat_history(username, flow_id, session_id)
 
 def is_valid_image(file_content):
     """Проверяет, является ли файл изображением"""
@@ -178,7 +167,7 @@ def main():
     # Отображение токена и количества генераций
     if user_data.get('active_token'):
         st.subheader("Доступные генерации")
-        remaining_generations = user_data.get('remaining_generations', 0)
+        remaining_generations = get_remaining(st.session_state.username)
         
         if remaining_generations > 0:
             st.success(f"Осталось генераций: {remaining_generations}")
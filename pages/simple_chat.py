@@ -1,12 +1,11 @@
 import streamlit as st
-import requests
 from time import sleep
 import hashlib
 import os
 from PIL import Image
-from googletrans import Translator
 import time
-from flowise import Flowise, PredictionData
+from utils.translation import detect_language, translate_text as translate_with_memory
+from utils.flowise_client import create_prediction, extract_text
 import uuid
 
 # Настройка заголовка страницы
@@ -82,33 +81,20 @@ def query(question):
             st.error("API URL или ID чата не найдены в конфигурации")
             return None
 
-        # Создаем клиент Flowise
-        client = Flowise(base_url=base_url)
-        
         # Получаем ключ для сообщений пользователя
         messages_key = get_user_messages_key()
         
         try:
-            # Создаем предсказание
-            prediction = client.create_prediction(
-                PredictionData(
-                    chatflowId=flow_id,
-                    question=question,
-                    overrideConfig={
-                        "sessionId": get_user_chat_id()
-                    }
-                )
+            # Создаем предсказание через общий транспорт Flowise
+            response = create_prediction(
+                base_url,
+                flow_id,
+                question,
+                {
+                    "sessionId": get_user_chat_id()
+                }
             )
-            
-            # Собираем ответ из потока
-            full_response = ""
-            for chunk in prediction:
-                if chunk:
-                    if isinstance(chunk, dict):
-                        chunk_text = chunk.get('text', str(chunk))
-                    else:
-                        chunk_text = str(chunk)
-                    full_response += chunk_text
+            full_response = extract_text(response) or ""
             
             if full_response:
                 # Добавляем сообщения в историю
@@ -116,11 +102,11 @@ def query(question):
                     st.session_state[messages_key] = []
                 
                 # Добавляем сообщение пользователя
-                user_message = {"role": "user", "content": question}
+                user_message = {"role": "user", "content": question, "id": uuid.uuid4().hex}
                 st.session_state[messages_key].append(user_message)
                 
                 # Добавляем ответ ассистента
-                assistant_message = {"role": "assistant", "content": full_response}
+                assistant_message = {"role": "assistant", "content": full_response, "id": uuid.uuid4().hex}
                 st.session_state[messages_key].append(assistant_message)
                 
                 st.rerun()
@@ -201,23 +187,18 @@ def translate_text(text, target_lang='ru'):
     target_lang: 'ru' для русского или 'en' для английского
     """
     try:
-        translator = Translator()
-        
         if text is None or not isinstance(text, str) or text.strip() == '':
             return "Пустой текст для перевода"
             
-        # Определяем язык текста
-        detected_lang = translator.detect(text).lang
+        # Определяем язык текста (результат кэшируется)
+        detected_lang = detect_language(text)
         
         # Если текст уже на целевом языке, меняем язык перевода
         if detected_lang == target_lang:
             target_lang = 'en' if target_lang == 'ru' else 'ru'
             
-        translation = translator.translate(text, dest=target_lang)
-        if translation and hasattr(translation, 'text') and translation.text:
-            return translation.text
-            
-        return f"Ошибка перевода: некорректный ответ от переводчика"
+        # Перевод через общую память переводов
+        return translate_with_memory(text, target_lang, source_lang=detected_lang)
         
     except Exception as e:
         st.error(f"Ошибка при переводе: {str(e)}")
@@ -225,18 +206,12 @@ def translate_text(text, target_lang='ru'):
 
 def display_message_with_translation(message):
     """Отображает сообщение с кнопкой перевода"""
-    message_hash = get_message_hash(message["role"], message["content"])
+    # id присваивается при добавлении сообщения; старым сообщениям сессии - один раз при отображении
+    message_id = message.setdefault("id", uuid.uuid4().hex)
     avatar = assistant_avatar if message["role"] == "assistant" else get_user_profile_image(st.session_state.get("username", ""))
     
-    # Добавляем уникальный идентификатор сообщения
-    if 'message_ids' not in st.session_state:
-        st.session_state.message_ids = {}
-    
-    if message_hash not in st.session_state.message_ids:
-        st.session_state.message_ids[message_hash] = len(st.session_state.message_ids)
-    
     # Инициализируем состояние перевода для этого сообщения
-    translation_key = f"translation_state_{message_hash}"
+    translation_key = f"translation_state_{message_id}"
     if translation_key not in st.session_state:
         st.session_state[translation_key] = {
             "is_translated": False,
@@ -270,8 +245,7 @@ def display_message_with_translation(message):
                 """,
                 unsafe_allow_html=True
             )
-            # Используем комбинацию хэша, ID сообщения и роли для уникального ключа
-            button_key = f"translate_{message_hash}_{st.session_state.message_ids[message_hash]}_{message['role']}"
+            button_key = f"translate_{message_id}"
             if st.button("🔄", key=button_key, help="Перевести сообщение"):
                 current_state = st.session_state[translation_key]
                 
@@ -286,10 +260,6 @@ def display_message_with_translation(message):
                     message_placeholder.markdown(st.session_state[translation_key]["translated_text"])
                     st.session_state[translation_key]["is_translated"] = True
 
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
-
 def main():
     # Проверка аутентификации
     if not st.session_state.get("authenticated", False):
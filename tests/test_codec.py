@@ -0,0 +1,39 @@
+import json
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("bson")
+
+from utils.database import codec
+
+def _chat_history(length: int = 200):
+    """Типичная история чата, как она хранится в кэше chat_history:*"""
+    now = datetime.now()
+    return [
+        {
+            "id": f"{i:032x}",
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": "Пример сообщения в истории чата. " * 10,
+            "lang": "ru",
+            "seq": i,
+            "timestamp": now
+        }
+        for i in range(length)
+    ]
+
+def test_chat_history_roundtrip_keeps_types():
+    history = _chat_history(5)
+    decoded = codec.decode(codec.encode(history))
+    assert [m["seq"] for m in decoded] == [m["seq"] for m in history]
+    assert isinstance(decoded[0]["timestamp"], datetime)
+
+def test_chat_history_is_smaller_than_json():
+    history = _chat_history()
+    encoded = codec.encode(history)
+    json_data = json.dumps(history, default=str).encode("utf-8")
+    assert encoded[:1] == codec.FORMAT_BSON_ZLIB
+    assert len(encoded) < len(json_data)
+
+def test_legacy_json_values_are_still_readable():
+    assert codec.decode(json.dumps({"a": 1}).encode("utf-8")) == {"a": 1}
@@ -0,0 +1,35 @@
+import io
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from utils import flowise_client
+
+CYRILLIC_SSE = (
+    'event: token\n'
+    'data: Привет\n'
+    '\n'
+    'data: {"event": "token", "data": ", мир!"}\n'
+    '\n'
+    'data: {"event": "end", "data": "[DONE]"}\n'
+    '\n'
+).encode("utf-8")
+
+def _sse_response(body: bytes) -> requests.Response:
+    """Ответ Flowise с text/event-stream без charset, как его присылает сервер"""
+    response = requests.Response()
+    response.status_code = 200
+    response.headers["Content-Type"] = "text/event-stream"
+    response.raw = io.BytesIO(body)
+    return response
+
+def test_iter_events_decodes_cyrillic_as_utf8():
+    events = list(flowise_client._iter_events(_sse_response(CYRILLIC_SSE)))
+    assert events == [("token", "Привет"), ("token", ", мир!"), ("end", "[DONE]")]
+
+def test_stream_prediction_yields_cyrillic_tokens(monkeypatch):
+    monkeypatch.setattr(flowise_client, "_request",
+                        lambda *args, **kwargs: _sse_response(CYRILLIC_SSE))
+    chunks = list(flowise_client.stream_prediction("http://flowise", "flow", "вопрос"))
+    assert "".join(chunks) == "Привет, мир!"
@@ -0,0 +1,61 @@
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")  # Lua-скрипты в fakeredis
+
+from utils import session_store
+from utils.database import codec
+
+USER, FLOW, SESSION = "user", "flow", "session"
+
+@pytest.fixture
+def redis_server(monkeypatch):
+    """Общий fakeredis-сервер для текстового и двоичного клиентов"""
+    server = fakeredis.FakeServer()
+    text_client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    binary_client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(session_store, "get_redis_connection", lambda: text_client)
+    monkeypatch.setattr(session_store, "get_redis_binary_connection", lambda: binary_client)
+    monkeypatch.setattr(session_store, "_scripts", {})
+    return binary_client
+
+def _stored_seqs(binary_client):
+    raw = binary_client.lrange(session_store.messages_key(USER, FLOW, SESSION), 0, -1)
+    return [codec.decode(item)["seq"] for item in raw]
+
+def test_interleaved_appends_keep_list_ordered_by_seq(redis_server, monkeypatch):
+    session_store.append_messages(USER, FLOW, SESSION, [{"role": "user", "content": "0"}])
+
+    # Второй запрос добавляет сообщения между чтением next_seq и записью первого
+    get_script = session_store._get_script
+    raced = []
+    interleaved = []
+
+    def racing_get_script(source):
+        script = get_script(source)
+        if source != session_store._APPEND_SCRIPT or raced:
+            return script
+
+        def run(*args, **kwargs):
+            if not raced:
+                raced.append(True)
+                interleaved.extend(session_store.append_messages(
+                    USER, FLOW, SESSION,
+                    [{"role": "user", "content": "b1"}, {"role": "assistant", "content": "b2"}]
+                ))
+            return script(*args, **kwargs)
+        return run
+
+    monkeypatch.setattr(session_store, "_get_script", racing_get_script)
+    first = session_store.append_messages(
+        USER, FLOW, SESSION,
+        [{"role": "user", "content": "a1"}, {"role": "assistant", "content": "a2"}]
+    )
+
+    assert [m["seq"] for m in interleaved] == [1, 2]
+    assert [m["seq"] for m in first] == [3, 4]
+    assert _stored_seqs(redis_server) == [0, 1, 2, 3, 4]
+
+    messages, total = session_store.load_recent_messages(USER, FLOW, SESSION, 2)
+    assert [m["content"] for m in messages] == ["a1", "a2"]
+    assert total == 5
@@ -0,0 +1,97 @@
+import json
+import zlib
+from typing import Any
+import bson
+from bson.errors import InvalidDocument
+
+# Формат значений кэша в Redis.
+#
+# Значение оборачивается в документ {"v": значение} и кодируется в BSON, поэтому
+# datetime и ObjectId возвращаются из кэша теми же типами, что и из MongoDB.
+# Первый байт - заголовок формата:
+#   0x01 - BSON
+#   0x02 - BSON, сжатый zlib (для значений больше COMPRESS_THRESHOLD байт)
+# Значения, записанные раньше в JSON, начинаются с печатного символа и читаются как JSON.
+
+FORMAT_BSON = b"\x01"
+FORMAT_BSON_ZLIB = b"\x02"
+COMPRESS_THRESHOLD = 1024   # байт
+COMPRESS_LEVEL = 6
+
+def encode(value: Any) -> bytes:
+    """Кодирование значения для записи в кэш"""
+    try:
+        payload = bson.encode({"v": value})
+    except (InvalidDocument, TypeError, OverflowError):
+        # Типы, которых нет в BSON, сохраняются как раньше - текстовым JSON
+        return json.dumps(value, default=str).encode("utf-8")
+
+    if len(payload) > COMPRESS_THRESHOLD:
+        compressed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(compressed) < len(payload):
+            return FORMAT_BSON_ZLIB + compressed
+    return FORMAT_BSON + payload
+
+def decode(data) -> Any:
+    """Декодирование значения из кэша (поддерживает старый JSON-формат)"""
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return json.loads(data)
+    header = data[:1]
+    if header == FORMAT_BSON:
+        return bson.decode(data[1:])["v"]
+    if header == FORMAT_BSON_ZLIB:
+        return bson.decode(zlib.decompress(data[1:]))["v"]
+    return json.loads(data)
+
+def _benchmark(iterations: int = 2000):
+    """Сравнение кодека с JSON по времени и размеру на типичных значениях кэша"""
+    import timeit
+    from datetime import datetime
+    from bson import ObjectId
+
+    now = datetime.now()
+    samples = {
+        "user": {
+            "_id": ObjectId(),
+            "username": "user_example",
+            "email": "user@example.com",
+            "password": "x" * 60,
+            "remaining_generations": 250,
+            "active_token": "f" * 64,
+            "created_at": now,
+            "updated_at": now,
+            "chat_flows": [{"id": f"flow-{i}", "name": f"Чат {i}"} for i in range(5)]
+        },
+        "chat_history_200": [
+            {
+                "role": "user" if i % 2 == 0 else "assistant",
+                "content": "Пример сообщения в истории чата. " * 10,
+                "lang": "ru",
+                "seq": i,
+                "timestamp": now.isoformat()
+            }
+            for i in range(200)
+        ]
+    }
+
+    print(f"{'значение':<18}{'формат':<8}{'байт':>10}{'encode, мкс':>14}{'decode, мкс':>14}")
+    for name, value in samples.items():
+        json_data = json.dumps(value, default=str).encode("utf-8")
+        codec_data = encode(value)
+        rows = [
+            ("json", json_data,
+             lambda: json.dumps(value, default=str).encode("utf-8"),
+             lambda: json.loads(json_data)),
+            ("codec", codec_data,
+             lambda: encode(value),
+             lambda: decode(codec_data))
+        ]
+        for label, data, encoder, decoder in rows:
+            encode_time = timeit.timeit(encoder, number=iterations) / iterations * 1e6
+            decode_time = timeit.timeit(decoder, number=iterations) / iterations * 1e6
+            print(f"{name:<18}{label:<8}{len(data):>10}{encode_time:>14.1f}{decode_time:>14.1f}")
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,113 @@
+import socket
+import threading
+from typing import Dict
+import streamlit as st
+from pymongo import MongoClient
+import redis
+
+# Реестр подключений уровня процесса.
+# Streamlit перевыполняет скрипты страниц на каждое действие пользователя,
+# поэтому клиенты создаются здесь один раз и переиспользуются всеми страницами.
+_lock = threading.Lock()
+
+# Сессии, квоты и токены страниц всегда хранились в базе Redis 0 (параметр redis.db
+# из secrets.toml использовал только кэш DatabaseManager), поэтому номер базы закреплен.
+REDIS_DB = 0
+
+_mongo_client = None
+_redis_pool = None
+_redis_client = None
+_redis_binary_pool = None
+_redis_binary_client = None
+
+# Счетчики созданных объектов: при повторном запуске страницы они не должны расти
+_stats = {
+    "mongo_clients_created": 0,
+    "redis_pools_created": 0,
+    "redis_clients_created": 0
+}
+
+def _keepalive_options() -> Dict[int, int]:
+    """Параметры TCP keepalive (доступны не на всех платформах)"""
+    options = {}
+    for name, value in (("TCP_KEEPIDLE", 30), ("TCP_KEEPINTVL", 10), ("TCP_KEEPCNT", 3)):
+        if hasattr(socket, name):
+            options[getattr(socket, name)] = value
+    return options
+
+def get_mongo_client() -> MongoClient:
+    """Получение единственного MongoClient процесса"""
+    global _mongo_client
+    if _mongo_client is None:
+        with _lock:
+            if _mongo_client is None:
+                client = MongoClient(
+                    st.secrets["mongodb"]["uri"],
+                    username=st.secrets["mongodb"]["username"],
+                    password=st.secrets["mongodb"]["password"],
+                    serverSelectionTimeoutMS=5000,
+                    connectTimeoutMS=5000
+                )
+                # Проверяем подключение один раз при создании клиента
+                client.admin.command('ping')
+                _stats["mongo_clients_created"] += 1
+                _mongo_client = client
+    return _mongo_client
+
+def _create_redis_pool(decode_responses: bool) -> redis.ConnectionPool:
+    """Пул подключений Redis с общими настройками"""
+    pool = redis.BlockingConnectionPool(
+        host=st.secrets["redis"]["host"],
+        port=st.secrets["redis"]["port"],
+        password=st.secrets["redis"]["password"],
+        db=REDIS_DB,
+        decode_responses=decode_responses,
+        socket_timeout=10,
+        socket_connect_timeout=10,
+        socket_keepalive=True,
+        socket_keepalive_options=_keepalive_options(),
+        retry_on_timeout=True,
+        max_connections=50,
+        timeout=10,
+        health_check_interval=15
+    )
+    _stats["redis_pools_created"] += 1
+    return pool
+
+def get_redis_pool() -> redis.ConnectionPool:
+    """Получение единственного пула подключений Redis процесса"""
+    global _redis_pool
+    if _redis_pool is None:
+        with _lock:
+            if _redis_pool is None:
+                _redis_pool = _create_redis_pool(decode_responses=True)
+    return _redis_pool
+
+def get_redis_connection() -> redis.Redis:
+    """Получение клиента Redis поверх общего пула подключений"""
+    global _redis_client
+    if _redis_client is None:
+        pool = get_redis_pool()
+        with _lock:
+            if _redis_client is None:
+                _redis_client = redis.Redis(connection_pool=pool)
+                _stats["redis_clients_created"] += 1
+    return _redis_client
+
+def get_redis_binary_connection() -> redis.Redis:
+    """
+    Клиент Redis без декодирования ответов (значения возвращаются как bytes).
+    Используется для значений кэша в двоичном формате utils.database.codec.
+    """
+    global _redis_binary_pool, _redis_binary_client
+    if _redis_binary_client is None:
+        with _lock:
+            if _redis_binary_client is None:
+                _redis_binary_pool = _create_redis_pool(decode_responses=False)
+                _redis_binary_client = redis.Redis(connection_pool=_redis_binary_pool)
+                _stats["redis_clients_created"] += 1
+    return _redis_binary_client
+
+def get_connection_stats() -> Dict[str, int]:
+    """Счетчики созданных подключений (для проверки отсутствия новых подключений при rerun)"""
+    return dict(_stats)
@@ -1,26 +1,42 @@
 import os
+import re
 import json
+import time
+import uuid
+import hashlib
+import threading
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import streamlit as st
-from pymongo import MongoClient
+from pymongo import ReturnDocument
 from pymongo.collection import Collection
-import redis
 from bson import ObjectId
 from functools import wraps
 import inspect
+from utils.database.connections import get_mongo_client, get_redis_connection, get_redis_binary_connection
+from utils.database import codec
+from utils.database.local_cache import LocalCache
+
+# Канал Redis для рассылки инвалидаций локальных кэшей всем экземплярам приложения
+INVALIDATION_CHANNEL = "cache:invalidate"
+
+# Размер пачки SCAN при удалении ключей по шаблону
+SCAN_BATCH_SIZE = 500
+
+# Снятие блокировки cache_handler: ключ удаляется, только если в нем токен владельца
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
 
 class DatabaseManager:
     _instance = None
 
     def __init__(self):
-        # MongoDB подключение
-        self.mongo_uri = st.secrets["mongodb"]["uri"]
-        self.mongo_client = MongoClient(
-            self.mongo_uri,
-            username=st.secrets["mongodb"]["username"],
-            password=st.secrets["mongodb"]["password"]
-        )
+        # MongoDB подключение (общий клиент процесса)
+        self.mongo_client = get_mongo_client()
         self.db = self.mongo_client[st.secrets["mongodb"]["database"]]
         
         # Коллекции MongoDB
@@ -28,18 +44,76 @@ class DatabaseManager:
         self.chat_sessions = self.db.chat_sessions
         self.chat_history = self.db.chat_history
         self.access_tokens = self.db.access_tokens
+        self.deactivated_tokens = self.db.deactivated_tokens
+        self.usage_rollups = self.db.usage_rollups
         
         # Создаем индексы
         self._create_indexes()
         
-        # Redis подключение
-        self.redis_client = redis.Redis(
-            host=st.secrets["redis"]["host"],
-            port=st.secrets["redis"]["port"],
-            password=st.secrets["redis"]["password"],
-            db=st.secrets["redis"]["db"],
-            decode_responses=True
-        )
+        # Redis подключение (общий пул процесса)
+        self.redis_client = get_redis_connection()
+        # Значения кэша хранятся в двоичном формате codec (типы сохраняются как в MongoDB)
+        self.cache_redis = get_redis_binary_connection()
+        
+        # Двухуровневый кэш: L1 в памяти процесса перед L2 в Redis
+        self.local_cache = LocalCache(maxsize=2000, ttl=30)
+        self._instance_id = uuid.uuid4().hex
+        self._cache_stats = {"l2_hits": 0, "l2_misses": 0}
+        self._invalidation_thread = None
+        self._subscribe_invalidations()
+    
+    def _subscribe_invalidations(self):
+        """Подписка на инвалидации от других экземпляров приложения"""
+        def handle(message):
+            try:
+                payload = json.loads(message["data"])
+                # Свои инвалидации уже применены локально
+                if payload.get("origin") == self._instance_id:
+                    return
+                for key in payload.get("keys", []):
+                    self.local_cache.delete(key)
+                for prefix in payload.get("prefixes", []):
+                    self.local_cache.delete_prefix(prefix)
+            except Exception as e:
+                print(f"Ошибка обработки инвалидации кэша: {str(e)}")
+        
+        try:
+            pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{INVALIDATION_CHANNEL: handle})
+            self._invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except Exception as e:
+            # Без подписки локальные записи устаревают не позже чем через ttl L1
+            print(f"Ошибка подписки на инвалидации кэша: {str(e)}")
+    
+    def _invalidate(self, keys: List[str] = (), prefixes: List[str] = ()):
+        """Удаление записей из L1 этого процесса и рассылка инвалидации остальным"""
+        for key in keys:
+            self.local_cache.delete(key)
+        for prefix in prefixes:
+            self.local_cache.delete_prefix(prefix)
+        try:
+            self.redis_client.publish(
+                INVALIDATION_CHANNEL,
+                json.dumps({"origin": self._instance_id, "keys": list(keys), "prefixes": list(prefixes)})
+            )
+        except Exception as e:
+            print(f"Ошибка рассылки инвалидации кэша: {str(e)}")
+    
+    def _count_l2(self, hit: bool):
+        self._cache_stats["l2_hits" if hit else "l2_misses"] += 1
+    
+    def get_cache_stats(self) -> Dict[str, Dict[str, float]]:
+        """Попадания по уровням кэша"""
+        l2 = dict(self._cache_stats)
+        lookups = l2["l2_hits"] + l2["l2_misses"]
+        return {
+            "l1": self.local_cache.get_stats(),
+            "l2": {
+                "hits": l2["l2_hits"],
+                "misses": l2["l2_misses"],
+                "hit_ratio": round(l2["l2_hits"] / lookups, 3) if lookups else 0.0
+            }
+        }
     
     def _create_indexes(self):
         """Создание индексов для оптимизации запросов"""
@@ -75,12 +149,39 @@ class DatabaseManager:
                     ("session_id", 1)
                 ])
             
+            # Документы, ожидающие сжатия (после удаления или очистки сообщений)
+            if "needs_compaction_1" not in history_indexes:
+                self.chat_history.create_index(
+                    [("needs_compaction", 1)],
+                    partialFilterExpression={"needs_compaction": True}
+                )
+            
             # Индекс для токенов
             existing_token_indexes = self.access_tokens.list_indexes()
             token_indexes = {idx['name'] for idx in existing_token_indexes}
             
             if "token_1" not in token_indexes:
                 self.access_tokens.create_index("token", unique=True)
+            if "created_at_-1__id_-1" not in token_indexes:
+                self.access_tokens.create_index([("created_at", -1), ("_id", -1)])
+            
+            # Индекс для деактивированных токенов
+            existing_deactivated_indexes = self.deactivated_tokens.list_indexes()
+            deactivated_indexes = {idx['name'] for idx in existing_deactivated_indexes}
+            
+            if "token_1" not in deactivated_indexes:
+                self.deactivated_tokens.create_index("token", unique=True)
+            
+            # Индекс для счетчиков использования
+            existing_usage_indexes = self.usage_rollups.list_indexes()
+            usage_indexes = {idx['name'] for idx in existing_usage_indexes}
+            
+            if "hour_1_flow_id_1_username_1" not in usage_indexes:
+                self.usage_rollups.create_index([
+                    ("hour", 1),
+                    ("flow_id", 1),
+                    ("username", 1)
+                ], unique=True)
             
         except Exception as e:
             print(f"Ошибка при создании индексов: {str(e)}")
@@ -90,18 +191,32 @@ class DatabaseManager:
         """Получение данных пользователя с кэшированием"""
         cache_key = f"user:{username}"
         
-        # Пробуем получить из кэша
-        cached_user = self.redis_client.get(cache_key)
+        # Сначала кэш процесса, затем Redis
+        found, user = self.local_cache.get(cache_key)
+        if found:
+            return user
+        
+        cached_user = self.cache_redis.get(cache_key)
+        self._count_l2(bool(cached_user))
         if cached_user:
-            return json.loads(cached_user)
+            user = codec.decode(cached_user)
+            self.local_cache.set(cache_key, user)
+            return user
         
         # Если нет в кэше, получаем из MongoDB
         user = self.users.find_one({"username": username})
         if user:
             # Кэшируем на 5 минут
-            self.redis_client.setex(cache_key, 300, json.dumps(user, default=str))
+            self.cache_redis.setex(cache_key, 300, codec.encode(user))
+            self.local_cache.set(cache_key, user)
         return user
     
+    def invalidate_user(self, username: str):
+        """Сброс кэша пользователя во всех экземплярах приложения"""
+        cache_key = f"user:{username}"
+        self.redis_client.delete(cache_key)
+        self._invalidate(keys=[cache_key])
+    
     def update_user(self, username: str, update_data: Dict) -> bool:
         """Обновление данных пользователя с инвалидацией кэша"""
         try:
@@ -111,67 +226,398 @@ class DatabaseManager:
             )
             
             # Инвалидируем кэш
-            self.redis_client.delete(f"user:{username}")
+            self.invalidate_user(username)
             
             return result.modified_count > 0
         except Exception as e:
             print(f"Ошибка при обновлении пользователя: {str(e)}")
             return False
     
-    def get_chat_history(self, username: str, flow_id: str, session_id: str) -> List[Dict]:
-        """Получение истории чата с кэшированием"""
-        cache_key = f"chat_history:{username}:{flow_id}:{session_id}"
+    def find_users_page(self, search: str = "", after_username: Optional[str] = None,
+                        page_size: int = 50) -> Tuple[List[Dict], Optional[str]]:
+        """
+        Страница списка пользователей по имени (по возрастанию) с поиском по началу имени или email.
+        Вместо skip используется диапазонный запрос от последнего имени предыдущей страницы.
+        Возвращает (пользователи, имя для следующей страницы или None).
+        """
+        query = {}
+        search = search.strip()
+        if search:
+            # Якорные regex используют уникальные индексы username и email
+            pattern = {"$regex": f"^{re.escape(search)}"}
+            query["$or"] = [{"username": pattern}, {"email": pattern}]
+        if after_username is not None:
+            query["username"] = {"$gt": after_username}
         
-        # Пробуем получить из кэша
-        cached_history = self.redis_client.get(cache_key)
-        if cached_history:
-            return json.loads(cached_history)
+        users = list(
+            self.users.find(query, {
+                "username": 1,
+                "email": 1,
+                "created_at": 1,
+                "registered_at": 1,
+                "active_token": 1,
+                "remaining_generations": 1,
+                "chat_flows.id": 1,
+                "chat_flows.name": 1
+            })
+            .sort("username", 1)
+            .limit(page_size + 1)
+        )
+        next_username = None
+        if len(users) > page_size:
+            users = users[:page_size]
+            next_username = users[-1]["username"]
+        return users, next_username
+    
+    def get_users_summary(self, days: int = 30) -> Dict:
+        """Сводка по пользователям одной агрегацией: токены, остаток генераций, регистрации по дням"""
+        result = list(self.users.aggregate([
+            {"$project": {
+                "has_token": {"$cond": [{"$ifNull": ["$active_token", False]}, 1, 0]},
+                "remaining": {"$cond": [
+                    {"$ifNull": ["$active_token", False]},
+                    {"$ifNull": ["$remaining_generations", 0]},
+                    0
+                ]},
+                "registered": {"$ifNull": ["$created_at", "$registered_at"]}
+            }},
+            {"$facet": {
+                "totals": [
+                    {"$group": {
+                        "_id": None,
+                        "users": {"$sum": 1},
+                        "active_tokens": {"$sum": "$has_token"},
+                        "remaining_generations": {"$sum": "$remaining"}
+                    }}
+                ],
+                "registrations": [
+                    {"$match": {"registered": {"$type": "date"}}},
+                    {"$group": {
+                        "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$registered"}},
+                        "count": {"$sum": 1}
+                    }},
+                    {"$sort": {"_id": -1}},
+                    {"$limit": days},
+                    {"$sort": {"_id": 1}}
+                ]
+            }}
+        ]))
         
-        # Если нет в кэше, получаем из MongoDB
-        history = self.chat_history.find_one({
+        facets = result[0] if result else {"totals": [], "registrations": []}
+        totals = facets["totals"][0] if facets["totals"] else {}
+        return {
+            "users": totals.get("users", 0),
+            "active_tokens": totals.get("active_tokens", 0),
+            "remaining_generations": totals.get("remaining_generations", 0),
+            "registrations": [
+                {"date": row["_id"], "count": row["count"]} for row in facets["registrations"]
+            ]
+        }
+    
+    def _history_query(self, username: str, flow_id: str, session_id: str) -> Dict:
+        """Фильтр документа истории чата"""
+        return {
             "username": username,
             "flow_id": flow_id,
             "session_id": session_id
-        })
+        }
+    
+    @staticmethod
+    def _visible_messages_expr() -> Dict:
+        """
+        Видимые сообщения документа истории: без отметки deleted и с номером не меньше
+        visible_from_seq (сообщения до очистки истории). Сообщения без номера видимы,
+        пока история не очищалась.
+        """
+        return {"$filter": {
+            "input": {"$ifNull": ["$messages", []]},
+            "as": "m",
+            "cond": {"$and": [
+                {"$ne": ["$$m.deleted", True]},
+                {"$gte": [{"$ifNull": ["$$m.seq", -1]}, {"$ifNull": ["$visible_from_seq", -1]}]}
+            ]}
+        }}
+    
+    @staticmethod
+    def _visible_messages(history: Optional[Dict]) -> List[Dict]:
+        """Та же фильтрация для документа, уже полученного из MongoDB"""
+        if not history:
+            return []
+        visible_from = history.get("visible_from_seq", -1)
+        return [
+            message for message in history.get("messages", [])
+            if not message.get("deleted") and message.get("seq", -1) >= visible_from
+        ]
+    
+    def _history_cache_key(self, username: str, flow_id: str, session_id: str) -> str:
+        """Ключ кэша истории чата (список Redis, по одному сообщению на элемент)"""
+        return f"chat_history:{username}:{flow_id}:{session_id}"
+    
+    def _cache_history(self, cache_key: str, messages: List[Dict]):
+        """Полная запись истории в кэш"""
+        try:
+            pipe = self.cache_redis.pipeline()
+            pipe.delete(cache_key)
+            if messages:
+                pipe.rpush(cache_key, *[codec.encode(message) for message in messages])
+                # Кэшируем на 1 минуту
+                pipe.expire(cache_key, 60)
+            pipe.execute()
+        except Exception as e:
+            print(f"Ошибка при кэшировании истории: {str(e)}")
+    
+    def get_chat_history(self, username: str, flow_id: str, session_id: str) -> List[Dict]:
+        """Получение истории чата с кэшированием"""
+        cache_key = self._history_cache_key(username, flow_id, session_id)
+        
+        # Сначала кэш процесса, затем Redis
+        found, messages = self.local_cache.get(cache_key)
+        if found:
+            return messages
+        
+        try:
+            cached_history = self.cache_redis.lrange(cache_key, 0, -1)
+            self._count_l2(bool(cached_history))
+            if cached_history:
+                # При одновременной записи элементы кэша могут прийти не по порядку
+                messages = sorted(
+                    (codec.decode(message) for message in cached_history),
+                    key=lambda message: message.get("seq", -1)
+                )
+                self.local_cache.set(cache_key, messages)
+                return messages
+        except Exception as e:
+            print(f"Ошибка при получении истории из кэша: {str(e)}")
         
-        messages = history.get("messages", []) if history else []
+        # Если нет в кэше, получаем из MongoDB
+        history = self.chat_history.find_one(
+            self._history_query(username, flow_id, session_id),
+            {"messages": 1, "visible_from_seq": 1}
+        )
         
-        # Кэшируем на 1 минуту
-        self.redis_client.setex(cache_key, 60, json.dumps(messages, default=str))
+        messages = self._visible_messages(history)
+        self._cache_history(cache_key, messages)
+        self.local_cache.set(cache_key, messages)
         
         return messages
     
-    def save_chat_history(self, username: str, flow_id: str, session_id: str, messages: List[Dict]) -> bool:
-        """Сохранение истории чата с обновлением кэша"""
+    def append_chat_messages(self, username: str, flow_id: str, session_id: str, new_messages: List[Dict]) -> List[Dict]:
+        """
+        Добавление сообщений в конец истории (история не читается и не передается с клиента).
+        Каждому сообщению присваиваются неизменяемый id и порядковый номер seq в пределах сессии.
+        Возвращает сохраненные сообщения (пустой список при ошибке).
+        """
+        if not new_messages:
+            return []
         try:
-            self.chat_history.update_one(
-                {
-                    "username": username,
-                    "flow_id": flow_id,
-                    "session_id": session_id
-                },
+            query = self._history_query(username, flow_id, session_id)
+            now = datetime.now()
+            
+            # Номера резервируются и сообщения дописываются одним обновлением документа,
+            # поэтому при одновременной записи порядок массива совпадает с порядком seq.
+            # Для старых документов без счетчика нумерация продолжается с текущей длины массива.
+            prepared = [
+                {"message": {**message, "id": message.get("id") or uuid.uuid4().hex}, "offset": i}
+                for i, message in enumerate(new_messages)
+            ]
+            counter = self.chat_history.find_one_and_update(
+                query,
+                [
+                    {"$set": {
+                        "next_seq": {"$ifNull": ["$next_seq", {"$size": {"$ifNull": ["$messages", []]}}]},
+                        "created_at": {"$ifNull": ["$created_at", now]}
+                    }},
+                    {"$set": {
+                        "messages": {"$concatArrays": [
+                            {"$ifNull": ["$messages", []]},
+                            {"$map": {
+                                "input": {"$literal": prepared},
+                                "as": "m",
+                                "in": {"$mergeObjects": [
+                                    "$$m.message",
+                                    {"seq": {"$add": ["$next_seq", "$$m.offset"]}}
+                                ]}
+                            }}
+                        ]},
+                        "next_seq": {"$add": ["$next_seq", len(new_messages)]},
+                        "updated_at": now
+                    }}
+                ],
+                projection={"next_seq": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            first_seq = counter["next_seq"] - len(new_messages)
+            stored = [
+                {**item["message"], "seq": first_seq + item["offset"]}
+                for item in prepared
+            ]
+            
+            # Дополняем кэш, только если он уже заполнен (RPUSHX не создает ключ)
+            cache_key = self._history_cache_key(username, flow_id, session_id)
+            try:
+                pipe = self.cache_redis.pipeline()
+                pipe.rpushx(cache_key, *[codec.encode(message) for message in stored])
+                pipe.expire(cache_key, 60)
+                pipe.execute()
+            except Exception as e:
+                print(f"Ошибка при обновлении кэша истории: {str(e)}")
+            self._invalidate(keys=[cache_key])
+            
+            return stored
+        except Exception as e:
+            print(f"Ошибка при добавлении сообщений: {str(e)}")
+            return []
+    
+    def delete_chat_message(self, username: str, flow_id: str, session_id: str, message_id: str) -> bool:
+        """
+        Удаление одного сообщения по id: сообщение помечается deleted (одна запись
+        в элемент массива). Место освобождает compact_chat_history.
+        """
+        try:
+            result = self.chat_history.update_one(
+                {**self._history_query(username, flow_id, session_id), "messages.id": message_id},
                 {
                     "$set": {
-                        "messages": messages,
+                        "messages.$.deleted": True,
+                        "needs_compaction": True,
                         "updated_at": datetime.now()
                     }
-                },
+                }
+            )
+            if result.modified_count:
+                self._drop_history_cache(username, flow_id, session_id)
+            return bool(result.modified_count)
+        except Exception as e:
+            print(f"Ошибка при удалении сообщения: {str(e)}")
+            return False
+    
+    def clear_chat_history(self, username: str, flow_id: str, session_id: str) -> bool:
+        """
+        Очистка истории без перезаписи массива: указатель visible_from_seq
+        переносится на следующий номер сообщения, более ранние сообщения скрываются.
+        """
+        try:
+            now = datetime.now()
+            self.chat_history.update_one(
+                self._history_query(username, flow_id, session_id),
+                [
+                    {"$set": {
+                        "next_seq": {"$ifNull": ["$next_seq", {"$size": {"$ifNull": ["$messages", []]}}]},
+                        "created_at": {"$ifNull": ["$created_at", now]},
+                        "updated_at": now
+                    }},
+                    {"$set": {
+                        "visible_from_seq": "$next_seq",
+                        "needs_compaction": {"$gt": [{"$size": {"$ifNull": ["$messages", []]}}, 0]}
+                    }}
+                ],
                 upsert=True
             )
-            
-            # Обновляем кэш
-            cache_key = f"chat_history:{username}:{flow_id}:{session_id}"
-            self.redis_client.setex(cache_key, 60, json.dumps(messages, default=str))
-            
+            self._drop_history_cache(username, flow_id, session_id)
             return True
         except Exception as e:
-            print(f"Ошибка при сохранении истории: {str(e)}")
+            print(f"Ошибка при очистке истории: {str(e)}")
             return False
     
+    def _drop_history_cache(self, username: str, flow_id: str, session_id: str):
+        """Сброс кэша истории во всех уровнях"""
+        cache_key = self._history_cache_key(username, flow_id, session_id)
+        try:
+            self.cache_redis.delete(cache_key)
+        except Exception as e:
+            print(f"Ошибка при сбросе кэша истории: {str(e)}")
+        self._invalidate(keys=[cache_key])
+    
+    def compact_chat_history(self) -> int:
+        """
+        Освобождение места: из документов удаляются сообщения с отметкой deleted
+        и сообщения до visible_from_seq. Обрабатываются только документы с отметкой
+        needs_compaction (частичный индекс), которую ставят удаление и очистка.
+        Выполняется фоновым обслуживанием. Возвращает число сжатых документов.
+        """
+        result = self.chat_history.update_many(
+            {"needs_compaction": True},
+            [
+                {"$set": {"messages": self._visible_messages_expr(), "compacted_at": datetime.now()}},
+                {"$unset": "needs_compaction"}
+            ]
+        )
+        return result.modified_count
+    
+    def get_chat_history_page(self, username: str, flow_id: str, session_id: str,
+                              page: int = 0, page_size: int = 50) -> Tuple[List[Dict], int]:
+        """
+        Получение одной страницы истории (страница 0 - самые новые сообщения)
+        и общего количества сообщений. Срез выполняется на сервере MongoDB.
+        """
+        skip = max(page, 0) * page_size
+        try:
+            result = list(self.chat_history.aggregate([
+                {"$match": self._history_query(username, flow_id, session_id)},
+                {"$project": {"_id": 0, "visible": self._visible_messages_expr()}},
+                {"$project": {
+                    "total": {"$size": "$visible"},
+                    "messages": {"$let": {
+                        "vars": {"all": "$visible"},
+                        "in": {"$let": {
+                            "vars": {"size": {"$size": "$$all"}},
+                            "in": {"$cond": [
+                                {"$lte": ["$$size", skip]},
+                                {"$literal": []},
+                                {"$slice": [
+                                    "$$all",
+                                    {"$max": [{"$subtract": ["$$size", skip + page_size]}, 0]},
+                                    {"$min": [page_size, {"$subtract": ["$$size", skip]}]}
+                                ]}
+                            ]}
+                        }}
+                    }}
+                }}
+            ]))
+            if not result:
+                return [], 0
+            return result[0]["messages"], result[0]["total"]
+        except Exception as e:
+            print(f"Ошибка при получении страницы истории: {str(e)}")
+            return [], 0
+    
+    def get_chat_messages_by_seq(self, username: str, flow_id: str, session_id: str,
+                                 seq_from: int, seq_to: Optional[int] = None) -> Tuple[List[Dict], int]:
+        """
+        Получение сообщений с порядковыми номерами в диапазоне [seq_from, seq_to)
+        и общего количества сообщений. Фильтрация выполняется на сервере MongoDB.
+        """
+        condition = {"$gte": [{"$ifNull": ["$$m.seq", -1]}, seq_from]}
+        if seq_to is not None:
+            condition = {"$and": [condition, {"$lt": [{"$ifNull": ["$$m.seq", -1]}, seq_to]}]}
+        try:
+            result = list(self.chat_history.aggregate([
+                {"$match": self._history_query(username, flow_id, session_id)},
+                {"$project": {"_id": 0, "visible": self._visible_messages_expr()}},
+                {"$project": {
+                    "total": {"$size": "$visible"},
+                    "messages": {"$filter": {
+                        "input": "$visible",
+                        "as": "m",
+                        "cond": condition
+                    }}
+                }}
+            ]))
+            if not result:
+                return [], 0
+            return result[0]["messages"], result[0]["total"]
+        except Exception as e:
+            print(f"Ошибка при получении сообщений по диапазону: {str(e)}")
+            return [], 0
+    
     def cache_set(self, key: str, value: any, expire: int = 300):
         """Сохранение данных в кэш"""
         try:
-            self.redis_client.setex(key, expire, json.dumps(value, default=str))
+            self.cache_redis.setex(key, expire, codec.encode(value))
+            # Старые копии в L1 других экземпляров больше не актуальны
+            self._invalidate(keys=[key])
+            self.local_cache.set(key, value, expire)
             return True
         except Exception as e:
             print(f"Ошибка при сохранении в кэш: {str(e)}")
@@ -179,9 +625,17 @@ class DatabaseManager:
     
     def cache_get(self, key: str) -> any:
         """Получение данных из кэша"""
+        found, value = self.local_cache.get(key)
+        if found:
+            return value
         try:
-            data = self.redis_client.get(key)
-            return json.loads(data) if data else None
+            data = self.cache_redis.get(key)
+            self._count_l2(bool(data))
+            if not data:
+                return None
+            value = codec.decode(data)
+            self.local_cache.set(key, value)
+            return value
         except Exception as e:
             print(f"Ошибка при получении из кэша: {str(e)}")
             return None
@@ -192,51 +646,149 @@ class DatabaseManager:
             # Удаляем кэш пользователя
             self.redis_client.delete(f"user:{username}")
             
-            # Удаляем кэш истории чатов
-            pattern = f"chat_history:{username}:*"
-            keys = self.redis_client.keys(pattern)
-            if keys:
-                self.redis_client.delete(*keys)
+            # Удаляем кэш истории чатов: ключи обходятся SCAN пачками, без блокирующего KEYS
+            batch = []
+            for key in self.redis_client.scan_iter(match=f"chat_history:{username}:*", count=SCAN_BATCH_SIZE):
+                batch.append(key)
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    self.redis_client.delete(*batch)
+                    batch = []
+            if batch:
+                self.redis_client.delete(*batch)
+            
+            # Сбрасываем L1 во всех экземплярах приложения
+            self._invalidate(keys=[f"user:{username}"], prefixes=[f"chat_history:{username}:"])
             
             return True
         except Exception as e:
             print(f"Ошибка при очистке кэша: {str(e)}")
             return False
     
-    def __del__(self):
-        """Закрытие соединений при удалении объекта"""
-        try:
-            self.mongo_client.close()
-            self.redis_client.close()
-        except:
-            pass
-
-    def cache_handler(self, key_prefix: str, ttl: int = 300):
+    def _cache_key_for(self, key_prefix: str, func, args, kwargs) -> str:
         """
-        Декоратор для кэширования результатов функций
+        Ключ кэша по содержимому аргументов: sha256 от канонического JSON.
+        Одинаков во всех процессах и работает с нехэшируемыми аргументами (списки, словари).
+        """
+        bound_args = inspect.signature(func).bind(*args, **kwargs)
+        bound_args.apply_defaults()
+        payload = json.dumps(bound_args.arguments, sort_keys=True, default=str, separators=(",", ":"))
+        digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+        return f"{key_prefix}:{func.__name__}:{digest}"
+    
+    def cache_handler(self, key_prefix: str, ttl: int = 300, stale_ttl: int = 60,
+                      negative_ttl: int = 30, lock_timeout: int = 10):
+        """
+        Декоратор для кэширования результатов функций.
+        
+        - ключ строится по содержимому аргументов и совпадает во всех экземплярах приложения;
+        - при промахе значение вычисляет только один вызов (блокировка на ключ в процессе
+          и блокировка SET NX в Redis между экземплярами), остальные ждут его результата;
+        - после ttl значение еще stale_ttl секунд отдается устаревшим, а обновляется в фоне;
+        - пустые результаты (None, [], {}) кэшируются на negative_ttl секунд.
+        
+        У обернутой функции есть метод invalidate(*args, **kwargs) для сброса записи.
         """
         def decorator(func):
+            key_locks = {}
+            key_locks_guard = threading.Lock()
+            
+            def get_key_lock(cache_key):
+                with key_locks_guard:
+                    if len(key_locks) > 10000:
+                        key_locks.clear()
+                    return key_locks.setdefault(cache_key, threading.Lock())
+            
+            release_script = self.redis_client.register_script(_RELEASE_LOCK_SCRIPT)
+            
+            def acquire_shared_lock(cache_key) -> Optional[str]:
+                """Токен владельца блокировки или None, если блокировку держит другой экземпляр"""
+                token = uuid.uuid4().hex
+                try:
+                    if self.redis_client.set(f"lock:{cache_key}", token, nx=True, ex=lock_timeout):
+                        return token
+                    return None
+                except Exception as e:
+                    print(f"Ошибка блокировки кэша: {str(e)}")
+                    return token
+            
+            def release_shared_lock(cache_key, token):
+                # Снимается только своя блокировка: истекшую и занятую другим экземпляром не трогаем
+                try:
+                    release_script(keys=[f"lock:{cache_key}"], args=[token])
+                except Exception as e:
+                    print(f"Ошибка снятия блокировки кэша: {str(e)}")
+            
+            def compute(cache_key, args, kwargs):
+                result = func(*args, **kwargs)
+                is_negative = result is None or result == [] or result == {}
+                fresh_ttl = negative_ttl if is_negative else ttl
+                self.cache_set(
+                    cache_key,
+                    {"value": result, "fresh_until": time.time() + fresh_ttl},
+                    fresh_ttl + stale_ttl
+                )
+                return result
+            
+            def refresh(cache_key, token, args, kwargs):
+                try:
+                    compute(cache_key, args, kwargs)
+                except Exception as e:
+                    print(f"Ошибка фонового обновления кэша {cache_key}: {str(e)}")
+                finally:
+                    release_shared_lock(cache_key, token)
+            
             @wraps(func)
             def wrapper(*args, **kwargs):
-                # Создаем уникальный ключ кэша на основе аргументов функции
-                bound_args = inspect.signature(func).bind(*args, **kwargs)
-                bound_args.apply_defaults()
-                cache_key = f"{key_prefix}:{func.__name__}:{hash(frozenset(bound_args.arguments.items()))}"
+                cache_key = self._cache_key_for(key_prefix, func, args, kwargs)
                 
-                # Пробуем получить данные из кэша
-                cached_result = self.cache_get(cache_key)
-                if cached_result is not None:
-                    return cached_result
+                entry = self.cache_get(cache_key)
+                if isinstance(entry, dict) and "fresh_until" in entry:
+                    if entry["fresh_until"] < time.time():
+                        token = acquire_shared_lock(cache_key)
+                        if token:
+                            # Устаревшее значение отдаем сразу, обновляем в фоне
+                            threading.Thread(target=refresh, args=(cache_key, token, args, kwargs), daemon=True).start()
+                    return entry["value"]
                 
-                # Если нет в кэше, выполняем функцию и сохраняем результат
-                result = func(*args, **kwargs)
-                self.cache_set(cache_key, result, ttl)
-                return result
+                with get_key_lock(cache_key):
+                    # Значение могло появиться, пока ждали блокировку
+                    entry = self.cache_get(cache_key)
+                    if isinstance(entry, dict) and "fresh_until" in entry:
+                        return entry["value"]
+                    
+                    token = acquire_shared_lock(cache_key)
+                    if not token:
+                        # Значение вычисляет другой экземпляр: ждем его результат
+                        deadline = time.monotonic() + lock_timeout
+                        while time.monotonic() < deadline:
+                            time.sleep(0.05)
+                            entry = self.cache_get(cache_key)
+                            if isinstance(entry, dict) and "fresh_until" in entry:
+                                return entry["value"]
+                    try:
+                        return compute(cache_key, args, kwargs)
+                    finally:
+                        if token:
+                            release_shared_lock(cache_key, token)
+            
+            def invalidate(*args, **kwargs):
+                cache_key = self._cache_key_for(key_prefix, func, args, kwargs)
+                try:
+                    self.redis_client.delete(cache_key)
+                except Exception as e:
+                    print(f"Ошибка при сбросе кэша: {str(e)}")
+                self._invalidate(keys=[cache_key])
+            
+            wrapper.invalidate = invalidate
             return wrapper
         return decorator
 
+_instance_lock = threading.Lock()
+
 def get_database() -> DatabaseManager:
     """Получение единственного экземпляра DatabaseManager"""
-    if not DatabaseManager._instance:
-        DatabaseManager._instance = DatabaseManager()
-    return DatabaseManager._instance 
\ No newline at end of file
+    if DatabaseManager._instance is None:
+        with _instance_lock:
+            if DatabaseManager._instance is None:
+                DatabaseManager._instance = DatabaseManager()
+    return DatabaseManager._instance
@@ -0,0 +1,63 @@
+import copy
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+class LocalCache:
+    """
+    Ограниченный кэш процесса (LRU с временем жизни записей).
+    Значения копируются при записи и чтении, чтобы изменения вызывающего кода
+    не попадали в кэш.
+    """
+
+    def __init__(self, maxsize: int = 2000, ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """Возвращает (найдено ли, значение)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self._stats["misses"] += 1
+                return False, None
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            value = entry[1]
+        return True, copy.deepcopy(value)
+
+    def set(self, key: str, value: Any, ttl: float = None):
+        """Сохраняет значение (не дольше ttl секунд)"""
+        expires = time.monotonic() + min(ttl or self.ttl, self.ttl)
+        value = copy.deepcopy(value)
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self._stats["invalidations"] += 1
+
+    def delete_prefix(self, prefix: str):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+                self._stats["invalidations"] += 1
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["items"] = len(self._data)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
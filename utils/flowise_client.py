@@ -0,0 +1,281 @@
+import json
+import time
+import random
+import threading
+from collections import defaultdict, deque
+from typing import Dict, Iterator, Optional
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from utils.perf import PERF_LOG_ENABLED
+
+# Общий транспорт для всех обращений к Flowise: одна requests.Session на процесс
+# с пулом keep-alive подключений, ограничением подключений на хост и таймаутами.
+
+PREDICTION_PATH = "/api/v1/prediction"
+
+CONNECT_TIMEOUT = 5       # секунд на установку соединения
+READ_TIMEOUT = 120        # секунд ожидания данных от сервера
+STREAM_DEADLINE = 300     # предельная длительность потокового ответа, секунд
+POOL_MAXSIZE = 20         # подключений на один хост
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5       # базовая задержка между попытками, секунд
+RETRY_STATUSES = {502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+_session_lock = threading.Lock()
+_session = None
+_adapter = None
+
+_stats_lock = threading.Lock()
+_transport_stats = {
+    "requests": 0,
+    "retries": 0,
+    "timeouts": 0,
+    "errors": 0
+}
+
+# Время до первого токена (секунды) по каждому чат-потоку, последние 200 замеров
+_ttft_lock = threading.Lock()
+_ttft_samples = defaultdict(lambda: deque(maxlen=200))
+
+class FlowiseStreamError(Exception):
+    """Ошибка, полученная от Flowise в потоке событий"""
+
+def _get_session() -> requests.Session:
+    """Общая HTTP-сессия процесса с пулом keep-alive подключений"""
+    global _session, _adapter
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=10,
+                    pool_maxsize=POOL_MAXSIZE,
+                    pool_block=True,
+                    max_retries=0
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                _adapter = adapter
+                _session = session
+    return _session
+
+def _count(name: str, value: int = 1):
+    with _stats_lock:
+        _transport_stats[name] += value
+
+def _is_connect_failure(error: Exception) -> bool:
+    """Ошибка до отправки запроса: повтор безопасен даже для POST"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], "reason", None), NewConnectionError)
+    return False
+
+def _request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Запрос через общую сессию с таймаутами и повторами с джиттером.
+    Повторяются только безопасные случаи: сбой подключения для любого метода,
+    таймауты и ответы 502/503/504 для идемпотентных методов.
+    """
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+    session = _get_session()
+
+    for attempt in range(MAX_RETRIES):
+        _count("requests")
+        last_attempt = attempt == MAX_RETRIES - 1
+        try:
+            response = session.request(method, url, **kwargs)
+            if idempotent and response.status_code in RETRY_STATUSES and not last_attempt:
+                response.close()
+                retry_reason = f"HTTP {response.status_code}"
+            else:
+                return response
+        except requests.exceptions.Timeout as e:
+            _count("timeouts")
+            if last_attempt or not (idempotent or _is_connect_failure(e)):
+                _count("errors")
+                raise
+            retry_reason = str(e)
+        except requests.exceptions.ConnectionError as e:
+            if last_attempt or not (idempotent or _is_connect_failure(e)):
+                _count("errors")
+                raise
+            retry_reason = str(e)
+
+        _count("retries")
+        delay = RETRY_BACKOFF * (2 ** attempt) + random.uniform(0, RETRY_BACKOFF)
+        print(f"[FLOWISE] Попытка {attempt + 1}/{MAX_RETRIES} не удалась ({retry_reason}), повтор через {delay:.1f}с")
+        time.sleep(delay)
+
+def get_transport_stats() -> Dict[str, float]:
+    """Метрики транспорта: запросы, новые подключения и доля переиспользованных подключений"""
+    with _stats_lock:
+        stats = dict(_transport_stats)
+
+    connections = 0
+    pool_requests = 0
+    if _adapter is not None:
+        pools = _adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+    stats["connections_opened"] = connections
+    stats["connection_reuse_rate"] = round(1 - connections / pool_requests, 3) if pool_requests else 0.0
+    return stats
+
+def prediction_url(base_url: str, flow_id: str, append_path: bool = True) -> str:
+    """
+    URL предсказания для чат-потока.
+    При append_path=False base_url считается готовым адресом предсказаний
+    (как flowise.api_base_url) и к нему добавляется только flow_id.
+    """
+    base = base_url.rstrip('/')
+    if not append_path:
+        return f"{base}/{flow_id}"
+    if base.endswith(PREDICTION_PATH):
+        base = base[:-len(PREDICTION_PATH)]
+    return f"{base}{PREDICTION_PATH}/{flow_id}"
+
+def extract_text(response_data) -> Optional[str]:
+    """Извлекает текст ответа из JSON Flowise (обычный ответ или сообщения агентов)"""
+    if isinstance(response_data, dict):
+        if response_data.get('text'):
+            return response_data['text']
+        if 'agentReasoning' in response_data:
+            return _agent_reasoning_text(response_data['agentReasoning'])
+        return None
+    return str(response_data) if response_data else None
+
+def _agent_reasoning_text(agents) -> Optional[str]:
+    """Последнее сообщение агентов"""
+    for agent in reversed(agents or []):
+        if agent.get('messages'):
+            last_message = agent['messages'][-1]
+            if isinstance(last_message, dict) and last_message.get('content'):
+                return last_message['content']
+            if isinstance(last_message, str) and last_message:
+                return last_message
+        if agent.get('instructions'):
+            return agent['instructions']
+    return None
+
+def record_ttft(flow_id: str, seconds: float):
+    """Сохраняет замер времени до первого токена"""
+    with _ttft_lock:
+        _ttft_samples[flow_id].append(seconds)
+    if PERF_LOG_ENABLED:
+        print(f"[FLOWISE] Время до первого токена ({flow_id}): {seconds:.2f}с")
+
+def get_ttft_stats() -> Dict[str, Dict[str, float]]:
+    """Статистика времени до первого токена по чат-потокам"""
+    stats = {}
+    with _ttft_lock:
+        for flow_id, samples in _ttft_samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            stats[flow_id] = {
+                "count": len(ordered),
+                "avg": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "last": samples[-1]
+            }
+    return stats
+
+def _iter_events(response) -> Iterator[tuple]:
+    """Разбор потока server-sent events Flowise в пары (событие, данные)"""
+    current_event = None
+    # Flowise не указывает charset в text/event-stream, и requests декодировал бы
+    # поток как ISO-8859-1, поэтому каждая строка декодируется как UTF-8 явно
+    for raw_line in response.iter_lines():
+        line = raw_line.decode("utf-8", errors="replace")
+        if not line:
+            current_event = None
+            continue
+        if line.startswith("event:"):
+            current_event = line[6:].strip()
+            continue
+        if not line.startswith("data:"):
+            continue
+        data = line[5:]
+        if data.startswith(" "):
+            data = data[1:]
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            payload = None
+        if isinstance(payload, dict) and "event" in payload:
+            yield payload["event"], payload.get("data")
+        else:
+            yield current_event or "token", data
+
+def create_prediction(base_url: str, flow_id: str, question: str,
+                      override_config: Optional[Dict] = None, append_path: bool = True):
+    """Обычный (не потоковый) запрос предсказания, возвращает JSON ответа"""
+    response = _request(
+        "POST",
+        prediction_url(base_url, flow_id, append_path),
+        json={
+            "question": question,
+            "overrideConfig": override_config or {}
+        }
+    )
+    response.raise_for_status()
+    return response.json()
+
+def stream_prediction(base_url: str, flow_id: str, question: str,
+                      override_config: Optional[Dict] = None,
+                      append_path: bool = True) -> Iterator[str]:
+    """
+    Генератор фрагментов ответа Flowise по мере их поступления.
+    Если чат-поток не поддерживает потоковую передачу, возвращает ответ целиком одним фрагментом.
+    """
+    payload = {
+        "question": question,
+        "streaming": True,
+        "overrideConfig": override_config or {}
+    }
+    started = time.monotonic()
+    first_token = True
+    agent_reasoning = None
+
+    with _request("POST", prediction_url(base_url, flow_id, append_path), json=payload, stream=True) as response:
+        response.raise_for_status()
+
+        if "text/event-stream" not in response.headers.get("Content-Type", ""):
+            text = extract_text(response.json())
+            record_ttft(flow_id, time.monotonic() - started)
+            if text:
+                yield text
+            return
+
+        for event, data in _iter_events(response):
+            if time.monotonic() - started > STREAM_DEADLINE:
+                _count("timeouts")
+                raise FlowiseStreamError(f"Превышено время ожидания ответа ({STREAM_DEADLINE}с)")
+            if event == "token":
+                if not data:
+                    continue
+                if first_token:
+                    record_ttft(flow_id, time.monotonic() - started)
+                    first_token = False
+                yield data
+            elif event == "agentReasoning":
+                agent_reasoning = data
+            elif event == "error":
+                raise FlowiseStreamError(str(data))
+            elif event == "end":
+                break
+
+    # Агентные потоки могут не присылать токены, только итоговые сообщения агентов
+    if first_token and agent_reasoning:
+        text = _agent_reasoning_text(agent_reasoning)
+        if text:
+            record_ttft(flow_id, time.monotonic() - started)
+            yield text
@@ -0,0 +1,164 @@
+import os
+import time
+import argparse
+import threading
+from datetime import datetime
+from typing import Dict
+from utils.database.connections import get_redis_connection
+from utils.database.database_manager import get_database
+from utils.quota import flush_dirty_balances
+from utils.usage import flush_usage_rollups
+from utils.session_store import compact_sessions
+
+# Фоновое обслуживание, вынесенное из страниц приложения:
+# очистка токенов, перенос остатков генераций и счетчиков использования в MongoDB,
+# сжатие истории чатов после удаления и очистки сообщений.
+#
+# Запуск:
+#   python -m utils.maintenance           - цикл с интервалом MAINTENANCE_INTERVAL
+#   python -m utils.maintenance --once    - один проход
+#   start_background_maintenance()        - фоновый поток процесса приложения
+#                                           (вызывается из setup_pages; отключается
+#                                           переменной окружения MAINTENANCE_IN_APP=0)
+#
+# Одновременно работает только один экземпляр: проход выполняется под
+# распределенной блокировкой в Redis.
+
+MAINTENANCE_INTERVAL = 300    # секунд между проходами
+LOCK_KEY = "maintenance:lock"
+LOCK_TIMEOUT = 600            # блокировка снимается сама, если процесс упал
+SCAN_BATCH_SIZE = 500
+MAINTENANCE_IN_APP = os.environ.get("MAINTENANCE_IN_APP", "1").lower() not in ("0", "false", "no")
+
+_background_lock = threading.Lock()
+_background_thread = None
+
+def ensure_token_indexes():
+    """
+    Индексы коллекции токенов.
+    Просроченные токены удаляет сама MongoDB по TTL-индексу на expires_at
+    (документы без срока действия, с expires_at = None, не затрагиваются).
+    MongoDB сравнивает expires_at с временем UTC, поэтому срок хранится в UTC.
+    """
+    db = get_database()
+    indexes = {idx['name']: idx for idx in db.access_tokens.list_indexes()}
+
+    # Раньше страница администратора создавала обычный индекс expires_at_1
+    ttl_index = indexes.get("expires_at_1")
+    if ttl_index is not None and "expireAfterSeconds" not in ttl_index:
+        db.access_tokens.drop_index("expires_at_1")
+        ttl_index = None
+    if ttl_index is None:
+        db.access_tokens.create_index([("expires_at", 1)], expireAfterSeconds=0)
+
+    if "remaining_generations_1" not in indexes:
+        db.access_tokens.create_index([("remaining_generations", 1)])
+    if "created_at_-1" not in indexes:
+        db.access_tokens.create_index([("created_at", -1)])
+
+def delete_depleted_tokens() -> int:
+    """Удаление токенов без генераций"""
+    db = get_database()
+    result = db.access_tokens.delete_many({"remaining_generations": {"$lte": 0}})
+    return result.deleted_count
+
+def reconcile_token_cache(batch_size: int = SCAN_BATCH_SIZE) -> int:
+    """
+    Удаляет из Redis кэш токенов, которых больше нет в MongoDB.
+    Ключи обходятся через SCAN и проверяются пачками одним запросом $in.
+    """
+    redis_client = get_redis_connection()
+    db = get_database()
+    removed = 0
+    batch = []
+
+    def check_batch(keys):
+        tokens = [key[len("token_"):] for key in keys]
+        existing = {
+            doc["token"]
+            for doc in db.access_tokens.find({"token": {"$in": tokens}}, {"token": 1, "_id": 0})
+        }
+        stale = [key for key, token in zip(keys, tokens) if token not in existing]
+        if stale:
+            redis_client.delete(*stale)
+        return len(stale)
+
+    for key in redis_client.scan_iter("token_*", count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            removed += check_batch(batch)
+            batch = []
+    if batch:
+        removed += check_batch(batch)
+
+    return removed
+
+def run_once() -> Dict[str, int]:
+    """Один проход обслуживания"""
+    ensure_token_indexes()
+    return {
+        "depleted_tokens": delete_depleted_tokens(),
+        "stale_token_cache": reconcile_token_cache(),
+        "flushed_balances": flush_dirty_balances(),
+        "flushed_usage": flush_usage_rollups(),
+        "compacted_histories": get_database().compact_chat_history(),
+        "compacted_session_messages": compact_sessions()
+    }
+
+def run_locked():
+    """Проход под распределенной блокировкой: если ее держит другой экземпляр, проход пропускается"""
+    lock = get_redis_connection().lock(LOCK_KEY, timeout=LOCK_TIMEOUT, blocking=False)
+    if not lock.acquire():
+        print("[MAINTENANCE] Обслуживание уже выполняется другим экземпляром")
+        return None
+    try:
+        started = time.monotonic()
+        result = run_once()
+        print(f"[MAINTENANCE] {datetime.now().isoformat()} {result} за {time.monotonic() - started:.1f}с")
+        return result
+    finally:
+        try:
+            lock.release()
+        except Exception as e:
+            print(f"[MAINTENANCE] Не удалось снять блокировку: {str(e)}")
+
+def _background_loop(interval: int):
+    while True:
+        try:
+            run_locked()
+        except Exception as e:
+            print(f"[MAINTENANCE] Ошибка обслуживания: {str(e)}")
+        time.sleep(interval)
+
+def start_background_maintenance(interval: int = MAINTENANCE_INTERVAL):
+    """
+    Запуск обслуживания в фоновом потоке процесса приложения (один поток на процесс).
+    Проходы из разных процессов не пересекаются благодаря блокировке в Redis.
+    """
+    global _background_thread
+    if not MAINTENANCE_IN_APP or _background_thread is not None:
+        return
+    with _background_lock:
+        if _background_thread is None:
+            _background_thread = threading.Thread(
+                target=_background_loop, args=(interval,), name="maintenance", daemon=True
+            )
+            _background_thread.start()
+
+def main():
+    parser = argparse.ArgumentParser(description="Фоновое обслуживание токенов и квот")
+    parser.add_argument("--once", action="store_true", help="выполнить один проход и завершиться")
+    parser.add_argument("--interval", type=int, default=MAINTENANCE_INTERVAL, help="интервал между проходами, секунд")
+    args = parser.parse_args()
+
+    while True:
+        try:
+            run_locked()
+        except Exception as e:
+            print(f"[MAINTENANCE] Ошибка обслуживания: {str(e)}")
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,11 @@ import redis
 import json
 from datetime import timedelta
 import time
+import threading
+from functools import lru_cache
 from utils.redis_client import get_redis_client
+from utils.database.local_cache import LocalCache
+from utils.maintenance import start_background_maintenance
 
 # Словарь с настройками страниц
 PAGE_CONFIG = {
@@ -79,83 +83,126 @@ def get_pages_store():
     """Создает изолированное хранилище страниц"""
     return {}
 
-def setup_pages():
-    """Настройка страниц приложения"""
-    # Проверяем состояние сессии в Redis
-    redis_client = get_redis_client()
-    session_id = st.session_state.get("_session_id")
-    username = st.session_state.get("username", "anonymous")
-    
-    if redis_client and session_id and username != "anonymous":
-        session_key = f"session:{username}:{session_id}"
-        session_data = redis_client.get(session_key)
-        
-        if not session_data:
-            # Если сессия не найдена в Redis, сбрасываем состояние
-            st.session_state.authenticated = False
-            st.session_state.username = None
-            st.session_state.is_admin = False
-            st.session_state._session_id = None
-            show_pages([Page("pages/registr.py", name=PAGE_CONFIG["registr"]["name"], icon=PAGE_CONFIG["registr"]["icon"])])
-            return
-        
-        # Обновляем состояние из Redis
-        try:
-            session_data = json.loads(session_data)
-            st.session_state.authenticated = session_data.get("authenticated", False)
-            st.session_state.is_admin = session_data.get("is_admin", False)
-        except Exception as e:
-            print(f"Ошибка при загрузке данных сессии: {e}")
-    
-    # Формируем список страниц
-    pages_to_show = []
-    is_authenticated = st.session_state.get("authenticated", False)
-    is_admin = st.session_state.get("is_admin", False)
-    
-    # Страница регистрации для неаутентифицированных пользователей
+# Проверенные сессии: повторная проверка в Redis не чаще раза в SESSION_CHECK_TTL секунд
+SESSION_CHECK_TTL = 30
+_session_checks = LocalCache(maxsize=5000, ttl=SESSION_CHECK_TTL)
+
+# Роль, для которой навигация была применена в процессе последней
+_nav_lock = threading.Lock()
+_last_applied_role = None
+
+def _get_role(is_authenticated: bool, is_admin: bool) -> str:
+    """Роль для набора страниц меню"""
     if not is_authenticated:
+        return "anonymous"
+    return "admin" if is_admin else "user"
+
+@lru_cache(maxsize=3)
+def _build_pages(role: str) -> tuple:
+    """Список страниц меню для роли (строится один раз на процесс)"""
+    pages = []
+    if role == "anonymous":
         reg_page_path = "pages/registr.py"
         if os.path.exists(reg_page_path):
-            pages_to_show.append(
+            pages.append(
                 Page(reg_page_path, name=PAGE_CONFIG["registr"]["name"], icon=PAGE_CONFIG["registr"]["icon"])
             )
         else:
             print(f"Ошибка: Файл {reg_page_path} не найден")
-            return
+        return tuple(pages)
     
-    # Добавляем остальные страницы
     for page_id, config in sorted(PAGE_CONFIG.items(), key=lambda x: x[1]["order"]):
         if page_id == "registr":
             continue
         
         # Проверяем права доступа
         should_show = (
-            is_authenticated and 
             config["show_when_authenticated"] and
-            (not config.get("admin_only", False) or is_admin)
+            (not config.get("admin_only", False) or role == "admin")
         )
         
         if should_show and config.get("show_in_menu", True):
             page_path = f"pages/{page_id}.py"
             if os.path.exists(page_path):
-                pages_to_show.append(
+                pages.append(
                     Page(page_path, name=config["name"], icon=config["icon"])
                 )
             else:
                 print(f"Предупреждение: Файл {page_path} не найден")
+    return tuple(pages)
+
+def _apply_pages(role: str):
+    """Применяет меню роли, только если оно отличается от уже показанного"""
+    global _last_applied_role
+    if st.session_state.get("_nav_role") == role and _last_applied_role == role:
+        return
     
+    pages_to_show = _build_pages(role)
     if not pages_to_show:
         print("Ошибка: Нет доступных страниц для отображения")
         return
+    
+    with _nav_lock:
+        try:
+            show_pages(list(pages_to_show))
+            _last_applied_role = role
+            st.session_state._nav_role = role
+        except Exception as e:
+            print(f"Ошибка при отображении страниц: {e}")
+            # Показываем только страницу регистрации в случае ошибки
+            if role == "anonymous":
+                show_pages([Page("pages/registr.py", name=PAGE_CONFIG["registr"]["name"], icon=PAGE_CONFIG["registr"]["icon"])])
+
+def _load_session(username: str, session_id: str):
+    """Данные сессии из Redis с локальным кэшем на SESSION_CHECK_TTL секунд"""
+    session_key = f"session:{username}:{session_id}"
+    found, session_data = _session_checks.get(session_key)
+    if found:
+        return session_data
+    
+    redis_client = get_redis_client()
+    if not redis_client:
+        return None
+    session_data = redis_client.get(session_key)
+    if session_data:
+        # Запоминаем только действующие сессии: завершенная сессия проверяется заново
+        _session_checks.set(session_key, session_data)
+    return session_data
+
+def setup_pages():
+    """Настройка страниц приложения"""
+    # Фоновое обслуживание запускается один раз на процесс
+    start_background_maintenance()
+    
+    # Проверяем состояние сессии (Redis, не чаще раза в SESSION_CHECK_TTL секунд)
+    session_id = st.session_state.get("_session_id")
+    username = st.session_state.get("username", "anonymous")
+    
+    if session_id and username and username != "anonymous" and get_redis_client():
+        session_data = _load_session(username, session_id)
         
-    # Отображаем страницы
-    try:
-        show_pages(pages_to_show)
-    except Exception as e:
-        print(f"Ошибка при отображении страниц: {e}")
-        # Показываем только страницу регистрации в случае ошибки
-        if not is_authenticated:
-            show_pages([Page("pages/registr.py", name=PAGE_CONFIG["registr"]["name"], icon=PAGE_CONFIG["registr"]["icon"])])
+        if not session_data:
+            # Если сессия не найдена в Redis, сбрасываем состояние
+            st.session_state.authenticated = False
+            st.session_state.username = None
+            st.session_state.is_admin = False
+            st.session_state._session_id = None
+            _apply_pages("anonymous")
+            return
+        
+        # Обновляем состояние из Redis
+        try:
+            session_data = json.loads(session_data)
+            st.session_state.authenticated = session_data.get("authenticated", False)
+            st.session_state.is_admin = session_data.get("is_admin", False)
+        except Exception as e:
+            print(f"Ошибка при загрузке данных сессии: {e}")
+    
+    role = _get_role(
+        st.session_state.get("authenticated", False),
+        st.session_state.get("is_admin", False)
+    )
+    _apply_pages(role)
 
 def check_token_access():
     """Проверка доступа к функционалу, требующему токен"""
@@ -0,0 +1,48 @@
+import os
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Dict
+
+# Замеры серверного времени обработки взаимодействий (последние 200 на каждый замер).
+# Позволяют сравнить полный перезапуск страницы и перезапуск только фрагмента чата.
+
+# Вывод каждого замера в журнал включается переменной окружения PERF_LOG=1
+PERF_LOG_ENABLED = os.environ.get("PERF_LOG", "").lower() in ("1", "true", "yes")
+
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=200))
+
+def record_timing(name: str, seconds: float):
+    """Сохраняет замер"""
+    with _lock:
+        _samples[name].append(seconds)
+    if PERF_LOG_ENABLED:
+        print(f"[PERF] {name}: {seconds * 1000:.0f} мс")
+
+@contextmanager
+def timed(name: str):
+    """Замер времени выполнения блока"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_timing(name, time.perf_counter() - started)
+
+def get_perf_stats() -> Dict[str, Dict[str, float]]:
+    """Статистика замеров в миллисекундах"""
+    stats = {}
+    with _lock:
+        for name, samples in _samples.items():
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            stats[name] = {
+                "count": len(ordered),
+                "avg_ms": round(sum(ordered) / len(ordered) * 1000, 1),
+                "p50_ms": round(ordered[len(ordered) // 2] * 1000, 1),
+                "p95_ms": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 1),
+                "last_ms": round(samples[-1] * 1000, 1)
+            }
+    return stats
@@ -0,0 +1,189 @@
+import threading
+from datetime import datetime
+from typing import Tuple
+from pymongo import UpdateOne
+from utils.database.connections import get_redis_connection
+from utils.database.database_manager import get_database
+from utils.token_registry import deactivate_token
+
+# Учет генераций пользователей.
+#
+# quota:{username}  - остаток генераций (счетчик Redis, источник истины для горячего пути)
+# quota:dirty       - SET пользователей, чей остаток еще не записан в MongoDB
+#
+# Проверка и списание выполняются одним Lua-скриптом на стороне Redis, поэтому
+# одновременные запросы одного пользователя не могут уйти в минус.
+# Остатки переносятся в MongoDB пакетами (flush_dirty_balances) фоновым обслуживанием
+# (utils/maintenance.py), кэш user:{username} при этом не сбрасывается.
+
+DIRTY_SET_KEY = "quota:dirty"
+FLUSH_BATCH_SIZE = 500
+
+# Коды результата скрипта
+NOT_LOADED = -2           # остаток не загружен в Redis
+INSUFFICIENT = -1         # генераций недостаточно, списание не выполнено
+
+_CONSUME_SCRIPT = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then
+    return -2
+end
+local amount = tonumber(ARGV[2])
+if tonumber(balance) < amount then
+    return -1
+end
+local remaining = redis.call('DECRBY', KEYS[1], amount)
+redis.call('SADD', KEYS[2], ARGV[1])
+return remaining
+"""
+
+_script_lock = threading.Lock()
+_consume_script = None
+
+def quota_key(username: str) -> str:
+    """Ключ остатка генераций пользователя"""
+    return f"quota:{username}"
+
+def _get_consume_script():
+    """Скрипт списания, зарегистрированный один раз на процесс"""
+    global _consume_script
+    if _consume_script is None:
+        with _script_lock:
+            if _consume_script is None:
+                _consume_script = get_redis_connection().register_script(_CONSUME_SCRIPT)
+    return _consume_script
+
+def _load_balance(username: str) -> int:
+    """Загружает остаток из MongoDB в Redis, если его там еще нет"""
+    db = get_database()
+    user = db.users.find_one(
+        {"username": username},
+        {"remaining_generations": 1, "active_token": 1}
+    )
+    balance = 0
+    if user and user.get("active_token"):
+        balance = max(int(user.get("remaining_generations", 0)), 0)
+
+    redis_client = get_redis_connection()
+    # NX: остаток, уже загруженный другим процессом, не перезаписывается
+    redis_client.set(quota_key(username), balance, nx=True)
+    return int(redis_client.get(quota_key(username)) or 0)
+
+def get_remaining(username: str) -> int:
+    """Текущий остаток генераций пользователя"""
+    try:
+        balance = get_redis_connection().get(quota_key(username))
+        if balance is None:
+            return _load_balance(username)
+        return max(int(balance), 0)
+    except Exception as e:
+        print(f"Ошибка при получении остатка генераций: {str(e)}")
+        return 0
+
+def set_balance(username: str, generations: int):
+    """Устанавливает остаток генераций (при активации нового токена)"""
+    redis_client = get_redis_connection()
+    pipe = redis_client.pipeline()
+    pipe.set(quota_key(username), max(int(generations), 0))
+    pipe.srem(DIRTY_SET_KEY, username)
+    pipe.execute()
+
+def consume_generation(username: str, amount: int = 1, finalize: bool = True) -> Tuple[bool, int]:
+    """
+    Атомарно проверяет и списывает генерации.
+    Возвращает (списано ли, остаток после операции).
+    При finalize=False токен не деактивируется: генерации списываются до запроса к модели,
+    а завершает списание finalize_generation (или отменяет refund_generation).
+    """
+    script = _get_consume_script()
+    keys = [quota_key(username), DIRTY_SET_KEY]
+
+    result = script(keys=keys, args=[username, amount])
+    if result == NOT_LOADED:
+        _load_balance(username)
+        result = script(keys=keys, args=[username, amount])
+
+    if result < 0:
+        return False, max(int(get_redis_connection().get(quota_key(username)) or 0), 0)
+
+    if finalize:
+        finalize_generation(username, result)
+    return True, result
+
+def finalize_generation(username: str, remaining: int):
+    """Завершение списания: деактивация токена, если генерации закончились"""
+    if remaining <= 0:
+        _deactivate_token(username)
+
+def refund_generation(username: str, amount: int = 1):
+    """Возврат списанных генераций, если ответ не был получен"""
+    try:
+        pipe = get_redis_connection().pipeline()
+        pipe.decrby(quota_key(username), -amount)
+        pipe.sadd(DIRTY_SET_KEY, username)
+        pipe.execute()
+    except Exception as e:
+        print(f"Ошибка при возврате генерации: {str(e)}")
+
+def _deactivate_token(username: str):
+    """Деактивация токена пользователя после списания последней генерации"""
+    db = get_database()
+    now = datetime.now()
+    user = db.users.find_one({"username": username}, {"active_token": 1})
+    if not user or not user.get("active_token"):
+        return
+
+    db.access_tokens.update_one(
+        {"token": user["active_token"]},
+        {"$set": {"used": True, "deactivated_at": now}}
+    )
+    deactivate_token(user["active_token"], reason="generations_depleted", deactivated_at=now)
+    db.users.update_one(
+        {"username": username},
+        {
+            "$set": {
+                "active_token": None,
+                "remaining_generations": 0,
+                "token_deactivated_at": now
+            }
+        }
+    )
+    get_redis_connection().srem(DIRTY_SET_KEY, username)
+    # Токен сменился, поэтому кэш пользователя сбрасывается
+    db.invalidate_user(username)
+
+def flush_dirty_balances(batch_size: int = FLUSH_BATCH_SIZE) -> int:
+    """Переносит измененные остатки в MongoDB пакетами, возвращает число обновленных пользователей"""
+    redis_client = get_redis_connection()
+    db = get_database()
+    flushed = 0
+
+    while True:
+        usernames = redis_client.spop(DIRTY_SET_KEY, batch_size)
+        if not usernames:
+            break
+
+        balances = redis_client.mget([quota_key(u) for u in usernames])
+        now = datetime.now()
+        operations = [
+            UpdateOne(
+                {"username": username},
+                {"$set": {"remaining_generations": int(balance), "last_generation_update": now}}
+            )
+            for username, balance in zip(usernames, balances)
+            if balance is not None
+        ]
+        if operations:
+            try:
+                db.users.bulk_write(operations, ordered=False)
+            except Exception as e:
+                # Возвращаем пользователей в очередь, чтобы не потерять остатки
+                redis_client.sadd(DIRTY_SET_KEY, *usernames)
+                print(f"Ошибка при переносе остатков генераций в MongoDB: {str(e)}")
+                break
+            flushed += len(operations)
+
+        if len(usernames) < batch_size:
+            break
+
+    return flushed
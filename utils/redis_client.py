@@ -1,7 +1,9 @@
-import redis
 import streamlit as st
 import socket
+from functools import lru_cache
+from utils.database.connections import get_redis_connection
 
+@lru_cache(maxsize=1)
 def is_local_environment():
     """Проверяет, запущено ли приложение локально"""
     hostname = socket.gethostname()
@@ -12,35 +14,32 @@ def get_redis_client():
     try:
         if is_local_environment():
             # Для локального тестирования всегда используем in-memory хранилище
-            return InMemoryRedis()
+            return _local_storage
         else:
-            # Для production используем настройки из secrets
-            return redis.Redis(
-                host=st.secrets["redis"]["host"],
-                port=st.secrets["redis"]["port"],
-                password=st.secrets["redis"]["password"],
-                db=st.secrets["redis"]["db"],
-                decode_responses=True
-            )
+            # Для production используем общий пул подключений процесса
+            return get_redis_connection()
     except Exception as e:
         print(f"Ошибка подключения к Redis: {e}")
         if is_local_environment():
-            return InMemoryRedis()
+            return _local_storage
         return None
 
 class InMemoryRedis:
     """Имитация Redis для локального тестирования"""
     def __init__(self):
         self.storage = {}
-        
+
     def setex(self, key, time, value):
         self.storage[key] = value
         return True
-        
+
     def get(self, key):
         return self.storage.get(key)
-        
+
     def delete(self, key):
         if key in self.storage:
             del self.storage[key]
-        return True 
\ No newline at end of file
+        return True
+
+# Единое in-memory хранилище процесса, чтобы данные сессий переживали rerun
+_local_storage = InMemoryRedis()
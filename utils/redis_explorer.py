@@ -0,0 +1,164 @@
+import re
+from itertools import islice
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from utils.database.connections import get_redis_connection, get_redis_binary_connection
+from utils.database import codec
+
+# Просмотр пространства ключей Redis без блокировки сервера:
+# вместо KEYS используется пошаговый SCAN с курсором, сведения о ключах
+# (тип, TTL, размер) запрашиваются одним конвейером на страницу.
+
+KNOWN_PREFIXES = [
+    "session:",
+    "user:",
+    "chat_history:",
+    "chat_sessions:",
+    "chat_sessions_indexed:",
+    "chat_session_meta:",
+    "chat_session_messages:",
+    "chat_session_deleted:",
+    "chat_sessions_compact",
+    "translation:",
+    "quota:",
+    "tokens:",
+    "token_",
+    "sessions_",
+    "maintenance:"
+]
+
+# Значения этих ключей записаны в формате utils.database.codec (двоичные)
+CODEC_PREFIXES = ("user:", "chat_history:", "chat_session_messages:")
+
+# Сессии в старом формате: {username}_{flow_id}_{session_id}
+LEGACY_SESSION_PATTERN = re.compile(r"^.+_[0-9a-f\-]{8,}_[0-9a-f\-]{8,}$")
+LEGACY_SESSION_GROUP = "{username}_{flow_id}_{session_id}"
+OTHER_GROUP = "прочее"
+
+# Предел вызовов SCAN на одну страницу: при редких совпадениях MATCH
+# страница возвращается неполной вместе с курсором для продолжения
+SCAN_MAX_ITERATIONS = 15
+
+def key_group(key: str) -> str:
+    """Группа ключа по префиксу"""
+    for prefix in KNOWN_PREFIXES:
+        if key.startswith(prefix):
+            return prefix
+    if LEGACY_SESSION_PATTERN.match(key):
+        return LEGACY_SESSION_GROUP
+    return OTHER_GROUP
+
+def _describe_keys(keys: List[str]) -> List[Dict]:
+    """Тип, TTL и размер ключей одним конвейером"""
+    if not keys:
+        return []
+    redis_client = get_redis_connection()
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.type(key)
+        pipe.ttl(key)
+        pipe.memory_usage(key)
+    results = pipe.execute(raise_on_error=False)
+
+    rows = []
+    for i, key in enumerate(keys):
+        key_type, ttl, memory = results[i * 3:i * 3 + 3]
+        rows.append({
+            "key": key,
+            "type": key_type if not isinstance(key_type, Exception) else "?",
+            "ttl": ttl if not isinstance(ttl, Exception) else None,
+            "memory_bytes": memory if not isinstance(memory, Exception) else None
+        })
+    return rows
+
+def scan_page(match: str = "*", cursor: int = 0, count: int = 100,
+              max_iterations: int = SCAN_MAX_ITERATIONS) -> Tuple[int, List[Dict]]:
+    """
+    Одна страница SCAN с описанием ключей.
+    Возвращает (курсор следующей страницы, ключи); курсор 0 означает, что обход завершен.
+    SCAN может вернуть меньше ключей, чем count, поэтому запросы повторяются
+    до заполнения страницы, конца обхода или max_iterations вызовов.
+    """
+    redis_client = get_redis_connection()
+    keys = []
+    for _ in range(max_iterations):
+        cursor, batch = redis_client.scan(cursor=cursor, match=match or "*", count=count)
+        keys.extend(batch)
+        if cursor == 0 or len(keys) >= count:
+            break
+    return cursor, _describe_keys(keys)
+
+def sample_memory_by_prefix(sample_size: int = 1000) -> Dict:
+    """
+    Оценка памяти по группам ключей по случайной выборке (RANDOMKEY).
+    Итог по группе экстраполируется на весь объем базы (DBSIZE).
+    """
+    redis_client = get_redis_connection()
+    total_keys = redis_client.dbsize()
+    if not total_keys:
+        return {"total_keys": 0, "sampled": 0, "groups": []}
+
+    pipe = redis_client.pipeline(transaction=False)
+    for _ in range(min(sample_size, total_keys)):
+        pipe.randomkey()
+    sampled_keys = list({key for key in pipe.execute() if key})
+
+    pipe = redis_client.pipeline(transaction=False)
+    for key in sampled_keys:
+        pipe.memory_usage(key)
+    sizes = pipe.execute(raise_on_error=False)
+
+    groups = defaultdict(lambda: {"keys": 0, "bytes": 0})
+    for key, size in zip(sampled_keys, sizes):
+        group = groups[key_group(key)]
+        group["keys"] += 1
+        group["bytes"] += size if isinstance(size, int) else 0
+
+    sampled = len(sampled_keys)
+    scale = total_keys / sampled if sampled else 0
+    rows = [
+        {
+            "group": name,
+            "sampled_keys": stats["keys"],
+            "sampled_bytes": stats["bytes"],
+            "avg_bytes": round(stats["bytes"] / stats["keys"]) if stats["keys"] else 0,
+            "estimated_keys": round(stats["keys"] * scale),
+            "estimated_bytes": round(stats["bytes"] * scale)
+        }
+        for name, stats in groups.items()
+    ]
+    rows.sort(key=lambda row: row["estimated_bytes"], reverse=True)
+    return {"total_keys": total_keys, "sampled": sampled, "groups": rows}
+
+def _decode_value(key: str, raw: bytes):
+    """Значение ключа: формат codec для известных префиксов, иначе текст"""
+    if key.startswith(CODEC_PREFIXES):
+        return codec.decode(raw)
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        # Значения кэша (cache_set, cache_handler) тоже хранятся в формате codec
+        return codec.decode(raw)
+
+def read_value(key: str, limit: int = 50):
+    """
+    Значение ключа для просмотра: строка, первые limit элементов списка или поля HASH.
+    Читается двоичным клиентом, чтобы не падать на значениях в формате codec.
+    """
+    binary_client = get_redis_binary_connection()
+    key_type = binary_client.type(key).decode()
+    if key_type == "string":
+        return _decode_value(key, binary_client.get(key))
+    if key_type == "list":
+        return [_decode_value(key, raw) for raw in binary_client.lrange(key, 0, limit - 1)]
+    if key_type == "hash":
+        return {
+            field.decode("utf-8", "replace"): value.decode("utf-8", "replace")
+            for field, value in binary_client.hgetall(key).items()
+        }
+    if key_type == "set":
+        members = islice(binary_client.sscan_iter(key, count=limit), limit)
+        return sorted(member.decode("utf-8", "replace") for member in members)
+    if key_type == "none":
+        return None
+    return f"<{key_type}>"
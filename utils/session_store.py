@@ -0,0 +1,426 @@
+import json
+import uuid
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from utils.database.connections import get_redis_connection, get_redis_binary_connection
+from utils.database import codec
+
+# Хранилище сессий страницы "Личный помощник" в Redis.
+#
+# chat_sessions:{username}:{flow_id}                      - ZSET: session_id -> время создания
+# chat_session_meta:{username}:{flow_id}:{session_id}     - HASH: display_name, created_at,
+#                                                           updated_at, message_count, next_seq,
+#                                                           visible_from
+# chat_session_messages:{username}:{flow_id}:{session_id} - LIST: по одному сообщению на элемент
+#                                                           (формат utils.database.codec)
+# chat_session_deleted:{username}:{flow_id}:{session_id}  - SET: id удаленных сообщений
+# chat_sessions_compact                                   - SET: сессии, ожидающие сжатия
+#
+# Список сессий строится по индексу, без SCAN по всему пространству ключей.
+# Метаданные хранятся отдельно от сообщений: переименование и получение списка
+# не читают сообщения, а добавление сообщения - это RPUSH в конец списка.
+# Старый формат ({username}_{flow_id}_{session_id} - JSON со всеми сообщениями)
+# переносится в новый при первом чтении сессии.
+# При записи сообщению присваиваются неизменяемый id и порядковый номер seq;
+# по id сообщение находится при отображении и удалении.
+#
+# Удаление и очистка не перезаписывают список: удаленное сообщение попадает в SET
+# chat_session_deleted, очистка переносит указатель visible_from на следующий номер.
+# Скрытые элементы убирает из списка compact_sessions (фоновое обслуживание).
+
+PRIMARY_SESSION_NAME = "Основная сессия"
+COMPACT_QUEUE_KEY = "chat_sessions_compact"
+
+# Добавление сообщений: номера seq и RPUSH выполняются одной операцией, поэтому
+# порядок элементов списка всегда совпадает с порядком номеров. Сообщения кодируются
+# заранее с номерами от ожидаемого next_seq (ARGV[1]); если другой запрос успел
+# добавить сообщения раньше, ничего не записывается и возвращается текущий next_seq.
+# Для сессий без счетчика нумерация продолжается с текущей длины списка.
+_APPEND_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'next_seq') == 0 then
+    redis.call('HSET', KEYS[1], 'next_seq', redis.call('LLEN', KEYS[2]))
+end
+local next_seq = tonumber(redis.call('HGET', KEYS[1], 'next_seq'))
+if next_seq ~= tonumber(ARGV[1]) then
+    return {0, next_seq}
+end
+local count = #ARGV - 2
+redis.call('RPUSH', KEYS[2], unpack(ARGV, 3))
+redis.call('HINCRBY', KEYS[1], 'next_seq', count)
+redis.call('HINCRBY', KEYS[1], 'message_count', count)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[2])
+return {1, next_seq}
+"""
+APPEND_MAX_RETRIES = 10
+
+# Удаление сообщения: отметка в SET. Счетчик уменьшается только для видимого сообщения
+# (номер не меньше visible_from и уже выдан) и только при первой отметке.
+_DELETE_SCRIPT = """
+local seq = tonumber(ARGV[4])
+local visible_from = tonumber(redis.call('HGET', KEYS[1], 'visible_from') or '-1')
+local next_seq = tonumber(redis.call('HGET', KEYS[1], 'next_seq') or '0')
+if seq < visible_from or seq >= next_seq then
+    return 0
+end
+if redis.call('SADD', KEYS[2], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'message_count', -1)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[2])
+redis.call('SADD', KEYS[3], ARGV[3])
+return 1
+"""
+
+# Очистка: сообщения с номером меньше visible_from скрываются
+_CLEAR_SCRIPT = """
+if redis.call('HEXISTS', KEYS[1], 'next_seq') == 0 then
+    redis.call('HSET', KEYS[1], 'next_seq', redis.call('LLEN', KEYS[2]))
+end
+local next_seq = redis.call('HGET', KEYS[1], 'next_seq')
+redis.call('HSET', KEYS[1], 'visible_from', next_seq, 'message_count', 0, 'updated_at', ARGV[1])
+redis.call('DEL', KEYS[3])
+redis.call('SADD', KEYS[4], ARGV[2])
+return tonumber(next_seq)
+"""
+
+_script_lock = threading.Lock()
+_scripts = {}
+
+def _get_script(source: str):
+    """Lua-скрипт, зарегистрированный один раз на процесс"""
+    script = _scripts.get(source)
+    if script is None:
+        with _script_lock:
+            script = _scripts.get(source)
+            if script is None:
+                script = get_redis_connection().register_script(source)
+                _scripts[source] = script
+    return script
+
+def new_message_id() -> str:
+    """Неизменяемый идентификатор сообщения"""
+    return uuid.uuid4().hex
+
+def index_key(username: str, flow_id: str) -> str:
+    """Ключ индекса сессий пользователя в чат-потоке"""
+    return f"chat_sessions:{username}:{flow_id}"
+
+def meta_key(username: str, flow_id: str, session_id: str) -> str:
+    """Ключ метаданных сессии"""
+    return f"chat_session_meta:{username}:{flow_id}:{session_id}"
+
+def messages_key(username: str, flow_id: str, session_id: str) -> str:
+    """Ключ списка сообщений сессии"""
+    return f"chat_session_messages:{username}:{flow_id}:{session_id}"
+
+def deleted_key(username: str, flow_id: str, session_id: str) -> str:
+    """Ключ множества id удаленных сообщений сессии"""
+    return f"chat_session_deleted:{username}:{flow_id}:{session_id}"
+
+def legacy_key(username: str, flow_id: str, session_id: str) -> str:
+    """Ключ сессии в старом формате (сообщения и имя в одном JSON)"""
+    return f"{username}_{flow_id}_{session_id}"
+
+def _indexed_marker_key(username: str, flow_id: str) -> str:
+    """Отметка о том, что старые сессии уже перенесены в индекс"""
+    return f"chat_sessions_indexed:{username}:{flow_id}"
+
+def register_session(username: str, flow_id: str, session_id: str,
+                     display_name: Optional[str] = None, created_at: Optional[datetime] = None):
+    """Добавляет сессию в индекс (существующие данные не перезаписываются)"""
+    redis_client = get_redis_connection()
+    pipe = redis_client.pipeline()
+    _register_in_pipeline(pipe, username, flow_id, session_id, display_name, created_at)
+    pipe.execute()
+
+def _register_in_pipeline(pipe, username: str, flow_id: str, session_id: str,
+                          display_name: Optional[str] = None, created_at: Optional[datetime] = None):
+    """Команды регистрации сессии в индексе (выполняются в составе конвейера)"""
+    created_at = created_at or datetime.now()
+    key = meta_key(username, flow_id, session_id)
+    pipe.zadd(index_key(username, flow_id), {session_id: created_at.timestamp()}, nx=True)
+    pipe.hsetnx(key, "created_at", created_at.isoformat())
+    pipe.hsetnx(key, "display_name", display_name or f"Сессия {session_id[:8]}")
+
+def _build_index_from_legacy(username: str, flow_id: str):
+    """Однократный перенос сессий, созданных до появления индекса"""
+    redis_client = get_redis_connection()
+    marker = _indexed_marker_key(username, flow_id)
+    if redis_client.exists(marker):
+        return
+
+    prefix = f"{username}_{flow_id}_"
+    for key in redis_client.scan_iter(f"{prefix}*", count=500):
+        session_id = key[len(prefix):]
+        try:
+            data = json.loads(redis_client.get(key) or "{}")
+            created_at = datetime.fromisoformat(data["created_at"]) if data.get("created_at") else None
+        except Exception as e:
+            print(f"Ошибка чтения старой сессии {key}: {e}")
+            data, created_at = {}, None
+        register_session(username, flow_id, session_id, data.get("display_name"), created_at)
+
+    redis_client.set(marker, 1)
+
+def list_sessions(username: str, flow_id: str) -> List[Dict]:
+    """Список сессий в порядке создания: одна выборка индекса и один конвейер HGETALL"""
+    redis_client = get_redis_connection()
+    _build_index_from_legacy(username, flow_id)
+
+    session_ids = redis_client.zrange(index_key(username, flow_id), 0, -1)
+    if not session_ids:
+        return []
+
+    pipe = redis_client.pipeline()
+    for session_id in session_ids:
+        pipe.hgetall(meta_key(username, flow_id, session_id))
+    metas = pipe.execute()
+
+    sessions = []
+    for i, (session_id, meta) in enumerate(zip(session_ids, metas)):
+        sessions.append({
+            'id': session_id,
+            'display_name': PRIMARY_SESSION_NAME if i == 0 else meta.get('display_name', f"Сессия {i + 1}"),
+            'created_at': meta.get('created_at'),
+            'updated_at': meta.get('updated_at'),
+            'message_count': int(meta.get('message_count', 0)),
+            'is_primary': i == 0
+        })
+    return sessions
+
+def get_display_name(username: str, flow_id: str, session_id: str) -> str:
+    """Отображаемое имя сессии"""
+    redis_client = get_redis_connection()
+    name = redis_client.hget(meta_key(username, flow_id, session_id), "display_name")
+    return name or f"Сессия {session_id}"
+
+def rename_session(username: str, flow_id: str, session_id: str, new_name: str):
+    """Переименование сессии: меняется только запись метаданных"""
+    redis_client = get_redis_connection()
+    redis_client.hset(meta_key(username, flow_id, session_id), "display_name", new_name)
+
+def delete_session(username: str, flow_id: str, session_id: str) -> bool:
+    """Удаление сессии вместе с записью в индексе"""
+    redis_client = get_redis_connection()
+    pipe = redis_client.pipeline()
+    pipe.zrem(index_key(username, flow_id), session_id)
+    pipe.delete(
+        meta_key(username, flow_id, session_id),
+        messages_key(username, flow_id, session_id),
+        deleted_key(username, flow_id, session_id),
+        legacy_key(username, flow_id, session_id)
+    )
+    removed, _ = pipe.execute()
+    return bool(removed)
+
+def _migrate_legacy_messages(username: str, flow_id: str, session_id: str) -> List[Dict]:
+    """Перенос сообщений сессии из старого JSON в список"""
+    redis_client = get_redis_connection()
+    data = redis_client.get(legacy_key(username, flow_id, session_id))
+    messages = json.loads(data).get('messages', []) if data else []
+    # Старым сообщениям id и номера присваиваются при переносе
+    messages = [
+        {**m, "id": m.get("id") or new_message_id(), "seq": i}
+        for i, m in enumerate(messages)
+    ]
+
+    pipe = redis_client.pipeline()
+    _register_in_pipeline(pipe, username, flow_id, session_id)
+    pipe.delete(messages_key(username, flow_id, session_id))
+    if messages:
+        pipe.rpush(messages_key(username, flow_id, session_id), *[codec.encode(m) for m in messages])
+    pipe.hset(meta_key(username, flow_id, session_id), mapping={
+        "message_count": len(messages),
+        "next_seq": len(messages)
+    })
+    pipe.delete(legacy_key(username, flow_id, session_id))
+    pipe.execute()
+    return messages
+
+def _visible_filter(visible_from, deleted) -> Callable[[Dict], bool]:
+    """Проверка видимости сообщения по указателю visible_from и множеству удаленных id"""
+    visible_from = int(visible_from) if visible_from is not None else -1
+    deleted = {d.decode() if isinstance(d, bytes) else d for d in deleted or ()}
+
+    def is_visible(message: Dict) -> bool:
+        return message.get("seq", -1) >= visible_from and message.get("id") not in deleted
+    return is_visible
+
+def load_messages(username: str, flow_id: str, session_id: str, start: int = 0, end: int = -1) -> List[Dict]:
+    """Чтение видимых сообщений сессии (диапазон позиций как в LRANGE)"""
+    # Сообщения читаются двоичным клиентом: значения в формате codec
+    redis_client = get_redis_binary_connection()
+    pipe = redis_client.pipeline()
+    pipe.lrange(messages_key(username, flow_id, session_id), start, end)
+    pipe.hmget(meta_key(username, flow_id, session_id), "message_count", "visible_from")
+    pipe.smembers(deleted_key(username, flow_id, session_id))
+    raw_messages, (migrated, visible_from), deleted = pipe.execute()
+
+    if migrated is None:
+        messages = _migrate_legacy_messages(username, flow_id, session_id)
+        return messages[start:] if end == -1 else messages[start:end + 1]
+    is_visible = _visible_filter(visible_from, deleted)
+    return [m for m in (codec.decode(raw) for raw in raw_messages) if is_visible(m)]
+
+def load_recent_messages(username: str, flow_id: str, session_id: str, count: int) -> Tuple[List[Dict], int]:
+    """
+    Последние count видимых сообщений сессии и общее количество видимых сообщений.
+    Если среди последних элементов есть скрытые, более ранние дочитываются.
+    """
+    redis_client = get_redis_binary_connection()
+    key = messages_key(username, flow_id, session_id)
+    pipe = redis_client.pipeline()
+    pipe.lrange(key, -count, -1)
+    pipe.llen(key)
+    pipe.hmget(meta_key(username, flow_id, session_id), "message_count", "visible_from")
+    pipe.smembers(deleted_key(username, flow_id, session_id))
+    raw_messages, length, (total, visible_from), deleted = pipe.execute()
+
+    if total is None:
+        messages = _migrate_legacy_messages(username, flow_id, session_id)
+        return messages[-count:], len(messages)
+
+    is_visible = _visible_filter(visible_from, deleted)
+    decoded = [codec.decode(raw) for raw in raw_messages]
+    messages = [m for m in decoded if is_visible(m)]
+    fetched = len(raw_messages)
+    # Элементы до visible_from идут в начале списка: дальше них читать не нужно
+    reached_hidden_prefix = bool(decoded) and not _visible_filter(visible_from, ())(decoded[0])
+    while len(messages) < count and fetched < length and not reached_hidden_prefix:
+        missing = count - len(messages)
+        earlier = [codec.decode(raw) for raw in redis_client.lrange(key, -(fetched + missing), -(fetched + 1))]
+        if not earlier:
+            break
+        fetched += len(earlier)
+        reached_hidden_prefix = not _visible_filter(visible_from, ())(earlier[0])
+        messages = [m for m in earlier if is_visible(m)] + messages
+
+    return messages, max(int(total), len(messages))
+
+def append_messages(username: str, flow_id: str, session_id: str, new_messages: List[Dict]) -> List[Dict]:
+    """
+    Добавление сообщений в конец сессии без чтения и перезаписи истории.
+    Возвращает сохраненные сообщения с присвоенными id и seq.
+    """
+    if not new_messages:
+        return []
+    redis_client = get_redis_connection()
+    key = meta_key(username, flow_id, session_id)
+    messages = [{**message, "id": message.get("id") or new_message_id()} for message in new_messages]
+
+    pipe = redis_client.pipeline()
+    _register_in_pipeline(pipe, username, flow_id, session_id)
+    pipe.hget(key, "next_seq")
+    expected = pipe.execute()[-1]
+    expected = int(expected) if expected is not None else -1
+
+    append = _get_script(_APPEND_SCRIPT)
+    for _ in range(APPEND_MAX_RETRIES):
+        stored = [{**message, "seq": expected + i} for i, message in enumerate(messages)]
+        appended, next_seq = append(
+            keys=[key, messages_key(username, flow_id, session_id)],
+            args=[expected, datetime.now().isoformat(), *[codec.encode(m) for m in stored]]
+        )
+        if appended:
+            return stored
+        # Номера заняты параллельной записью: кодируем заново от актуального next_seq
+        expected = int(next_seq)
+    raise RuntimeError(f"Не удалось добавить сообщения в сессию {session_id}: "
+                       f"номера заняты параллельными записями")
+
+def replace_messages(username: str, flow_id: str, session_id: str, messages: List[Dict],
+                     display_name: Optional[str] = None):
+    """Полная замена сообщений сессии (используется при создании сессии)"""
+    redis_client = get_redis_connection()
+    key = meta_key(username, flow_id, session_id)
+    pipe = redis_client.pipeline()
+    _register_in_pipeline(pipe, username, flow_id, session_id, display_name)
+    pipe.delete(
+        messages_key(username, flow_id, session_id),
+        deleted_key(username, flow_id, session_id),
+        legacy_key(username, flow_id, session_id)
+    )
+    pipe.hdel(key, "visible_from")
+    messages = [m if m.get("id") else {**m, "id": new_message_id()} for m in messages]
+    if messages:
+        pipe.rpush(messages_key(username, flow_id, session_id), *[codec.encode(m) for m in messages])
+    pipe.hset(key, mapping={
+        "message_count": len(messages),
+        "updated_at": datetime.now().isoformat()
+    })
+    pipe.execute()
+
+def delete_message(username: str, flow_id: str, session_id: str, message: Dict) -> bool:
+    """
+    Удаление сообщения по id: отметка в множестве удаленных, список не изменяется.
+    Номер seq нужен, чтобы не учитывать сообщения, скрытые очисткой, и чужие id.
+    """
+    if not message.get("id") or message.get("seq") is None:
+        return False
+    deleted = _get_script(_DELETE_SCRIPT)(
+        keys=[
+            meta_key(username, flow_id, session_id),
+            deleted_key(username, flow_id, session_id),
+            COMPACT_QUEUE_KEY
+        ],
+        args=[
+            message["id"],
+            datetime.now().isoformat(),
+            json.dumps([username, flow_id, session_id]),
+            int(message["seq"])
+        ]
+    )
+    return bool(deleted)
+
+def clear_messages(username: str, flow_id: str, session_id: str):
+    """Очистка истории сессии переносом указателя visible_from (список не изменяется)"""
+    _get_script(_CLEAR_SCRIPT)(
+        keys=[
+            meta_key(username, flow_id, session_id),
+            messages_key(username, flow_id, session_id),
+            legacy_key(username, flow_id, session_id),
+            COMPACT_QUEUE_KEY
+        ],
+        args=[datetime.now().isoformat(), json.dumps([username, flow_id, session_id])]
+    )
+
+def compact_sessions() -> int:
+    """
+    Удаляет из списков сообщения, скрытые очисткой или удалением.
+    Скрытое начало списка обрезается LTRIM, удаленные сообщения убираются LREM по значению,
+    поэтому сообщения, добавленные во время сжатия, не теряются.
+    Возвращает число удаленных элементов.
+    """
+    redis_client = get_redis_connection()
+    binary_client = get_redis_binary_connection()
+    removed = 0
+
+    for member in redis_client.smembers(COMPACT_QUEUE_KEY):
+        redis_client.srem(COMPACT_QUEUE_KEY, member)
+        username, flow_id, session_id = json.loads(member)
+        key = messages_key(username, flow_id, session_id)
+        visible_from = redis_client.hget(meta_key(username, flow_id, session_id), "visible_from")
+        deleted = redis_client.smembers(deleted_key(username, flow_id, session_id))
+        is_after_clear = _visible_filter(visible_from, ())
+
+        hidden_prefix = 0
+        deleted_raw = []
+        for raw in binary_client.lrange(key, 0, -1):
+            message = codec.decode(raw)
+            if not is_after_clear(message):
+                hidden_prefix += 1
+            elif message.get("id") in deleted:
+                deleted_raw.append(raw)
+
+        pipe = binary_client.pipeline()
+        if hidden_prefix:
+            pipe.ltrim(key, hidden_prefix, -1)
+        for raw in deleted_raw:
+            pipe.lrem(key, 1, raw)
+        if deleted:
+            pipe.srem(deleted_key(username, flow_id, session_id), *deleted)
+        pipe.execute()
+        removed += hidden_prefix + len(deleted_raw)
+
+    return removed
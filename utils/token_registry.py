@@ -0,0 +1,341 @@
+import os
+import re
+import io
+import csv
+import json
+import secrets
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from utils.database.connections import get_redis_connection
+from utils.database.database_manager import get_database
+
+# Реестр состояния токенов доступа.
+#
+# MongoDB access_tokens       - выпущенные токены (уникальный индекс по token)
+# MongoDB deactivated_tokens  - деактивированные токены (уникальный индекс по token)
+# Redis tokens:deactivated    - SET деактивированных токенов для проверки за O(1)
+# Redis tokens:deactivated:loaded - отметка, что SET заполнен из MongoDB и полон
+#
+# Заменяет файлы chat/access_keys.json и chat/deactivated_keys.json, которые
+# читались и перезаписывались целиком при каждой проверке и изменении.
+
+DEACTIVATED_SET_KEY = "tokens:deactivated"
+DEACTIVATED_LOADED_KEY = "tokens:deactivated:loaded"
+WARMUP_BATCH_SIZE = 1000
+
+MINT_CHUNK_SIZE = 1000
+MINT_MAX_RETRIES = 5          # повторы пачек, в которых сгенерировались повторяющиеся токены
+DUPLICATE_KEY_ERROR = 11000
+TOKEN_CACHE_TTL = 86400   # кэш выпущенного токена в Redis, секунд
+
+CHAT_DIR = os.path.join(os.path.dirname(__file__), '..', 'chat')
+
+def _normalize(token: str) -> str:
+    """Токены в старых файлах могли храниться в кавычках"""
+    return token.strip().strip('"')
+
+def _warm_deactivated_set():
+    """Заполняет SET деактивированных токенов из MongoDB, если он еще не заполнен"""
+    redis_client = get_redis_connection()
+    if redis_client.exists(DEACTIVATED_LOADED_KEY):
+        return
+
+    db = get_database()
+    batch = []
+    for doc in db.deactivated_tokens.find({}, {"token": 1, "_id": 0}):
+        batch.append(doc["token"])
+        if len(batch) >= WARMUP_BATCH_SIZE:
+            redis_client.sadd(DEACTIVATED_SET_KEY, *batch)
+            batch = []
+    if batch:
+        redis_client.sadd(DEACTIVATED_SET_KEY, *batch)
+    redis_client.set(DEACTIVATED_LOADED_KEY, 1)
+
+def is_token_deactivated(token: str) -> bool:
+    """Проверка, был ли токен деактивирован"""
+    token = _normalize(token)
+    try:
+        _warm_deactivated_set()
+        return bool(get_redis_connection().sismember(DEACTIVATED_SET_KEY, token))
+    except Exception as e:
+        print(f"Ошибка при проверке токена в Redis: {str(e)}")
+        # Запасной путь: точечный запрос по уникальному индексу
+        return get_database().deactivated_tokens.find_one({"token": token}, {"_id": 1}) is not None
+
+def deactivate_token(token: str, reason: str = "generations_depleted",
+                     deactivated_at: Optional[datetime] = None) -> bool:
+    """Помечает токен деактивированным"""
+    token = _normalize(token)
+    try:
+        db = get_database()
+        db.deactivated_tokens.update_one(
+            {"token": token},
+            {"$setOnInsert": {
+                "token": token,
+                "deactivated_at": deactivated_at or datetime.now(),
+                "reason": reason
+            }},
+            upsert=True
+        )
+        get_redis_connection().sadd(DEACTIVATED_SET_KEY, token)
+        return True
+    except Exception as e:
+        print(f"Ошибка при деактивации токена: {str(e)}")
+        return False
+
+def register_token(token: str, generations: int = 500, activated_at: Optional[datetime] = None) -> bool:
+    """Регистрирует выпущенный токен (повторная регистрация не меняет существующую запись)"""
+    token = _normalize(token)
+    if is_token_deactivated(token):
+        print(f"Попытка повторного использования деактивированного токена: {token}")
+        return False
+    try:
+        now = datetime.now()
+        fields = {
+            "token": token,
+            "total_generations": generations,
+            "remaining_generations": generations,
+            "used": False,
+            "created_at": now,
+            "has_time_limit": False,
+            "expires_at": None
+        }
+        if activated_at:
+            fields["activated_at"] = activated_at
+        get_database().access_tokens.update_one(
+            {"token": token},
+            {"$setOnInsert": fields},
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        print(f"Ошибка при регистрации токена: {str(e)}")
+        return False
+
+def remove_token(token: str) -> bool:
+    """Удаляет токен из выпущенных вместе с его кэшем"""
+    token = _normalize(token)
+    try:
+        result = get_database().access_tokens.delete_one({"token": token})
+        get_redis_connection().delete(f"token_{token}")
+        return result.deleted_count > 0
+    except Exception as e:
+        print(f"Ошибка при удалении токена: {str(e)}")
+        return False
+
+def list_unused_tokens() -> List[str]:
+    """Неиспользованные выпущенные токены"""
+    cursor = get_database().access_tokens.find({"used": False}, {"token": 1, "_id": 0})
+    return [doc["token"] for doc in cursor]
+
+def token_generations(token_data: Dict) -> int:
+    """Количество генераций токена (в старых записях поле называлось generations)"""
+    return int(token_data.get("total_generations", token_data.get("generations", 0)))
+
+def generate_secure_token() -> str:
+    """Генерация криптографически безопасного токена"""
+    return secrets.token_hex(32)  # 256-bit token
+
+def serialize_token_data(token_data: dict) -> str:
+    """Безопасная сериализация данных токена в JSON"""
+    serializable_data = token_data.copy()
+    serializable_data.pop("_id", None)
+    for key, value in serializable_data.items():
+        if isinstance(value, datetime):
+            serializable_data[key] = value.isoformat()
+    return json.dumps(serializable_data)
+
+def mint_tokens(count: int, generations: int, expires_at: Optional[datetime] = None,
+                created_by: Optional[str] = None, chunk_size: int = MINT_CHUNK_SIZE,
+                progress_callback: Optional[Callable[[int, int], None]] = None) -> List[Dict]:
+    """
+    Массовый выпуск токенов.
+    Токены пишутся пачками через insert_many(ordered=False) и кэшируются в Redis
+    одним конвейером на пачку. progress_callback(выпущено, всего) вызывается после каждой пачки.
+    Повторяющиеся токены перевыпускаются (не более MINT_MAX_RETRIES раз), остальные ошибки
+    записи пробрасываются.
+    """
+    db = get_database()
+    redis_client = get_redis_connection()
+    minted = []
+    retries = 0
+
+    while len(minted) < count:
+        now = datetime.now()
+        chunk = [
+            {
+                "token": generate_secure_token(),
+                "total_generations": generations,
+                "remaining_generations": generations,
+                "used": False,
+                "created_at": now,
+                "has_time_limit": expires_at is not None,
+                "expires_at": expires_at,
+                "created_by": created_by
+            }
+            for _ in range(min(chunk_size, count - len(minted)))
+        ]
+
+        write_error = None
+        try:
+            db.access_tokens.insert_many(chunk, ordered=False)
+            inserted = chunk
+        except BulkWriteError as e:
+            # При unordered-вставке остальные документы пачки записаны
+            errors = e.details.get("writeErrors", [])
+            failed = {error["index"] for error in errors}
+            inserted = [doc for i, doc in enumerate(chunk) if i not in failed]
+            if any(error.get("code") != DUPLICATE_KEY_ERROR for error in errors):
+                write_error = e
+            else:
+                retries += 1
+                if retries > MINT_MAX_RETRIES:
+                    write_error = e
+
+        pipe = redis_client.pipeline(transaction=False)
+        for doc in inserted:
+            pipe.setex(f"token_{doc['token']}", TOKEN_CACHE_TTL, serialize_token_data(doc))
+        pipe.execute()
+
+        minted.extend(inserted)
+        if progress_callback:
+            progress_callback(len(minted), count)
+        if write_error is not None:
+            # Записанные токены уже в кэше; об остальных сообщаем вызывающему коду
+            raise write_error
+
+    return minted
+
+def tokens_to_csv(tokens: List[Dict]) -> str:
+    """CSV со списком выпущенных токенов"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["token", "generations", "expires_at", "created_at"])
+    for doc in tokens:
+        writer.writerow([
+            doc["token"],
+            doc["total_generations"],
+            doc["expires_at"].isoformat() if doc.get("expires_at") else "",
+            doc["created_at"].isoformat()
+        ])
+    return output.getvalue()
+
+TOKEN_LIST_PROJECTION = {
+    "token": 1,
+    "total_generations": 1,
+    "remaining_generations": 1,
+    "generations": 1,
+    "used": 1,
+    "has_time_limit": 1,
+    "expires_at": 1,
+    "created_at": 1
+}
+
+def _token_filter(status: str = "all", prefix: str = "") -> Dict:
+    """Фильтр списка токенов по состоянию и началу токена"""
+    query = {}
+    if status == "unused":
+        query["used"] = False
+    elif status == "used":
+        query["used"] = True
+    elif status == "expired":
+        query["has_time_limit"] = True
+        query["expires_at"] = {"$lt": datetime.utcnow()}
+    elif status == "time_limited":
+        query["has_time_limit"] = True
+    prefix = prefix.strip().lower()
+    if prefix:
+        # Токены - hex-строки; якорный regex использует индекс по token
+        query["token"] = {"$regex": f"^{re.escape(prefix)}"}
+    return query
+
+def find_tokens_page(status: str = "all", prefix: str = "", after: Optional[Tuple[datetime, object]] = None,
+                     page_size: int = 50) -> Tuple[List[Dict], Optional[Tuple[datetime, object]]]:
+    """
+    Страница списка токенов, новые сначала.
+    Вместо skip используется диапазонный запрос по (created_at, _id) от последнего
+    токена предыдущей страницы. Возвращает (токены, курсор следующей страницы или None).
+    """
+    query = _token_filter(status, prefix)
+    if after is not None:
+        created_at, last_id = after
+        query = {"$and": [query, {"$or": [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": last_id}}
+        ]}]}
+
+    tokens = list(
+        get_database().access_tokens
+        .find(query, TOKEN_LIST_PROJECTION)
+        .sort([("created_at", -1), ("_id", -1)])
+        .limit(page_size + 1)
+    )
+    next_cursor = None
+    if len(tokens) > page_size:
+        tokens = tokens[:page_size]
+        next_cursor = (tokens[-1]["created_at"], tokens[-1]["_id"])
+    return tokens, next_cursor
+
+def migrate_json_files(chat_dir: str = CHAT_DIR) -> Dict[str, int]:
+    """
+    Однократный перенос chat/access_keys.json и chat/deactivated_keys.json в реестр.
+    Повторный запуск безопасен: существующие записи не перезаписываются.
+    """
+    db = get_database()
+    result = {"access_tokens": 0, "deactivated_tokens": 0}
+
+    keys_file = os.path.join(chat_dir, 'access_keys.json')
+    if os.path.exists(keys_file):
+        with open(keys_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        generations = data.get("generations", {})
+        activation_dates = data.get("activation_dates", {})
+        operations = []
+        for raw_token in data.get("keys", []):
+            token = _normalize(raw_token)
+            count = generations.get(raw_token, generations.get(token, 500))
+            activated_at = activation_dates.get(raw_token) or activation_dates.get(token)
+            fields = {
+                "token": token,
+                "total_generations": count,
+                "remaining_generations": count,
+                "used": False,
+                "created_at": datetime.now(),
+                "has_time_limit": False,
+                "expires_at": None
+            }
+            if activated_at:
+                fields["activated_at"] = datetime.fromisoformat(activated_at)
+            operations.append(UpdateOne({"token": token}, {"$setOnInsert": fields}, upsert=True))
+        if operations:
+            result["access_tokens"] = db.access_tokens.bulk_write(operations, ordered=False).upserted_count
+
+    deactivated_file = os.path.join(chat_dir, 'deactivated_keys.json')
+    if os.path.exists(deactivated_file):
+        with open(deactivated_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        operations = []
+        for info in data.get("deactivated_keys", []):
+            token = _normalize(info["token"])
+            deactivated_at = info.get("deactivated_at")
+            operations.append(UpdateOne(
+                {"token": token},
+                {"$setOnInsert": {
+                    "token": token,
+                    "deactivated_at": datetime.fromisoformat(deactivated_at) if deactivated_at else datetime.now(),
+                    "reason": info.get("reason", "generations_depleted")
+                }},
+                upsert=True
+            ))
+        if operations:
+            result["deactivated_tokens"] = db.deactivated_tokens.bulk_write(operations, ordered=False).upserted_count
+
+    # SET в Redis будет заново заполнен из MongoDB при следующей проверке
+    get_redis_connection().delete(DEACTIVATED_LOADED_KEY)
+    return result
+
+if __name__ == "__main__":
+    migrated = migrate_json_files()
+    print(f"Перенесено токенов: {migrated['access_tokens']}, деактивированных: {migrated['deactivated_tokens']}")
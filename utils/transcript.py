@@ -0,0 +1,118 @@
+import hashlib
+import streamlit as st
+from typing import Callable, Dict, List, Tuple
+
+# Отображение истории чата окном последних сообщений.
+#
+# За один перезапуск выводятся только последние visible сообщений сессии (по умолчанию
+# INITIAL_WINDOW), более ранние подгружаются кнопкой по LOAD_MORE_STEP. Длинные ответы
+# ассистента показываются свернутыми: полный текст отправляется в браузер только
+# после нажатия "Показать полностью". Объем данных на одно взаимодействие не растет
+# вместе с длиной сессии.
+
+INITIAL_WINDOW = 20
+LOAD_MORE_STEP = 20
+COLLAPSE_THRESHOLD = 1500   # символов
+PREVIEW_LENGTH = 500        # символов
+
+EXPANDED_STATE_KEY = "transcript_expanded"
+
+def message_key(message: Dict) -> str:
+    """
+    Ключ сообщения для состояния виджетов: id, присвоенный при записи.
+    Хэш содержимого считается только для сообщений, сохраненных до появления id.
+    """
+    if message.get("id"):
+        return message["id"]
+    if message.get("seq") is not None:
+        return f"seq{message['seq']}"
+    return hashlib.md5(f"{message.get('role')}:{message.get('content')}".encode()).hexdigest()
+
+def _visible_key(transcript_id: str) -> str:
+    return f"transcript_visible_{transcript_id}"
+
+def _show_more(transcript_id: str):
+    st.session_state[_visible_key(transcript_id)] += LOAD_MORE_STEP
+
+def _reset_window(transcript_id: str):
+    st.session_state[_visible_key(transcript_id)] = INITIAL_WINDOW
+
+def _toggle_expanded(key: str):
+    expanded = st.session_state.setdefault(EXPANDED_STATE_KEY, set())
+    if key in expanded:
+        expanded.discard(key)
+    else:
+        expanded.add(key)
+
+def _preview(content: str) -> str:
+    """Начало длинного сообщения, обрезанное по границе слова"""
+    cut = content[:PREVIEW_LENGTH]
+    space = cut.rfind(" ")
+    if space > PREVIEW_LENGTH // 2:
+        cut = cut[:space]
+    return cut.rstrip() + " …"
+
+def render_message_body(message: Dict, role: str, key: str = None):
+    """
+    Текст сообщения. Длинный ответ ассистента выводится свернутым,
+    полный текст - только для развернутых сообщений.
+    """
+    content = message.get("content", "")
+    if role != "assistant" or len(content) <= COLLAPSE_THRESHOLD:
+        st.markdown(content)
+        return
+
+    key = key or message_key(message)
+    expanded = key in st.session_state.get(EXPANDED_STATE_KEY, set())
+    st.markdown(content if expanded else _preview(content))
+    st.button(
+        "Свернуть" if expanded else f"Показать полностью ({len(content)} символов)",
+        key=f"transcript_toggle_{key}",
+        on_click=_toggle_expanded,
+        args=(key,)
+    )
+
+def render_transcript(transcript_id: str,
+                      fetch_recent: Callable[[int], Tuple[List[Dict], int]],
+                      render_message: Callable[[Dict], None]):
+    """
+    Выводит последние сообщения сессии.
+
+    transcript_id  - идентификатор истории (например, сессии): размер окна хранится отдельно
+                     для каждой истории
+    fetch_recent   - функция (count) -> (последние count сообщений, общее количество)
+    render_message - вывод одного сообщения
+    """
+    visible_key = _visible_key(transcript_id)
+    if visible_key not in st.session_state:
+        st.session_state[visible_key] = INITIAL_WINDOW
+
+    messages, total = fetch_recent(st.session_state[visible_key])
+    hidden = max(total - len(messages), 0)
+
+    if hidden or st.session_state[visible_key] > INITIAL_WINDOW:
+        col1, col2 = st.columns(2)
+        with col1:
+            if hidden:
+                st.button(
+                    f"⬆ Загрузить более ранние ({hidden})",
+                    key=f"transcript_more_{transcript_id}",
+                    on_click=_show_more,
+                    args=(transcript_id,),
+                    use_container_width=True
+                )
+        with col2:
+            if st.session_state[visible_key] > INITIAL_WINDOW:
+                st.button(
+                    "Только последние сообщения",
+                    key=f"transcript_reset_{transcript_id}",
+                    on_click=_reset_window,
+                    args=(transcript_id,),
+                    use_container_width=True
+                )
+
+    for message in messages:
+        if isinstance(message, dict) and "role" in message and "content" in message:
+            render_message(message)
+        else:
+            print(f"Пропущено некорректное сообщение: {message}")
@@ -1,41 +1,161 @@
 from googletrans import Translator
 import streamlit as st
+import hashlib
+import threading
+from collections import OrderedDict
+from utils.database.connections import get_redis_connection
 
 # Создаем глобальный экземпляр переводчика
 translator = Translator()
 
-def translate_text(text, target_lang='ru'):
+# Память переводов: локальный LRU-кэш процесса (L1) и общий кэш в Redis (L2)
+TRANSLATION_CACHE_TTL = 30 * 24 * 3600  # 30 дней
+TRANSLATION_L1_MAX_ITEMS = 5000
+
+class TranslationMemory:
+    """Кэш переводов и определений языка по хэшу текста и целевому языку"""
+    def __init__(self, max_items=TRANSLATION_L1_MAX_ITEMS, ttl=TRANSLATION_CACHE_TTL):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0}
+
+    def _key(self, text, target_lang):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return f"translation:{target_lang}:{digest}"
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get(self, text, target_lang):
+        """Поиск перевода: сначала L1, затем Redis"""
+        key = self._key(text, target_lang)
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self._stats["l1_hits"] += 1
+                return self._items[key]
+        try:
+            value = get_redis_connection().get(key)
+        except Exception as e:
+            print(f"Ошибка чтения памяти переводов: {str(e)}")
+            value = None
+        if value is not None:
+            self._remember(key, value)
+            self._count("l2_hits")
+            return value
+        self._count("misses")
+        return None
+
+    def put(self, text, target_lang, value):
+        """Сохранение перевода в оба уровня кэша"""
+        key = self._key(text, target_lang)
+        self._remember(key, value)
+        try:
+            get_redis_connection().setex(key, self.ttl, value)
+        except Exception as e:
+            print(f"Ошибка записи в память переводов: {str(e)}")
+
+    def get_stats(self):
+        """Статистика попаданий по уровням кэша"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["l1_items"] = len(self._items)
+        total = stats["l1_hits"] + stats["l2_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["l1_hits"] + stats["l2_hits"]) / total, 3) if total else 0.0
+        return stats
+
+translation_memory = TranslationMemory()
+
+# Псевдо-язык для кэширования результатов определения языка
+DETECT_KEY = "detect"
+
+def detect_language(text):
+    """Определяет язык текста (с кэшированием результата)"""
+    cached = translation_memory.get(text, DETECT_KEY)
+    if cached:
+        return cached
+
+    detected = translator.detect(text)
+    detected_lang = detected.lang
+    print(f"Определен язык: {detected_lang} (уверенность: {detected.confidence})")
+
+    # Если уверенность в определении языка низкая, используем запасной метод
+    if detected.confidence is None or detected.confidence < 0.8:
+        print("Низкая уверенность в определении языка, пробуем запасной метод...")
+        from langdetect import detect
+        detected_lang = detect(text)
+        print(f"Язык определен запасным методом: {detected_lang}")
+
+    if isinstance(detected_lang, str):
+        translation_memory.put(text, DETECT_KEY, detected_lang)
+    return detected_lang
+
+def detect_message_language(text):
+    """
+    Определяет язык сообщения при его сохранении (локально, без сетевых запросов).
+    Результат сохраняется в записи сообщения в поле lang и используется при отображении.
+    """
+    if not text or not isinstance(text, str) or not text.strip():
+        return None
+    try:
+        from langdetect import detect
+        return detect(text)
+    except Exception as e:
+        print(f"Не удалось определить язык сообщения: {str(e)}")
+        return None
+
+def translate_chunk(text, target_lang='ru'):
+    """Переводит один фрагмент текста через память переводов"""
+    cached = translation_memory.get(text, target_lang)
+    if cached is not None:
+        return cached
+
+    translation = translator.translate(text, dest=target_lang)
+    if translation and hasattr(translation, 'text') and translation.text:
+        translation_memory.put(text, target_lang, translation.text)
+        return translation.text
+    return None
+
+def translate_text(text, target_lang='ru', source_lang=None):
     """
     Переводит текст на указанный язык, разбивая длинный текст на части
     target_lang: 'ru' для русского или 'en' для английского
+    source_lang: язык текста, если уже известен (определение языка пропускается)
+    Повторяющиеся тексты и фрагменты берутся из памяти переводов.
     """
     try:
         print(f"Начало перевода текста. Целевой язык: {target_lang}")
-        print(f"Исходный текст (первые 100 символов): {text[:100]}...")
         
         if text is None or not isinstance(text, str) or text.strip() == '':
             print("Получен пустой текст для перевода")
             return "Пустой текст для перевода"
         
-        # Создаем новый экземпляр переводчика для каждого перевода
-        translator = Translator()
+        print(f"Исходный текст (первые 100 символов): {text[:100]}...")
+        
+        # Весь текст уже переводился ранее
+        cached = translation_memory.get(text, target_lang)
+        if cached is not None:
+            print("Перевод найден в памяти переводов")
+            return cached
         
         # Определяем язык текста
-        try:
-            detected = translator.detect(text)
-            detected_lang = detected.lang
-            confidence = detected.confidence
-            print(f"Определен язык: {detected_lang} (уверенность: {confidence})")
-            
-            # Если уверенность в определении языка низкая, используем запасной метод
-            if confidence < 0.8:
-                print("Низкая уверенность в определении языка, пробуем запасной метод...")
-                from langdetect import detect
-                detected_lang = detect(text)
-                print(f"Язык определен запасным методом: {detected_lang}")
-        except Exception as e:
-            print(f"Ошибка при определении языка: {str(e)}")
-            return text
+        detected_lang = source_lang
+        if not detected_lang:
+            try:
+                detected_lang = detect_language(text)
+            except Exception as e:
+                print(f"Ошибка при определении языка: {str(e)}")
+                return text
         
         # Если текст уже на целевом языке, возвращаем его
         if detected_lang == target_lang:
@@ -60,25 +180,30 @@ def translate_text(text, target_lang='ru'):
         
         print(f"Текст разбит на {len(parts)} частей")
         
-        # Переводим каждую часть отдельно
+        # Переводим каждую часть отдельно, повторяющиеся части берутся из кэша
         translated_parts = []
+        all_translated = True
         for i, part in enumerate(parts, 1):
             try:
                 print(f"Перевод части {i}/{len(parts)}...")
-                translation = translator.translate(part, dest=target_lang)
-                if translation and hasattr(translation, 'text'):
-                    translated_parts.append(translation.text)
+                translated = translate_chunk(part, target_lang)
+                if translated:
+                    translated_parts.append(translated)
                     print(f"Часть {i} успешно переведена")
                 else:
                     print(f"Ошибка: часть {i} не удалось перевести")
                     translated_parts.append(part)
+                    all_translated = False
             except Exception as e:
                 print(f"Ошибка при переводе части {i}: {str(e)}")
                 translated_parts.append(part)
+                all_translated = False
                 continue
         
         # Объединяем переведенные части
         result = ' '.join(translated_parts)
+        if all_translated:
+            translation_memory.put(text, target_lang, result)
         print("Перевод завершен успешно")
         return result
             
@@ -87,18 +212,12 @@ def translate_text(text, target_lang='ru'):
         st.error(f"Ошибка при переводе: {str(e)}")
         return text
 
-def display_message_with_translation(message, message_hash, avatar, role, button_key=None):
-    """Отображает сообщение с кнопкой перевода"""
-    # Добавляем уникальный идентификатор для каждого сообщения
-    if 'message_display_counter' not in st.session_state:
-        st.session_state.message_display_counter = 0
-    st.session_state.message_display_counter += 1
-    
-    # Создаем уникальный ключ для кнопки, используя счетчик
+def display_message_with_translation(message, message_id, avatar, role, button_key=None):
+    """Отображает сообщение с кнопкой перевода (ключи виджетов и состояние перевода - по id сообщения)"""
     if button_key is None:
-        button_key = f"translate_{message_hash}_{role}_{st.session_state.message_display_counter}"
+        button_key = f"translate_{message_id}"
     
-    translation_key = f"translation_{message_hash}"
+    translation_key = f"translation_{message_id}"
     content = message.get("content", "")
     
     with st.chat_message(role, avatar=avatar):
@@ -121,29 +240,33 @@ def display_message_with_translation(message, message_hash, avatar, role, button
             
             current_state = st.session_state[translation_key]
             
+            # Язык определен при сохранении сообщения, при отображении он только читается
+            message_lang = message.get("lang")
+            target_lang = 'en' if message_lang == 'ru' else 'ru'
+            
             # Отображаем текст
             if current_state["is_translated"]:
                 if current_state["translated_text"] is None:
-                    current_state["translated_text"] = translate_text(content)
+                    current_state["translated_text"] = translate_text(content, target_lang, source_lang=message_lang)
                 message_placeholder.markdown(current_state["translated_text"])
             else:
                 message_placeholder.markdown(content)
         
         with cols[1]:
-            # Кнопка перевода с динамической подсказкой и уникальным ключом
-            try:
-                detected_lang = translator.detect(content).lang
-                tooltip = "Перевести на английский" if detected_lang == 'ru' else "Перевести на русский"
-            except:
+            # Кнопка перевода с подсказкой по сохраненному языку сообщения
+            if message_lang == 'ru':
+                tooltip = "Перевести на английский"
+            elif message_lang:
+                tooltip = "Перевести на русский"
+            else:
                 tooltip = "Перевести"
                 
-            translate_button_key = f"{button_key}_translate_{st.session_state.message_display_counter}"
-            if st.button("🔄", key=translate_button_key, help=tooltip):
+            if st.button("🔄", key=button_key, help=tooltip):
                 current_state = st.session_state[translation_key]
                 current_state["is_translated"] = not current_state["is_translated"]
                 
                 if current_state["is_translated"] and current_state["translated_text"] is None:
-                    current_state["translated_text"] = translate_text(content)
+                    current_state["translated_text"] = translate_text(content, target_lang, source_lang=message_lang)
                 
                 message_placeholder.markdown(
                     current_state["translated_text"] if current_state["is_translated"] 
@@ -151,9 +274,8 @@ def display_message_with_translation(message, message_hash, avatar, role, button
                 )
         
         with cols[2]:
-            # Кнопка удаления с уникальным ключом
-            delete_button_key = f"delete_{message_hash}_{st.session_state.message_display_counter}"
-            if st.button("🗑", key=delete_button_key, help="Удалить сообщение"):
+            # Кнопка удаления
+            if st.button("🗑", key=f"delete_{message_id}", help="Удалить сообщение"):
                 return True
     
     return False 
\ No newline at end of file
@@ -0,0 +1,145 @@
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from redis.exceptions import ResponseError
+from utils.database.connections import get_redis_connection
+from utils.database.database_manager import get_database
+
+# Счетчики использования для аналитики.
+#
+# usage:{YYYYMMDDHH} - HASH: "{flow_id}|{username}" -> число генераций за час
+# usage:pending      - SET часов, чьи счетчики еще не перенесены в MongoDB
+# usage:{YYYYMMDDHH}:flushing - счетчик часа, который сейчас переносится
+# usage:{YYYYMMDDHH}:lock     - блокировка переноса часа
+#
+# Запись сообщения добавляет одно HINCRBY (в конвейере), а перенос в коллекцию
+# usage_rollups выполняется пакетно: стоимость отчетов зависит от выбранного
+# периода, а не от количества сообщений в chat_history.
+
+PENDING_SET_KEY = "usage:pending"
+BUCKET_TTL = 7 * 86400    # страховка от накопления непереносимых счетчиков
+FLUSH_LOCK_TIMEOUT = 300  # блокировка часа снимается сама, если процесс упал
+FIELD_SEPARATOR = "|"
+
+def _bucket_key(hour: str) -> str:
+    return f"usage:{hour}"
+
+def record_generation(username: str, flow_id: str, count: int = 1, now: Optional[datetime] = None):
+    """Учитывает генерацию ответа в часовом счетчике"""
+    hour = (now or datetime.now()).strftime("%Y%m%d%H")
+    key = _bucket_key(hour)
+    try:
+        pipe = get_redis_connection().pipeline(transaction=False)
+        pipe.hincrby(key, f"{flow_id}{FIELD_SEPARATOR}{username}", count)
+        pipe.expire(key, BUCKET_TTL)
+        pipe.sadd(PENDING_SET_KEY, hour)
+        pipe.execute()
+    except Exception as e:
+        # Учет использования не должен мешать отправке сообщения
+        print(f"Ошибка при учете использования: {str(e)}")
+
+def _flushing_key(hour: str) -> str:
+    return f"{_bucket_key(hour)}:flushing"
+
+def _write_counters(redis_client, db, hour: str) -> int:
+    """
+    Переносит переименованный счетчик часа в usage_rollups.
+    Если часть записей не выполнена, в живой счетчик возвращаются только они.
+    """
+    flushing_key = _flushing_key(hour)
+    counters = redis_client.hgetall(flushing_key)
+    hour_start = datetime.strptime(hour, "%Y%m%d%H")
+    fields = list(counters)
+    operations = []
+    for field in fields:
+        flow_id, _, username = field.partition(FIELD_SEPARATOR)
+        operations.append(UpdateOne(
+            {"hour": hour_start, "flow_id": flow_id, "username": username},
+            {"$inc": {"generations": int(counters[field])}, "$setOnInsert": {"day": hour_start.strftime("%Y-%m-%d")}},
+            upsert=True
+        ))
+
+    failed = []
+    if operations:
+        try:
+            db.usage_rollups.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            failed = [fields[error["index"]] for error in e.details.get("writeErrors", [])]
+            print(f"Ошибка при переносе счетчиков использования: {len(failed)} из {len(operations)} записей")
+
+    pipe = redis_client.pipeline()
+    if failed:
+        key = _bucket_key(hour)
+        for field in failed:
+            pipe.hincrby(key, field, int(counters[field]))
+        pipe.expire(key, BUCKET_TTL)
+        pipe.sadd(PENDING_SET_KEY, hour)
+    pipe.delete(flushing_key)
+    pipe.execute()
+    return len(operations) - len(failed)
+
+def _flush_hour(redis_client, db, hour: str) -> int:
+    """Перенос счетчиков одного часа под блокировкой часа"""
+    lock = redis_client.lock(f"usage:{hour}:lock", timeout=FLUSH_LOCK_TIMEOUT, blocking=False)
+    if not lock.acquire():
+        # Этот час сейчас переносит другой процесс, вернемся к нему в следующий раз
+        redis_client.sadd(PENDING_SET_KEY, hour)
+        return 0
+    try:
+        flushed = 0
+        # Счетчик, оставшийся от прерванного переноса, переносится первым
+        if redis_client.exists(_flushing_key(hour)):
+            flushed += _write_counters(redis_client, db, hour)
+        try:
+            renamed = redis_client.renamenx(_bucket_key(hour), _flushing_key(hour))
+        except ResponseError:
+            # Ключа нет: новых генераций за этот час не было
+            renamed = False
+        if renamed:
+            flushed += _write_counters(redis_client, db, hour)
+        return flushed
+    except Exception as e:
+        # Счетчик :flushing остается и будет перенесен при следующем проходе
+        redis_client.sadd(PENDING_SET_KEY, hour)
+        print(f"Ошибка при переносе счетчиков использования: {str(e)}")
+        return 0
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            pass
+
+def flush_usage_rollups() -> int:
+    """
+    Переносит часовые счетчики в коллекцию usage_rollups.
+    Счетчик переименовывается перед чтением, поэтому генерации, учтенные во время
+    переноса, попадают в новый ключ и не теряются. Ключи :flushing, оставшиеся после
+    падения процесса, подбираются при следующем вызове.
+    Возвращает число обновленных записей.
+    """
+    redis_client = get_redis_connection()
+    db = get_database()
+    flushed = 0
+
+    hours = set(redis_client.smembers(PENDING_SET_KEY))
+    for key in redis_client.scan_iter("usage:*:flushing", count=500):
+        hours.add(key[len("usage:"):-len(":flushing")])
+
+    for hour in sorted(hours):
+        # Сначала снимаем отметку: новые записи снова добавят час в очередь
+        redis_client.srem(PENDING_SET_KEY, hour)
+        flushed += _flush_hour(redis_client, db, hour)
+
+    return flushed
+
+def get_usage_rollups(start: datetime, end: Optional[datetime] = None,
+                      flow_id: Optional[str] = None) -> List[Dict]:
+    """Часовые записи использования за период (только поля, нужные для отчетов)"""
+    query = {"hour": {"$gte": start, "$lt": end or datetime.now() + timedelta(hours=1)}}
+    if flow_id:
+        query["flow_id"] = flow_id
+    return list(get_database().usage_rollups.find(
+        query,
+        {"_id": 0, "hour": 1, "flow_id": 1, "username": 1, "generations": 1}
+    ))
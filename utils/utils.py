@@ -7,6 +7,8 @@ from streamlit.runtime.scriptrunner import add_script_run_ctx
 from streamlit import switch_page
 import streamlit as st
 from utils.database.database_manager import get_database
+from utils.quota import consume_generation, finalize_generation, get_remaining, set_balance
+from utils import token_registry
 
 # Определяем базовый путь для файлов данных
 DATA_DIR = "/data" if os.path.exists("/data") else "."
@@ -54,9 +56,12 @@ def check_token_status(username):
                 }
             }
         )
+        # Счетчик в Redis - источник истины для списания, обнуляем и его
+        set_balance(username, 0)
+        db.invalidate_user(username)
         return False, "Токен был деактивирован"
         
-    remaining_generations = user.get('remaining_generations', 0)
+    remaining_generations = get_remaining(username)
     if remaining_generations <= 0:
         # Деактивируем токен если генерации закончились
         save_deactivated_token(user['active_token'])
@@ -72,147 +77,47 @@ def check_token_status(username):
                 }
             }
         )
+        set_balance(username, 0)
+        db.invalidate_user(username)
         return False, "Токен деактивирован: закончились генерации"
         
     return True, f"Токен активен. Осталось генераций: {remaining_generations}"
 
 def save_token(token, generations=500):
-    chat_dir = os.path.join(os.path.dirname(__file__), '..', 'chat')
-    os.makedirs(chat_dir, exist_ok=True)
-    keys_file = os.path.join(chat_dir, 'access_keys.json')
-    
-    try:
-        # Проверяем, не был ли токен деактивирован ранее
-        if is_token_deactivated(token):
-            print(f"Попытка повторного использования деактивированного токена: {token}")
-            return False
-            
-        # Читаем существующие данные или создаем новые
-        if os.path.exists(keys_file):
-            with open(keys_file, 'r', encoding='utf-8') as f:
-                try:
-                    data = json.load(f)
-                except:
-                    data = {"keys": [], "generations": {}}
-        else:
-            data = {"keys": [], "generations": {}}
-        
-        # Добавляем токен
-        token = token.strip('"')
-        if token not in data["keys"]:
-            data["keys"].append(token)
-            # Добавляем дату активации
-            if "activation_dates" not in data:
-                data["activation_dates"] = {}
-            data["activation_dates"][token] = datetime.now().isoformat()
-            
-        data["generations"][token] = generations
-        
-        # Сохраняем данные
-        with open(keys_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        print(f"Error saving token: {str(e)}")
-        return False
+    """Регистрирует токен в реестре токенов"""
+    return token_registry.register_token(token, generations, activated_at=datetime.now())
 
 def load_access_keys():
-    chat_dir = os.path.join(os.path.dirname(__file__), '..', 'chat')
-    os.makedirs(chat_dir, exist_ok=True)
-    keys_file = os.path.join(chat_dir, 'access_keys.json')
-    
+    """Список неиспользованных токенов"""
     try:
-        if os.path.exists(keys_file):
-            with open(keys_file, 'r', encoding='utf-8') as f:
-                try:
-                    data = json.load(f)
-                    if isinstance(data, dict) and "keys" in data:
-                        return data["keys"]
-                except:
-                    return []
-        return []
+        return token_registry.list_unused_tokens()
     except Exception as e:
         print(f"Error loading keys: {str(e)}")
         return []
 
 def remove_used_key(used_key):
-    json_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'access_keys.json')
-    
-    try:
-        if not os.path.exists(json_file):
-            return False
-        
-        with open(json_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-            except:
-                data = {"keys": [], "generations": {}}
-        
-        if used_key in data.get('keys', []):
-            data['keys'].remove(used_key)
-        elif f'"{used_key}"' in data.get('keys', []):
-            data['keys'].remove(f'"{used_key}"')
-        
-        if used_key in data.get('generations', {}):
-            del data['generations'][used_key]
-        
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        print(f"Ошибка при удалении ключа: {str(e)}")
-        return False
+    """Удаляет использованный токен из реестра"""
+    return token_registry.remove_token(used_key)
 
-def update_remaining_generations(username, used):
-    """Обновляет количество оставшихся генераций путем вычитания использованных генераций"""
-    user = db.get_user(username)
-    
-    if not user:
-        return False
-    
-    current_generations = user.get('remaining_generations', 0)
-    
-    new_remaining = current_generations - used
-    
-    if new_remaining <= 0:
-        new_remaining = 0
-        if user.get('active_token'):
-            used_token = user['active_token']
+def reserve_generation(username, used=1):
+    """
+    Списывает генерации до запроса к модели (атомарно, через счетчик квоты в Redis).
+    Возвращает (списано ли, остаток). Если ответ не получен, генерации
+    возвращаются через refund_generation.
+    """
+    if used <= 0:
+        return False, 0
+    return consume_generation(username, used, finalize=False)
 
-            # Помечаем токен как использованный
-            db.access_tokens.update_one(
-                {"token": used_token},
-                {"$set": {"used": True, "deactivated_at": datetime.now()}}
-            )
+def complete_generation(username, remaining):
+    """Завершает списание после получения ответа"""
+    finalize_generation(username, remaining)
 
-            # Обновляем данные пользователя - деактивируем токен
-            db.users.update_one(
-                {"username": username},
-                {
-                    "$set": {
-                        "active_token": None,
-                        "remaining_generations": new_remaining,
-                        "token_deactivated_at": datetime.now()
-                    }
-                }
-            )
+    if remaining <= 0:
+        if 'access_granted' in st.session_state:
+            st.session_state.access_granted = False
 
-            if 'access_granted' in st.session_state:
-                st.session_state.access_granted = False
-
-            st.warning("⚠️ Ваш токен был деактивирован из-за окончания генераций. Пожалуйста, активируйте новый токен.")
-    else:
-        db.users.update_one(
-            {"username": username},
-            {
-                "$set": {
-                    "remaining_generations": new_remaining,
-                    "last_generation_update": datetime.now()
-                }
-            }
-        )
-    
-    return True
+        st.warning("⚠️ Ваш токен был деактивирован из-за окончания генераций. Пожалуйста, активируйте новый токен.")
 
 def verify_user_access():
     """Проверяет доступ пользователя.
@@ -235,44 +140,12 @@ def generate_and_save_token(generations=500):
     return generate_unique_token()
 
 def save_deactivated_token(token):
-    """Сохраняет деактивированный токен в отдельный файл"""
-    deactivated_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'deactivated_keys.json')
-    try:
-        if os.path.exists(deactivated_file):
-            with open(deactivated_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-        else:
-            data = {"deactivated_keys": []}
-        
-        # Добавляем информацию о деактивированном токене
-        token_info = {
-            "token": token.strip('"'),
-            "deactivated_at": datetime.now().isoformat(),
-            "reason": "generations_depleted"
-        }
-        
-        data["deactivated_keys"].append(token_info)
-        
-        with open(deactivated_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        print(f"Ошибка при сохранении деактивированного токена: {str(e)}")
-        return False
+    """Сохраняет деактивированный токен в реестре"""
+    return token_registry.deactivate_token(token, reason="generations_depleted")
 
 def is_token_deactivated(token):
     """Проверяет, был ли токен деактивирован ранее"""
-    deactivated_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'deactivated_keys.json')
-    try:
-        if os.path.exists(deactivated_file):
-            with open(deactivated_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                deactivated_keys = [info["token"] for info in data.get("deactivated_keys", [])]
-                return token.strip('"') in deactivated_keys
-        return False
-    except Exception as e:
-        print(f"Ошибка при проверке деактивированного токена: {str(e)}")
-        return False
+    return token_registry.is_token_deactivated(token)
 
 def verify_admin_access():
     """Проверяет, имеет ли текущий пользователь права администратора"""